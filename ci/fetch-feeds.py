@@ -7,12 +7,14 @@ import sys
 import os
 from pathlib import Path
 import subprocess
-import multiprocessing
-import concurrent.futures
 import requests
 import json
 from datetime import datetime, timezone
 
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from fetch import Fetcher, FetchScheduler  # noqa: E402
+
 if len(sys.argv) < 2:
     print("Argument run-reason is missing.")
     print("Must be one of timer, merge-request")
@@ -108,30 +110,24 @@ On **{time_string}**:
     print(f"Created error issue for {feed}")
 
 
-def do_fetch(feed: Path):
-    try:
-        details = subprocess.check_output(
-            ["./src/fetch.py", feed], stderr=subprocess.STDOUT
-        ).decode()
-        print(details)
-    except subprocess.CalledProcessError as error:
-        print(f"Error fetching {feed}:")
-        print(error.output.decode())
-        if "GITHUB_TOKEN" in os.environ:
-            create_feed_error_issue(feed, error.output.decode(), os.environ["GITHUB_TOKEN"])
-        else:
-            print("Can't report issue, because no token is set")
+def report_errors(feed: Path, errors: list[str], log: str):
+    # The log of the region, like when it was fetched in its own process
+    details = log + "\n".join(errors)
+    print(f"Error fetching {feed}:")
+    print(details)
+    if "GITHUB_TOKEN" in os.environ:
+        create_feed_error_issue(feed, details, os.environ["GITHUB_TOKEN"])
+    else:
+        print("Can't report issue, because no token is set")
 
 
 match run_reason:
     case "timer":
-        json_files = list(feed_dir.glob("*.json"))
+        json_files = sorted(feed_dir.glob("*.json"))
 
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=multiprocessing.cpu_count()
-        ) as executor:
-            for feed in json_files:
-                executor.submit(do_fetch, feed)
+        scheduler = FetchScheduler(Fetcher())
+        for feed, errors in scheduler.run(json_files).items():
+            report_errors(feed, errors, scheduler.log(feed))
 
         subprocess.check_call(["./src/garbage-collect.py"])
     case "merge-request":
@@ -156,5 +152,7 @@ match run_reason:
             if Path(f).exists() and f.startswith("feeds/") and f.endswith(".json")
         ]
 
-        for feed in changed_feeds:
-            subprocess.check_call(["./src/fetch.py", feed])
+        # Fetch all changed regions in one run, so that the dataset change
+        # manifest covers all of them
+        if changed_feeds:
+            subprocess.check_call(["./src/fetch.py", *changed_feeds])
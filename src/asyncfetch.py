@@ -0,0 +1,341 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# asyncio based download engine. It follows the same rules as
+# download_http_source in fetch.py, but keeps thousands of (mostly
+# conditional) requests in flight without a thread for each of them.
+#
+
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Optional, AsyncIterator
+from zipfile import ZipFile
+from metadata import HttpSource
+from downloadstate import DownloadState
+from utils import eprint
+from fetch import Fetcher, FetchJob, FetchScheduler, JobError, Download, \
+    DownloadError, PartialDownload, TransientHttpError, RETRY_STATUS_CODES, \
+    CHUNK_SIZE, request_headers, local_last_modified, fetch_interval_pending, \
+    download_urls, server_is_older, conditional_headers, retry_delay, \
+    temp_path_for, http_sessions, probe_unchanged
+from sessions import host_of
+from fetchhistory import FetchRecord
+from postprocesspool import PostprocessPool
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import joblog
+import ssl
+import time
+
+import httpx
+
+
+class AsyncHostLimit:
+    semaphore: asyncio.Semaphore
+    lock: asyncio.Lock
+    last_request: float = 0.0
+
+    def __init__(self, max_connections: int):
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.lock = asyncio.Lock()
+
+
+class AsyncDownloader:
+    """
+    Owns the HTTP clients and the per-host limits of the async engine.
+    Has to be used from inside a running event loop.
+    """
+    max_connections_per_host: int
+    min_request_interval: float
+
+    def __init__(self, max_in_flight: int = 256,
+                 max_connections_per_host: int = 4,
+                 min_request_interval: float = 0.2):
+        self.max_connections_per_host = max_connections_per_host
+        self.min_request_interval = min_request_interval
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._limits: dict[str, AsyncHostLimit] = {}
+
+        limits = httpx.Limits(max_connections=max_in_flight,
+                              max_keepalive_connections=max_in_flight)
+        self._clients = {
+            False: httpx.AsyncClient(limits=limits, follow_redirects=True),
+            True: httpx.AsyncClient(limits=limits, follow_redirects=True,
+                                    verify=lenient_ssl_context()),
+        }
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+
+    @asynccontextmanager
+    async def host_slot(self, url: str) -> AsyncIterator[None]:
+        """
+        Waits until a request to the host of url may be started,
+        and holds a connection slot for that host until the block is left.
+        """
+        host = host_of(url)
+        if host not in self._limits:
+            self._limits[host] = AsyncHostLimit(self.max_connections_per_host)
+        limit = self._limits[host]
+
+        async with limit.semaphore:
+            async with limit.lock:
+                wait = limit.last_request + self.min_request_interval \
+                    - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                limit.last_request = time.monotonic()
+
+            yield
+
+    async def _request(self, client: httpx.AsyncClient, url: str,
+                       source: HttpSource, headers: dict[str, str],
+                       state: DownloadState,
+                       last_modified: Optional[datetime],
+                       partial: PartialDownload,
+                       record: FetchRecord) -> Optional[httpx.Headers]:
+        """
+        Downloads url into partial, returns the response headers or None if
+        the server has nothing newer.
+        """
+        timeout = source.options.timeout
+
+        # Servers that answered conditional requests before don't
+        # need the additional HEAD request
+        if not source.options.method and not state.conditional_get \
+                and not partial.size:
+            with record.phase("head"):
+                head = await client.head(url, headers=headers, timeout=timeout)
+
+            # If server version is older, return
+            if server_is_older(head.headers, last_modified):
+                state.record("not-modified")
+                return None
+
+        with record.phase("get"):
+            async with client.stream(
+                    source.options.method or "GET", url,
+                    content=source.options.request_body,
+                    headers=headers | conditional_headers(state, last_modified) | partial.resume_headers(),
+                    timeout=timeout) as response:
+                record.http_status = response.status_code
+
+                # If the file was not modified, return
+                if response.status_code == 304:
+                    state.conditional_get = True
+                    state.record("not-modified")
+                    return None
+
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise TransientHttpError(response.status_code)
+
+                with partial.open_for(response.status_code, response.headers) as f:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        # Hashing and writing would block all other transfers
+                        await asyncio.to_thread(partial.write, f, chunk)
+
+                return response.headers
+
+    async def download(self, dest_path: Path, source: HttpSource,
+                       state: DownloadState,
+                       record: Optional[FetchRecord] = None) -> Optional[Download]:
+        """
+        Async counterpart of fetch.download_http_source.
+        The urls will be tried in the following order: url_override, url, cache_url
+        """
+        record = record or FetchRecord()
+        client = self._clients[source.options.ignore_tls_errors]
+
+        headers = request_headers(source)
+        last_modified = local_last_modified(dest_path)
+
+        if fetch_interval_pending(source, last_modified):
+            state.record("skipped")
+            return None
+
+        urls_to_try = download_urls(source)
+        primary_url_name, primary_url = urls_to_try[0]
+        temp_path = temp_path_for(dest_path)
+
+        errors = []
+        async with self._in_flight:
+            while urls_to_try:
+                name, url = urls_to_try.pop(0)
+                partial = PartialDownload(temp_path)
+                try:
+                    for attempt in itertools.count():
+                        try:
+                            async with self.host_slot(url):
+                                response_headers = await self._request(
+                                    client, url, source, headers, state,
+                                    last_modified, partial, record)
+                            break
+                        except (TransientHttpError, httpx.TransportError) as e:
+                            if attempt >= source.options.retries:
+                                raise
+
+                            delay = retry_delay(source, attempt)
+                            resume_note = f", resuming at {partial.size} bytes" \
+                                if partial.can_resume() else ""
+                            eprint(f"Warning: Fetching {url} failed ({e!r}), retrying in {delay:.1f}s{resume_note}")
+                            await asyncio.sleep(delay)
+
+                    if response_headers is None:
+                        return None
+
+                    # Try if response was zip
+                    # (some servers return html error page with code 200)
+                    await asyncio.to_thread(lambda: ZipFile(temp_path).close())
+
+                    # all errors checked, it worked
+                    if name != primary_url_name:
+                        eprint(f"Warning: Used {name} instead of {primary_url_name} ({primary_url}) because it was not reachable")
+
+                    return Download(temp_path, partial.hash.hexdigest(), response_headers)
+                except Exception as e:
+                    temp_path.unlink(missing_ok=True)
+                    errors.append((name, e))
+                finally:
+                    record.bytes_transferred += partial.transferred
+
+        raise DownloadError(errors)
+
+
+class AsyncFetchScheduler(FetchScheduler):
+    """
+    Like FetchScheduler, but downloads HTTP sources with the asyncio engine.
+    Sources that need blocking work (helper functions, FTP, storing the
+    download) are handed to threads, and finished downloads go straight to
+    the postprocess pool.
+    """
+    max_in_flight: int
+
+    def __init__(self, fetcher: Fetcher, max_in_flight: int = 256, **kwargs):
+        super().__init__(fetcher, **kwargs)
+        self.max_in_flight = max_in_flight
+
+    def fetch_all(self, jobs: list[FetchJob],
+                  postprocess_pool: PostprocessPool) \
+            -> dict[concurrent.futures.Future, FetchJob]:
+        return asyncio.run(self._fetch_all(jobs, postprocess_pool))
+
+    async def _fetch_all(self, jobs: list[FetchJob],
+                         postprocess_pool: PostprocessPool) \
+            -> dict[concurrent.futures.Future, FetchJob]:
+        postprocesses: dict[concurrent.futures.Future, FetchJob] = {}
+        downloader = AsyncDownloader(
+            max_in_flight=self.max_in_flight,
+            max_connections_per_host=http_sessions.max_connections_per_host,
+            min_request_interval=http_sessions.min_request_interval)
+        loop = asyncio.get_running_loop()
+        # Blocking parts of the jobs, mostly helper functions doing requests
+        blocking_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.network_workers)
+
+        async def run_job(job: FetchJob):
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            try:
+                with joblog.capture(job.log):
+                    future.set_result(await self._fetch_job(
+                        job, downloader, loop, blocking_pool))
+            except BaseException as e:
+                future.set_exception(e)
+
+            self.fetched(job, future, postprocess_pool, postprocesses)
+
+        try:
+            await asyncio.gather(*map(run_job, jobs))
+        finally:
+            await downloader.aclose()
+            blocking_pool.shutdown()
+
+        return postprocesses
+
+    async def needs_postprocess(self, job: FetchJob,
+                                loop: asyncio.AbstractEventLoop,
+                                blocking_pool: concurrent.futures.Executor) \
+            -> bool:
+        # May need to hash the download, which would block all transfers
+        return await loop.run_in_executor(
+            blocking_pool, in_context(self.fetcher.needs_postprocess, job))
+
+    async def _fetch_job(self, job: FetchJob, downloader: AsyncDownloader,
+                         loop: asyncio.AbstractEventLoop,
+                         blocking_pool: concurrent.futures.Executor) -> bool:
+        if not await loop.run_in_executor(
+                blocking_pool, in_context(self.fetcher.prepare_job, job)):
+            return False
+
+        assert job.download_path
+        source = job.source
+        if not isinstance(source, HttpSource):
+            try:
+                await loop.run_in_executor(
+                    blocking_pool, in_context(self.fetcher.fetch_source,
+                                              job.download_path, source,
+                                              job.record))
+            except Exception as e:
+                raise JobError(f"Could not fetch {job.id}: {e}") from e
+
+            return await self.needs_postprocess(job, loop, blocking_pool)
+
+        state = DownloadState.for_download(job.download_path)
+        try:
+            if await loop.run_in_executor(
+                    blocking_pool, in_context(lambda: probe_unchanged(
+                        job.download_path, source, state, record=job.record))):
+                return await self.needs_postprocess(job, loop, blocking_pool)
+
+            for attempt in itertools.count():
+                try:
+                    download = await downloader.download(
+                        job.download_path, source, state, job.record)
+                    break
+                except Exception as e:
+                    if attempt > 0 or not await loop.run_in_executor(
+                            blocking_pool, in_context(
+                                self.fetcher.renew_credentials, job, e)) \
+                            or not isinstance(job.source, HttpSource):
+                        raise
+                    source = job.source
+
+            if download:
+                try:
+                    await loop.run_in_executor(
+                        blocking_pool, in_context(self.fetcher.store_download,
+                                                  job.download_path, source,
+                                                  download, state))
+                finally:
+                    download.discard()
+        except Exception as e:
+            state.record("failed")
+            raise JobError(f"Could not fetch {job.id}: {e}") from e
+        finally:
+            state.save()
+            job.record.outcome = state.outcome
+
+        return await self.needs_postprocess(job, loop, blocking_pool)
+
+
+def in_context(function: Callable[..., Any], *args) -> Callable[[], Any]:
+    """
+    Binds function to the context of the current task, so that it keeps
+    the job log when it runs in an executor.
+    """
+    return functools.partial(contextvars.copy_context().run, function, *args)
+
+
+def lenient_ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.set_ciphers("ALL:@SECLEVEL=1")
+    return context
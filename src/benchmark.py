@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Benchmarks for the hot paths of the import pipeline, run on synthetic data.
+# Each benchmark compares against the previous implementation, which is kept
+# here as a reference, and checks that both give the same results.
+#
+
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import Iterable, Callable, Any
+from zipfile import ZipFile, ZIP_DEFLATED
+from zoneinfo import ZoneInfo
+
+import argparse
+import copy
+import importlib
+import io
+import json
+import random
+import tempfile
+import time
+
+import gtfs
+import metadata
+
+# Scripts with dashes in their name can't be imported directly
+fix_csv_quotes = importlib.import_module("fix-csv-quotes")
+
+
+def measure(name: str, function: Callable[[], Any]) -> tuple[float, Any]:
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    print(f"{name:>12}: {duration:8.3f}s")
+    return duration, result
+
+
+#
+# Feed validity check
+#
+
+def reference_check_feed_timeframe_valid(zip_file: ZipFile) -> gtfs.FeedValidity:
+    def parse_gtfs_date(date: str, feed_timezone: ZoneInfo) -> datetime:
+        return datetime.strptime(date.strip(), "%Y%m%d") \
+            .replace(tzinfo=feed_timezone)
+
+    def read_file(name: str) -> Iterable[dict]:
+        if name not in zip_file.namelist():
+            return []
+
+        return gtfs.parse_gtfs_csv(io.TextIOWrapper(zip_file.open(name, "r")))
+
+    feed_info = list(read_file("feed_info.txt"))
+    calendar = read_file("calendar.txt")
+    calendar_dates = read_file("calendar_dates.txt")
+
+    feed_timezone = ZoneInfo(gtfs.get_feed_timezone(zip_file))  # type: ignore
+    today = datetime.now(tz=feed_timezone)
+
+    if feed_info and not any(map(
+            lambda row: not row.get("feed_start_date") or
+            parse_gtfs_date(row["feed_start_date"], feed_timezone) <= today,
+            feed_info)):
+        return gtfs.FeedValidity.IN_FUTURE
+
+    def latest(rows: Iterable[dict], column: str):
+        dates = [parse_gtfs_date(row[column], feed_timezone)
+                 for row in rows if row.get(column)]
+        return max(dates) if dates else None
+
+    feed_info_end = latest(feed_info, "feed_end_date")
+    calendar_end = latest(calendar, "end_date")
+    calendar_dates_end = latest(calendar_dates, "date")
+
+    if feed_info_end:
+        valid = feed_info_end >= today
+    else:
+        valid = bool(calendar_end and calendar_end >= today or
+                     calendar_dates_end and calendar_dates_end >= today)
+
+    return gtfs.FeedValidity.CURRENTLY_VALID if valid \
+        else gtfs.FeedValidity.EXPIRED
+
+
+def write_synthetic_calendar_feed(path: Path, rows: int, end: datetime):
+    start = end - timedelta(days=365)
+    with ZipFile(path, "w", compression=ZIP_DEFLATED) as z:
+        z.writestr("agency.txt",
+                   "agency_id,agency_name,agency_url,agency_timezone\n"
+                   "1,Agency,https://example.org,Europe/Berlin\n")
+        with z.open("calendar.txt", "w") as f:
+            f.write(b"service_id,monday,tuesday,wednesday,thursday,friday,"
+                    b"saturday,sunday,start_date,end_date\n")
+            for service in range(rows // 100):
+                f.write(f"s{service},1,1,1,1,1,0,0,{start:%Y%m%d},{end:%Y%m%d}\n"
+                        .encode())
+        with z.open("calendar_dates.txt", "w") as f:
+            f.write(b"service_id,date,exception_type\n")
+            for row in range(rows):
+                date = start + timedelta(days=random.randrange(366))
+                f.write(f"s{row % 1000},{date:%Y%m%d},{1 + row % 2}\n".encode())
+
+
+def benchmark_validity(arguments: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, end in [("valid", datetime.now() + timedelta(days=30)),
+                           ("expired", datetime.now() - timedelta(days=30))]:
+            path = Path(tmp) / f"{label}.gtfs.zip"
+            write_synthetic_calendar_feed(path, arguments.rows, end)
+            print(f"{label} feed, {arguments.rows} calendar_dates rows:")
+
+            with ZipFile(path) as z:
+                reference_time, expected = measure(
+                    "reference", lambda: reference_check_feed_timeframe_valid(z))
+                scan_time, result = measure(
+                    "scanner", lambda: gtfs.check_feed_timeframe_valid(z))
+
+            assert result == expected, f"{result} != {expected}"
+            print(f"{'speedup':>12}: {reference_time / scan_time:8.1f}x")
+
+
+#
+# fix-csv-quotes
+#
+
+def reference_parse_fuzzy_csv(csv: str) -> list[list[str]]:
+    from functools import reduce
+
+    rows = []
+
+    # skip BOM
+    if csv.startswith("\ufeff"):
+        csv = csv[len("\ufeff"):]
+
+    # Split lines and fields
+    for line in csv.splitlines():
+        start = 0
+        current_field_start = 0
+        fields = []
+
+        while True:
+            fieldsep = line.find(",", start)
+            if fieldsep == -1:
+                field = line[current_field_start:]
+                fields.append(fix_csv_quotes.strip_quotes(field.strip()))
+                rows.append(fields)
+                break
+
+            field = line[current_field_start:fieldsep]
+            numquotes = reduce(
+                lambda acc, c: acc + 1 if c == '"' else acc, field, 0)
+            if numquotes % 2 == 0:
+                fields.append(fix_csv_quotes.strip_quotes(field.strip()))
+                current_field_start = fieldsep + 1
+                start = fieldsep + 1
+            else:
+                start = fieldsep + 1
+
+    # Unescape
+    for i, row in enumerate(rows):
+        for j, field in enumerate(row):
+            rows[i][j] = field.replace('""', '"')
+
+    return rows
+
+
+def reference_fix_csv(content: bytes) -> bytes:
+    import csv
+
+    with io.StringIO() as outcsv:
+        writer = csv.writer(outcsv)
+        for row in reference_parse_fuzzy_csv(content.decode()):
+            writer.writerow(row)
+
+        return outcsv.getvalue().encode()
+
+
+def streaming_fix_csv(content: bytes) -> bytes:
+    output = io.BytesIO()
+    # Keep the buffer readable after the wrapper closes it
+    output.close = lambda: None  # type: ignore
+    fix_csv_quotes.fix_csv(io.BytesIO(content), output)
+    return output.getvalue()
+
+
+def write_synthetic_stop_times(rows: int, long_field_length: int) -> bytes:
+    lines = ["\ufefftrip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign"]
+    long_field = ", ".join(["Hauptbahnhof"] * (long_field_length // 14))
+    for row in range(rows):
+        time = f"{8 + row % 12:02}:{row % 60:02}:00"
+        match row % 50:
+            case 0:
+                # Unescaped quotes inside a quoted field
+                headsign = '"Zentrum "Altstadt", Markt"'
+            case 1:
+                # Long quoted field with many commas
+                headsign = f'"{long_field}"'
+            case 2:
+                # Odd number of quotes, never closed
+                headsign = '"broken, field'
+            case _:
+                headsign = f"Stop {row % 1000}"
+        lines.append(f"t{row // 30},{time},{time},s{row % 5000},{row % 30},{headsign}")
+
+    return "\r\n".join(lines).encode()
+
+
+def benchmark_fix_csv_quotes(arguments: argparse.Namespace):
+    content = write_synthetic_stop_times(arguments.rows,
+                                         arguments.long_field_length)
+    print(f"stop_times.txt, {arguments.rows} rows, {len(content) / 1e6:.1f} MB:")
+
+    reference_time, expected = measure(
+        "reference", lambda: reference_fix_csv(content))
+    streaming_time, result = measure(
+        "streaming", lambda: streaming_fix_csv(content))
+
+    assert result == expected, "Output differs from the reference implementation"
+    print(f"{'speedup':>12}: {reference_time / streaming_time:8.1f}x")
+
+
+#
+# Region metadata
+#
+
+def reference_inherit_options_from_db_source(source: metadata.Source) -> metadata.Source:
+    # The previous implementation also changed the class of the copy,
+    # which is not possible between classes with different slots
+    return copy.deepcopy(source)
+
+
+def resolve_all(regions: list[metadata.Region],
+                inherit: Callable[[Any], metadata.Source]) -> int:
+    resolved = 0
+    for region in regions:
+        for source in region.sources:
+            if isinstance(source, (metadata.TransitlandSource,
+                                   metadata.MobilityDatabaseSource)):
+                inherit(source)
+                resolved += 1
+
+    return resolved
+
+
+def benchmark_metadata(arguments: argparse.Namespace):
+    contents = [json.loads(path.read_bytes())
+                for path in sorted(Path(arguments.feeds).glob("*.json"))]
+    print(f"{len(contents)} regions, {arguments.repeat} times:")
+
+    _, regions = measure("parsing", lambda: [
+        [metadata.Region(parsed) for parsed in contents]
+        for _ in range(arguments.repeat)][-1])
+
+    reference_time, expected = measure("deepcopy", lambda: [
+        resolve_all(regions, reference_inherit_options_from_db_source)
+        for _ in range(arguments.repeat)][-1])
+    copy_time, result = measure("copy", lambda: [
+        resolve_all(regions, metadata.inherit_options_from_db_source)
+        for _ in range(arguments.repeat)][-1])
+
+    assert result == expected
+    print(f"{'resolved':>12}: {result:8} sources per run")
+    print(f"{'speedup':>12}: {reference_time / copy_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Transitous import pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    validity = subparsers.add_parser("validity", help="Feed validity check in gtfs.py")
+    validity.add_argument("--rows", type=int, default=1_000_000, help="Number of calendar_dates rows")
+    validity.set_defaults(run=benchmark_validity)
+
+    quotes = subparsers.add_parser("fix-csv-quotes", help="Quote fixing in fix-csv-quotes.py")
+    quotes.add_argument("--rows", type=int, default=50_000, help="Number of stop_times rows")
+    quotes.add_argument("--long-field-length", type=int, default=2_000, help="Length of the long quoted fields")
+    quotes.set_defaults(run=benchmark_fix_csv_quotes)
+
+    regions = subparsers.add_parser("metadata", help="Parsing and resolving the sources of all regions")
+    regions.add_argument("--feeds", default="feeds/", help="Directory with the region files")
+    regions.add_argument("--repeat", type=int, default=10, help="Number of runs")
+    regions.set_defaults(run=benchmark_metadata)
+
+    arguments = parser.parse_args()
+    arguments.run(arguments)
@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Manifest of the datasets in out/ and how they changed in the last fetch
+# run. Later steps can use it to only act on the datasets that changed. The
+# manifest also serves as the state for the next run, so files are only
+# hashed again if their size or mtime changed.
+#
+
+from pathlib import Path
+from typing import Optional
+from datetime import datetime, timezone
+
+import hashlib
+import json
+import os
+
+import feedsummary
+
+DEFAULT_MANIFEST_PATH = Path("out/dataset-changes.json")
+# Increase when the format changes
+MANIFEST_VERSION = 1
+
+
+class DatasetState:
+    path: str
+    # Region metadata file the dataset belongs to
+    region: str
+    size: int
+    mtime_ns: int
+    sha256: str
+
+    def __init__(self, path: str, region: str, size: int, mtime_ns: int,
+                 sha256: str):
+        self.path = path
+        self.region = region
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+    @staticmethod
+    def from_json(parsed: dict) -> "DatasetState":
+        return DatasetState(parsed["path"], parsed["region"], parsed["size"],
+                            parsed["mtime-ns"], parsed["sha256"])
+
+    def to_json(self) -> dict:
+        return {
+            "path": self.path,
+            "region": self.region,
+            "size": self.size,
+            "mtime-ns": self.mtime_ns,
+            "sha256": self.sha256
+        }
+
+
+def dataset_state(path: Path, region: Path,
+                  previous: Optional[DatasetState]) -> DatasetState:
+    """
+    Current state of the dataset at path. The hash is only computed if the
+    file changed since the previous state, and the feed summary has none.
+    """
+    stat = path.stat()
+    if previous and previous.size == stat.st_size \
+            and previous.mtime_ns == stat.st_mtime_ns:
+        sha256 = previous.sha256
+    else:
+        summary = feedsummary.load_summary(path)
+        if summary:
+            sha256 = summary["sha256"]
+        else:
+            with open(path, "rb") as f:
+                sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+
+    return DatasetState(path.name, str(region), stat.st_size,
+                        stat.st_mtime_ns, sha256)
+
+
+class ChangeManifest:
+    path: Path
+    # All known datasets, by name
+    datasets: dict[str, DatasetState]
+    added: list[str]
+    updated: list[str]
+    unchanged: list[str]
+    # Datasets that are gone, with their last known state
+    removed: dict[str, DatasetState]
+    generated_at: Optional[str] = None
+
+    def __init__(self, path: Path = DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self.datasets = {}
+        self.added = []
+        self.updated = []
+        self.unchanged = []
+        self.removed = {}
+
+        try:
+            with open(path, "r") as f:
+                parsed = json.load(f)
+            if parsed.get("version") == MANIFEST_VERSION:
+                self.datasets = {name: DatasetState.from_json(dataset)
+                                 for name, dataset in parsed["datasets"].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def update(self, produced: dict[str, tuple[Path, Path]],
+               regions: set[Path], failed_regions: set[Path]):
+        """
+        Records the outcome of a fetch run.
+
+        produced maps the name of each dataset the run produced to its file
+        and region metadata file. regions are all region files the run
+        covered. Datasets of regions that had errors are kept, as their old
+        files are still used.
+        """
+        previous = self.datasets
+        self.datasets = {}
+        self.added = []
+        self.updated = []
+        self.unchanged = []
+        self.removed = {}
+
+        for name, (path, region) in sorted(produced.items()):
+            if not path.exists():
+                continue
+
+            state = dataset_state(path, region, previous.get(name))
+            self.datasets[name] = state
+            if name not in previous:
+                self.added.append(name)
+            elif previous[name].sha256 != state.sha256:
+                self.updated.append(name)
+            else:
+                self.unchanged.append(name)
+
+        for name, state in sorted(previous.items()):
+            if name in self.datasets:
+                continue
+
+            region = Path(state.region)
+            if region.exists() and (region not in regions
+                                    or region in failed_regions):
+                # Not part of this run
+                self.datasets[name] = state
+            else:
+                self.removed[name] = state
+
+        self.generated_at = datetime.now(tz=timezone.utc).isoformat()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = self.path.parent / f".tmp-{self.path.name}"
+        with open(tmppath, "w") as f:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "generated-at": self.generated_at,
+                "added": self.added,
+                "updated": self.updated,
+                "unchanged": self.unchanged,
+                "removed": {name: state.to_json()
+                            for name, state in self.removed.items()},
+                "datasets": {name: state.to_json()
+                             for name, state in self.datasets.items()}
+            }, f, indent=4)
+        os.replace(tmppath, self.path)
+
+    def print_summary(self):
+        print(f"Datasets: {len(self.added)} added, {len(self.updated)} updated, "
+              f"{len(self.unchanged)} unchanged, {len(self.removed)} removed")
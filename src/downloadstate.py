@@ -0,0 +1,84 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Per-source sidecar files in downloads/, which remember what the server told
+# us about the last download, so the next fetch can be a cheap conditional
+# request.
+#
+
+from pathlib import Path
+from typing import Optional
+from datetime import datetime, timezone
+
+import json
+import os
+
+
+class DownloadState:
+    path: Path
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_length: Optional[int] = None
+    sha256: Optional[str] = None
+    # One of skipped, not-modified, unchanged, updated, failed
+    outcome: Optional[str] = None
+    fetched_at: Optional[str] = None
+    # Whether the server answered a conditional GET with 304 before
+    conditional_get: bool = False
+    # Whether the server answered range requests to probe its ZIP file,
+    # None if it wasn't tried yet
+    ranges_supported: Optional[bool] = None
+
+    def __init__(self, path: Path, parsed: Optional[dict] = None):
+        self.path = path
+        if parsed:
+            self.etag = parsed.get("etag")
+            self.last_modified = parsed.get("last-modified")
+            self.content_length = parsed.get("content-length")
+            self.sha256 = parsed.get("sha256")
+            self.outcome = parsed.get("outcome")
+            self.fetched_at = parsed.get("fetched-at")
+            self.conditional_get = bool(parsed.get("conditional-get", False))
+            self.ranges_supported = parsed.get("ranges-supported")
+
+    @staticmethod
+    def for_download(dest_path: Path) -> "DownloadState":
+        """
+        Loads the state belonging to the download at dest_path.
+        The state is only trusted while the downloaded file still exists.
+        """
+        path = state_path_for(dest_path)
+        if not dest_path.exists() or not path.exists():
+            return DownloadState(path)
+
+        try:
+            with open(path, "r") as f:
+                return DownloadState(path, json.load(f))
+        except (OSError, ValueError):
+            return DownloadState(path)
+
+    def record(self, outcome: str):
+        self.outcome = outcome
+        self.fetched_at = datetime.now(tz=timezone.utc).isoformat()
+
+    def save(self):
+        tmppath = self.path.parent / f".tmp-{self.path.name}"
+        with open(tmppath, "w") as f:
+            json.dump({
+                "etag": self.etag,
+                "last-modified": self.last_modified,
+                "content-length": self.content_length,
+                "sha256": self.sha256,
+                "outcome": self.outcome,
+                "fetched-at": self.fetched_at,
+                "conditional-get": self.conditional_get,
+                "ranges-supported": self.ranges_supported,
+            }, f, indent=4)
+        os.replace(tmppath, self.path)
+
+
+def state_path_for(dest_path: Path) -> Path:
+    # downloads/{region}_{name}.{spec}.zip -> downloads/{region}_{name}.state.json
+    return dest_path.parent / f"{dest_path.name.rsplit('.', 2)[0]}.state.json"
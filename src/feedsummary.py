@@ -0,0 +1,161 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Summaries of postprocessed feeds, written next to each GTFS file in out/.
+# They contain everything later steps need to know about a feed, so that
+# they don't need to unzip and parse it again.
+#
+
+from pathlib import Path
+from typing import Optional
+from zipfile import ZipFile
+from gtfs import FeedTimeframe, FeedValidity, get_feed_timezone, \
+    scan_feed_timeframe, parse_gtfs_csv, today_in
+
+import hashlib
+import io
+import json
+import os
+
+# Increase when the format changes, to invalidate existing summaries
+SUMMARY_VERSION = 1
+
+
+def summary_path_for(feed_path: Path) -> Path:
+    # out/{region}_{name}.gtfs.zip -> out/{region}_{name}.gtfs.summary.json
+    return feed_path.parent / \
+        f"{feed_path.name.removesuffix('.zip')}.summary.json"
+
+
+def read_rows(zip_file: ZipFile, name: str) -> Optional[list[dict]]:
+    if name not in zip_file.namelist():
+        return None
+
+    with zip_file.open(name, "r") as f:
+        with io.TextIOWrapper(f, encoding="utf-8-sig") as text:
+            return list(parse_gtfs_csv(text))
+
+
+def count_rows(zip_file: ZipFile, name: str) -> int:
+    """
+    Number of lines after the header. Quoted line breaks are counted too,
+    which is good enough for statistics.
+    """
+    lines = 0
+    last = b"\n"
+    with zip_file.open(name, "r") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+
+    if last != b"\n":
+        lines += 1
+
+    return max(lines - 1, 0)
+
+
+def summarize_feed(feed_path: Path) -> dict:
+    with ZipFile(feed_path) as z:
+        timeframe = scan_feed_timeframe(z)
+
+        publisher = None
+        feed_info = read_rows(z, "feed_info.txt")
+        if feed_info and "feed_publisher_name" in feed_info[0] \
+                and "feed_publisher_url" in feed_info[0]:
+            publisher = {
+                "name": feed_info[0]["feed_publisher_name"],
+                "url": feed_info[0]["feed_publisher_url"],
+                "email": feed_info[0].get("feed_contact_email"),
+                "contact_url": feed_info[0].get("feed_contact_url")
+            }
+
+        agencies = [{
+            "agency_id": agency.get("agency_id"),
+            "name": agency.get("agency_name"),
+            "url": agency.get("agency_url"),
+            "email": agency.get("agency_email")
+        } for agency in read_rows(z, "agency.txt") or []]
+
+        attributions = read_rows(z, "attributions.txt")
+
+        return {
+            "timezone": get_feed_timezone(z),
+            "service_start": timeframe.service_start,
+            "service_end": timeframe.service_end,
+            "timeframe": timeframe.to_json(),
+            "publisher": publisher,
+            "agencies": agencies,
+            "attributions": None if attributions is None else [{
+                "name": attribution.get("organization_name"),
+                "url": attribution.get("attribution_url"),
+                "email": attribution.get("attribution_email")
+            } for attribution in attributions],
+            "row_counts": {
+                info.filename: count_rows(z, info.filename)
+                for info in z.infolist() if info.filename.endswith(".txt")
+            }
+        }
+
+
+def validity(summary: dict) -> FeedValidity:
+    today = today_in(summary["timezone"])
+    return FeedTimeframe.from_json(summary["timeframe"]).validity(today)
+
+
+def write_summary(feed_path: Path, summary: dict,
+                  path: Optional[Path] = None):
+    """
+    Writes the summary of the feed at feed_path, by default next to it.
+    The summary is keyed by the hash of the feed, and by its size and mtime
+    for a cheap staleness check.
+    """
+    with open(feed_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+    stat = feed_path.stat()
+    summary = summary | {
+        "version": SUMMARY_VERSION,
+        "sha256": digest,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns
+    }
+
+    path = path or summary_path_for(feed_path)
+    tmppath = path.parent / f".tmp-{path.name}"
+    with open(tmppath, "w") as f:
+        json.dump(summary, f, indent=4, ensure_ascii=False)
+    os.replace(tmppath, path)
+
+
+def load_summary(feed_path: Path,
+                 path: Optional[Path] = None) -> Optional[dict]:
+    """
+    Returns the summary of the feed at feed_path, or None if there is none
+    or it belongs to a different version of the file.
+    """
+    path = path or summary_path_for(feed_path)
+    try:
+        with open(path, "r") as f:
+            summary = json.load(f)
+        stat = feed_path.stat()
+    except (OSError, ValueError):
+        return None
+
+    if summary.get("version") != SUMMARY_VERSION \
+            or summary.get("size") != stat.st_size \
+            or summary.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+
+    return summary
+
+
+def load_or_create_summary(feed_path: Path,
+                           path: Optional[Path] = None) -> dict:
+    summary = load_summary(feed_path, path)
+    if summary is None:
+        summary = summarize_feed(feed_path)
+        write_summary(feed_path, summary, path)
+
+    return summary
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Reports from the fetch history that fetch.py records, to find the feeds
+# that take the longest, transfer the most data or change most often.
+#
+
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from utils import eprint
+from fetchhistory import FetchHistory, PHASES, phase_column, \
+    DEFAULT_HISTORY_PATH
+
+import argparse
+import sys
+
+MiB = 1024 * 1024
+
+TOTAL_DURATION = " + ".join(f"coalesce({phase_column(phase)}, 0)"
+                            for phase in PHASES)
+
+
+def recent(days: int) -> str:
+    return (datetime.now(tz=timezone.utc) - timedelta(days=days)).isoformat()
+
+
+def report_slowest(history: FetchHistory, arguments: argparse.Namespace):
+    rows = history.query(f"""
+        SELECT job_id, count(*), avg({TOTAL_DURATION}),
+            {", ".join(f"avg({phase_column(phase)})" for phase in PHASES)}
+        FROM fetches JOIN runs ON runs.id = fetches.run_id
+        WHERE runs.started_at >= ?
+        GROUP BY job_id ORDER BY avg({TOTAL_DURATION}) DESC LIMIT ?""",
+                          (recent(arguments.days), arguments.limit))
+
+    print(f"{'feed':40} {'runs':>5} {'total':>8} "
+          + " ".join(f"{phase:>14}" for phase in PHASES))
+    for job_id, runs, total, *phases in rows:
+        print(f"{job_id:40} {runs:5} {total:7.1f}s "
+              + " ".join(f"{duration:13.1f}s" if duration is not None
+                         else f"{'-':>14}" for duration in phases))
+
+
+def report_biggest(history: FetchHistory, arguments: argparse.Namespace):
+    rows = history.query("""
+        SELECT job_id, count(*), max(output_size),
+            avg(bytes_transferred), sum(bytes_transferred)
+        FROM fetches JOIN runs ON runs.id = fetches.run_id
+        WHERE runs.started_at >= ?
+        GROUP BY job_id ORDER BY max(output_size) DESC LIMIT ?""",
+                          (recent(arguments.days), arguments.limit))
+
+    print(f"{'feed':40} {'runs':>5} {'size':>10} {'transferred/run':>16} {'transferred':>12}")
+    for job_id, runs, size, transferred_avg, transferred_sum in rows:
+        size_text = f"{size / MiB:.1f} MiB" if size is not None else "-"
+        print(f"{job_id:40} {runs:5} {size_text:>10} "
+              f"{transferred_avg / MiB:12.1f} MiB {transferred_sum / MiB:8.1f} MiB")
+
+
+def report_changes(history: FetchHistory, arguments: argparse.Namespace):
+    since = recent(arguments.days)
+    order = "ASC" if arguments.least else "DESC"
+    rows = history.query(f"""
+        SELECT job_id, count(*),
+            sum(outcome = 'updated'),
+            sum(outcome IN ('not-modified', 'unchanged')),
+            sum(outcome = 'failed'),
+            avg(outcome = 'updated')
+        FROM fetches JOIN runs ON runs.id = fetches.run_id
+        WHERE runs.started_at >= ? AND outcome IS NOT NULL
+            AND outcome != 'skipped'
+        GROUP BY job_id ORDER BY avg(outcome = 'updated') {order}, job_id
+        LIMIT ?""", (since, arguments.limit))
+
+    print(f"{'feed':40} {'runs':>5} {'updated':>8} {'unchanged':>10} {'failed':>7} {'changes':>8}")
+    for job_id, runs, updated, unchanged, failed, frequency in rows:
+        print(f"{job_id:40} {runs:5} {updated:8} {unchanged:10} {failed:7} "
+              f"{frequency:7.0%}")
+
+    # Runs in which at least one feed changed needed a new import
+    runs, changed = history.query("""
+        SELECT count(*), sum(changed) FROM (
+            SELECT max(outcome = 'updated') AS changed
+            FROM fetches JOIN runs ON runs.id = fetches.run_id
+            WHERE runs.started_at >= ?
+            GROUP BY run_id)""", (since,))[0]
+    if runs:
+        print(f"\n{changed} of {runs} runs changed at least one feed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports from the history of feed fetches.")
+    parser.add_argument("--history", type=Path, default=DEFAULT_HISTORY_PATH, help="Fetch history database")
+    parser.add_argument("--days", type=int, default=30, help="Only consider runs of the last days")
+    parser.add_argument("--limit", type=int, default=20, help="Number of feeds to list")
+    subparsers = parser.add_subparsers(dest="report", required=True)
+
+    slowest = subparsers.add_parser("slowest", help="Feeds that take the longest to fetch and postprocess")
+    slowest.set_defaults(run=report_slowest)
+
+    biggest = subparsers.add_parser("biggest", help="Largest feeds and the data transferred for them")
+    biggest.set_defaults(run=report_biggest)
+
+    changes = subparsers.add_parser("changes", help="How often feeds change")
+    changes.add_argument("--least", action="store_true", help="List the feeds that change least often first")
+    changes.set_defaults(run=report_changes)
+
+    arguments = parser.parse_args()
+
+    if not arguments.history.exists():
+        eprint(f"Error: No fetch history at {arguments.history}")
+        sys.exit(1)
+
+    history = FetchHistory(arguments.history)
+    try:
+        arguments.run(history, arguments)
+    finally:
+        history.close()
@@ -4,44 +4,47 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from metadata import TransitlandSource, MobilityDatabaseSource, HttpSource, \
-    FtpSource, UrlSource, Source, Region
+    FtpSource, UrlSource, Source
 from pathlib import Path
 from datetime import datetime, timezone
-from utils import eprint, decrypt_if_necessary
+from utils import eprint, decrypt_if_necessary, prefetch_secrets
 from zipfile import ZipFile
-from typing import Optional, Any, Iterable, IO
-from zoneinfo import ZoneInfo
-from enum import Enum
+from typing import Optional, Any, Iterable, IO, Mapping
 from license_expression import get_spdx_licensing, Licensing, ExpressionError
-from urllib3.util import create_urllib3_context
-from urllib3 import PoolManager
-from requests.adapters import HTTPAdapter
-from requests import Session
+from sessions import SessionRegistry
+from gtfs import FeedValidity
+from downloadstate import DownloadState
+from postprocesspool import PostprocessPool, MiB
+from metadatacache import MetadataCache, CompiledRegion
+from changemanifest import ChangeManifest
+from fetchhistory import FetchRecord
 
 import argparse
+import concurrent.futures
 import email.utils
 import requests
-import transitland
-import mobilitydatabase
-import json
 import sys
 import os
 import subprocess
-import shutil
 import region_helpers
-import io
+import feedsummary
+import staging
+import zipprobe
+import fetchhistory
+import postprocesscache
+import joblog
+import itertools
 import hashlib
-import csv
 import ftplib
+import random
 import urllib
 import time
-import ssl
+import threading
+import sqlite3
+
+# Shared between all downloads of this process
+http_sessions = SessionRegistry()
 
-class LenientCipherAdapter(HTTPAdapter):
-    def init_poolmanager(self, *args, **kwargs):
-        context = create_urllib3_context(ciphers="ALL:@SECLEVEL=1", cert_reqs=ssl.CERT_NONE)
-        kwargs['ssl_context'] = context
-        return super(LenientCipherAdapter, self).init_poolmanager(*args, **kwargs)
 
 def validate_source_name(name: str):
     if " " in name:
@@ -65,143 +68,159 @@ def validate_spdx_identifier(licensing: Licensing, spdx_identifier: str):
         sys.exit(1)
 
 
-def parse_gtfs_csv(f: IO) -> csv.DictReader:
-    header = list(map(lambda h: h.strip(), next(csv.reader(f))))
-    return csv.DictReader(f, delimiter=",",
-                          quotechar='"', fieldnames=header)
+CHUNK_SIZE = 1024 * 1024
 
 
-def get_feed_timezone(zip_file: ZipFile) -> Optional[str]:
-    if "agency.txt" not in zip_file.namelist():
-        return None
+def copy_hashing(source: Iterable[bytes], dest: IO[bytes]) -> str:
+    """
+    Writes the chunks of source to dest and returns their SHA-256 hex digest.
+    """
+    h = hashlib.new("sha256")
+    for chunk in source:
+        h.update(chunk)
+        dest.write(chunk)
 
-    with zip_file.open("agency.txt", "r") as a:
-        with io.TextIOWrapper(a) as at:
-            feedinforeader = parse_gtfs_csv(at)
-            for row in feedinforeader:
-                if "agency_timezone" in row \
-                        and row["agency_timezone"]:
-                    return row["agency_timezone"].strip()
+    return h.hexdigest()
 
-    return None
 
+def read_chunks(f: IO[bytes]) -> Iterable[bytes]:
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
 
-class FeedValidity(Enum):
-    EXPIRED = 1
-    IN_FUTURE = 2
-    CURRENTLY_VALID = 3
 
+def temp_path_for(path: Path) -> Path:
+    return path.parent / f".tmp-{path.name}"
 
-def parse_gtfs_date(date: str, feed_timezone: ZoneInfo) -> datetime:
-    return datetime.strptime(date.strip(), "%Y%m%d") \
-        .replace(tzinfo=feed_timezone)
 
+class Download:
+    """
+    A finished download, stored in a temporary file next to its destination.
+    """
+    path: Path
+    sha256: str
+    headers: Mapping[str, str]
 
-def check_feed_already_valid(feed_info: Iterable[dict],
-                             feed_timezone: ZoneInfo) -> bool:
-    if not feed_info:
-        return True
+    def __init__(self, path: Path, sha256: str, headers: Mapping[str, str]):
+        self.path = path
+        self.sha256 = sha256
+        self.headers = headers
 
-    today = datetime.now(tz=feed_timezone)
-    valid_entries = map(
-        lambda row: "feed_start_date" not in row or
-        not row["feed_start_date"] or
-        parse_gtfs_date(row["feed_start_date"], feed_timezone) <= today,
-        feed_info)
-    return any(valid_entries)
-
-
-def check_feed_not_expired(feed_info: Iterable[dict],
-                           calendar: Iterable[dict],
-                           calendar_dates: Iterable[dict],
-                           feed_timezone: ZoneInfo):
-    today = datetime.now(tz=feed_timezone)
-
-    def feed_info_latest():
-        date_rows = filter(lambda row: "feed_end_date" in row and row["feed_end_date"], feed_info)
-        valid_entries = list(map(lambda row: parse_gtfs_date(row["feed_end_date"], feed_timezone), date_rows))
-        if valid_entries:
-            return max(valid_entries)
-        else:
-            return None
-
-    def calendar_latest():
-        valid_entries = list(map(
-            lambda row:
-                parse_gtfs_date(row["end_date"], feed_timezone),
-            calendar))
-        if valid_entries:
-            return max(valid_entries)
-        else:
-            return None
-
-    def calendar_dates_latest():
-        valid_entries = list(map(
-            lambda row:
-                parse_gtfs_date(row["date"], feed_timezone),
-            calendar_dates))
-        if valid_entries:
-            return max(valid_entries)
-        else:
-            return None
+    def discard(self):
+        self.path.unlink(missing_ok=True)
 
-    feed_info_end = feed_info_latest()
-    calendar_end = calendar_latest()
-    calendar_dates_end = calendar_dates_latest()
 
-    if feed_info_end:
-        return feed_info_end >= today
-    else:
-        return calendar_end and calendar_end >= today or \
-            calendar_dates_end and calendar_dates_end >= today
+# Server responses that are worth retrying after a while
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
 
-def check_feed_timeframe_valid(zip_file: ZipFile) -> FeedValidity:
-    def read_file(name: str) -> Iterable[dict]:
-        if name not in zip_file.namelist():
-            return []
+class TransientHttpError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP Status code: {status_code}")
 
-        a = zip_file.open(name, "r")
-        at = io.TextIOWrapper(a)
-        return parse_gtfs_csv(at)
 
-    feed_info = read_file("feed_info.txt")
-    calendar = read_file("calendar.txt")
-    calendar_dates = read_file("calendar_dates.txt")
+class HttpStatusError(Exception):
+    status_code: int
 
-    tz = get_feed_timezone(zip_file)
+    def __init__(self, status_code: int):
+        super().__init__(f"Could not fetch file. HTTP Status code: {status_code}")
+        self.status_code = status_code
 
-    if not tz:
-        raise Exception("Could not check validity, because the time zone could not be detected")
 
-    feed_timezone = ZoneInfo(tz)
+class DownloadError(Exception):
+    """
+    None of the URLs of a source could be downloaded.
+    """
+    # The error of each URL, by the name of the URL
+    errors: list[tuple[str, Exception]]
 
-    if not check_feed_already_valid(feed_info, feed_timezone):
-        return FeedValidity.IN_FUTURE
+    def __init__(self, errors: list[tuple[str, Exception]]):
+        super().__init__(errors)
+        self.errors = errors
 
-    if not check_feed_not_expired(feed_info, calendar, calendar_dates,
-                                  feed_timezone):
-        return FeedValidity.EXPIRED
 
-    return FeedValidity.CURRENTLY_VALID
+def credentials_rejected(error: Exception) -> bool:
+    return isinstance(error, DownloadError) and any(
+        isinstance(e, HttpStatusError) and e.status_code in (401, 403)
+        for _, e in error.errors)
 
 
-def download_http_source(
-    dest_path: Path, source: HttpSource,
-        session=requests.Session()) -> Optional[requests.Response]:
+class PartialDownload:
     """
-    Performs the download of the source and returns the response.
-    The urls will be tried in the following order: url_override, url, cache_url
+    The part of a download that was already written to disk. If the server
+    supports range requests, an interrupted download can be continued from
+    here instead of starting over.
     """
-    request_options: dict[str, Any] = {
-        "verify": not source.options.ignore_tls_errors,
-        "timeout": 30
-    }
-    if source.options.ignore_tls_errors:
-        session.mount("https://", LenientCipherAdapter())
-    else:
-        session.mount("https://", HTTPAdapter())
+    path: Path
+    size: int = 0
+    # Bytes received, including parts that were thrown away
+    transferred: int = 0
+    resumable: bool = False
+    # Strong ETag or Last-Modified of the response, to make sure the rest
+    # belongs to the same file
+    validator: Optional[str] = None
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.hash = hashlib.new("sha256")
+
+    def can_resume(self) -> bool:
+        return self.resumable and self.size > 0
+
+    def resume_headers(self) -> dict[str, str]:
+        """
+        Headers for requesting the download, or the rest of it.
+        """
+        # Byte ranges refer to the encoded body, but the size is counted in
+        # decoded bytes, so only ask for unencoded responses
+        headers = {"accept-encoding": "identity"}
+        if not self.can_resume():
+            return headers
+
+        headers["range"] = f"bytes={self.size}-"
+        if self.validator:
+            headers["if-range"] = self.validator
+        return headers
+
+    def open_for(self, status_code: int,
+                 headers: Mapping[str, str]) -> IO[bytes]:
+        """
+        Opens the file for the body of a response, either to append to the
+        previous part or to start over.
+        """
+        content_range = headers.get("content-range", "")
+        if status_code == 206 and self.can_resume() \
+                and content_range.startswith(f"bytes {self.size}-"):
+            return open(self.path, "ab")
+        elif status_code == 200:
+            # Start over, the server sent the whole file
+            self.size = 0
+            self.hash = hashlib.new("sha256")
+            # Servers may encode the body anyway, then the ranges don't
+            # match what was written
+            self.resumable = \
+                headers.get("accept-ranges", "").lower() == "bytes" \
+                and headers.get("content-encoding", "identity").lower() \
+                == "identity"
+            etag = headers.get("etag")
+            self.validator = etag if etag and not etag.startswith("W/") \
+                else headers.get("last-modified")
+            return open(self.path, "wb")
+        else:
+            # If the file was not successfully retrieved, throw
+            raise HttpStatusError(status_code)
+
+    def write(self, f: IO[bytes], chunk: bytes):
+        self.hash.update(chunk)
+        f.write(chunk)
+        self.size += len(chunk)
+        self.transferred += len(chunk)
+
+    def receive(self, response: requests.Response):
+        with self.open_for(response.status_code, response.headers) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                self.write(f, chunk)
 
+
+def request_headers(source: HttpSource) -> dict[str, str]:
     headers = {}
     for key, value in source.options.headers.items():
         headers[key] = decrypt_if_necessary(value)
@@ -209,19 +228,31 @@ def download_http_source(
         headers["user-agent"] \
             = "Transitous GTFS Fetcher (https://transitous.org)"
 
-    # Detect last modification time of local file
-    last_modified = None
-    if dest_path.exists():
-        mtime = dest_path.stat().st_mtime
-        last_modified = datetime.fromtimestamp(mtime,
-                                               tz=timezone.utc)
-
-    # Check if the last download was longer than the interval ago
-    if source.options.fetch_interval_days and last_modified \
-            and (datetime.now(tz=timezone.utc) - last_modified).days \
-            < source.options.fetch_interval_days:
+    return headers
+
+
+def local_last_modified(dest_path: Path) -> Optional[datetime]:
+    """
+    Detect last modification time of local file
+    """
+    if not dest_path.exists():
         return None
 
+    mtime = dest_path.stat().st_mtime
+    return datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+
+def fetch_interval_pending(source: HttpSource,
+                           last_modified: Optional[datetime]) -> bool:
+    """
+    Check if the last download was less than the fetch interval ago
+    """
+    return bool(source.options.fetch_interval_days and last_modified
+                and (datetime.now(tz=timezone.utc) - last_modified).days
+                < source.options.fetch_interval_days)
+
+
+def download_urls(source: HttpSource) -> list[tuple[str, str]]:
     urls_to_try: list[tuple[str, str]] = []
     # tuple unpacking needed to appease mypy
     for name, url in [
@@ -232,83 +263,288 @@ def download_http_source(
         if url:
             urls_to_try.append((name, decrypt_if_necessary(url)))
 
+    return urls_to_try
+
+
+def server_is_older(server_headers: Mapping[str, str],
+                    last_modified: Optional[datetime]) -> bool:
+    """
+    Whether the Last-Modified header of a HEAD response shows that the
+    local file is still current
+    """
+    if "last-modified" not in server_headers or not last_modified:
+        return False
+
+    last_modified_server = email.utils.parsedate_to_datetime(
+        server_headers["last-modified"])
+    return last_modified_server <= last_modified
+
+
+def conditional_headers(state: DownloadState,
+                        last_modified: Optional[datetime]) -> dict[str, str]:
+    """
+    Tell the server not to send data if it is older than what we have
+    """
+    headers = {}
+    if state.last_modified:
+        headers["if-modified-since"] = state.last_modified
+    elif last_modified:
+        headers["if-modified-since"] = last_modified \
+            .strftime("%a, %d %b %Y %X %Z")
+    if state.etag:
+        headers["if-none-match"] = state.etag
+
+    return headers
+
+
+def retry_delay(source: HttpSource, attempt: int) -> float:
+    """
+    Exponential backoff with jitter
+    """
+    return source.options.retry_backoff * 2 ** attempt \
+        * random.uniform(0.5, 1.5)
+
+
+def probe_unchanged(dest_path: Path, source: HttpSource,
+                    state: DownloadState,
+                    sessions: SessionRegistry = http_sessions,
+                    record: Optional[FetchRecord] = None) -> bool:
+    """
+    For servers that send neither ETag nor Last-Modified, checks with range
+    requests whether the remote ZIP file has the same members as the local
+    copy, without downloading it.
+    """
+    url = decrypt_if_necessary(source.url_override or source.url)
+    if state.etag or state.last_modified or state.ranges_supported is False \
+            or source.options.method or "#" in url or not dest_path.exists() \
+            or fetch_interval_pending(source, local_last_modified(dest_path)):
+        return False
+
+    local = zipprobe.local_members(dest_path)
+    if local is None:
+        return False
+
+    request_options: dict[str, Any] = {
+        "verify": not source.options.ignore_tls_errors,
+        "timeout": source.options.timeout
+    }
+
+    record = record or FetchRecord()
+    try:
+        session = sessions.session(url, source.options.ignore_tls_errors)
+        with sessions.host_slot(url), record.phase("probe"):
+            unchanged, transferred = zipprobe.remote_matches(
+                session, url, request_headers(source), request_options, local)
+            record.bytes_transferred += transferred
+    except zipprobe.RangesNotSupported:
+        state.ranges_supported = False
+        return False
+    except (zipprobe.ProbeError, requests.exceptions.RequestException) as e:
+        eprint(f"Warning: Probing {url} failed ({e}), downloading instead")
+        return False
+
+    state.ranges_supported = True
+    if unchanged:
+        print(f"Probed {url}: unchanged ({transferred // 1024} KiB transferred)")
+        state.record("unchanged")
+
+    return unchanged
+
+
+def download_http_source(
+    dest_path: Path, source: HttpSource,
+        sessions: SessionRegistry = http_sessions,
+        state: Optional[DownloadState] = None,
+        record: Optional[FetchRecord] = None) -> Optional[Download]:
+    """
+    Performs the download of the source into a temporary file next to
+    dest_path, without holding the feed in memory.
+    The urls will be tried in the following order: url_override, url, cache_url
+
+    If a download state is given, its validators are used for conditional
+    requests, and its outcome is updated if nothing needed to be downloaded.
+    Timings and transferred bytes are added to record.
+    """
+    if not state:
+        state = DownloadState.for_download(dest_path)
+    record = record or FetchRecord()
+
+    request_options: dict[str, Any] = {
+        "verify": not source.options.ignore_tls_errors,
+        "timeout": source.options.timeout
+    }
+
+    headers = request_headers(source)
+    last_modified = local_last_modified(dest_path)
+
+    if fetch_interval_pending(source, last_modified):
+        state.record("skipped")
+        return None
+
+    urls_to_try = download_urls(source)
     primary_url_name, primary_url = urls_to_try[0]
+    temp_path = temp_path_for(dest_path)
 
     errors = []
     while urls_to_try:
         name, url = urls_to_try.pop(0)
+        partial = PartialDownload(temp_path)
         try:
-            if not source.options.method:
-                # Fetch last modification time from the server
-                server_headers = \
-                    session.head(url, headers=headers,
-                                allow_redirects=True,
-                                **request_options).headers
-
-                # If server version is older, return
-                last_modified_server = None
-                if "last-modified" in server_headers:
-                    last_modified_server = email.utils.parsedate_to_datetime(
-                        server_headers["last-modified"])
-
-                    if last_modified and last_modified_server <= last_modified:
-                        return None
-
-            # Tell the server not to send data if it is older
-            # than what we have
-            if last_modified:
-                headers["if-modified-since"] = last_modified \
-                    .strftime("%a, %d %b %Y %X %Z")
-
-            req = requests.Request(source.options.method or "GET", url, data=source.options.request_body, headers=headers).prepare()
-            response = session.send(req, **request_options)
-
-            # If the file was not modified, return
-            if response.status_code == 304:
-                return None
-
-            # If the file was not successfully retrieved, throw
-            if response.status_code != 200:
-                raise Exception(f"Could not fetch file. HTTP Status code: {response.status_code}")
+            session = sessions.session(url, source.options.ignore_tls_errors)
+            for attempt in itertools.count():
+                try:
+                    with sessions.host_slot(url):
+                        # Servers that answered conditional requests before don't
+                        # need the additional HEAD request
+                        if not source.options.method and not state.conditional_get \
+                                and not partial.size:
+                            # Fetch last modification time from the server
+                            with record.phase("head"):
+                                server_headers = \
+                                    session.head(url, headers=headers,
+                                                allow_redirects=True,
+                                                **request_options).headers
+
+                            # If server version is older, return
+                            if server_is_older(server_headers, last_modified):
+                                state.record("not-modified")
+                                return None
+
+                        req = requests.Request(source.options.method or "GET", url, data=source.options.request_body, headers=headers | conditional_headers(state, last_modified) | partial.resume_headers()).prepare()
+                        with record.phase("get"), \
+                                session.send(req, stream=True, **request_options) as response:
+                            record.http_status = response.status_code
+
+                            # If the file was not modified, return
+                            if response.status_code == 304:
+                                state.conditional_get = True
+                                state.record("not-modified")
+                                return None
+
+                            if response.status_code in RETRY_STATUS_CODES:
+                                raise TransientHttpError(response.status_code)
+
+                            partial.receive(response)
+
+                    break
+                except (TransientHttpError, requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    if attempt >= source.options.retries:
+                        raise
+
+                    delay = retry_delay(source, attempt)
+                    resume_note = f", resuming at {partial.size} bytes" \
+                        if partial.can_resume() else ""
+                    eprint(f"Warning: Fetching {url} failed ({e}), retrying in {delay:.1f}s{resume_note}")
+                    time.sleep(delay)
 
             # Try if response was zip
             # (some servers return html error page with code 200)
-            ZipFile(io.BytesIO(response.content))
+            ZipFile(temp_path).close()
 
             # all errors checked, it worked
             if name != primary_url_name:
                 eprint(f"Warning: Used {name} instead of {primary_url_name} ({primary_url}) because it was not reachable")
 
-            return response
+            return Download(temp_path, partial.hash.hexdigest(), response.headers)
         except Exception as e:
+            temp_path.unlink(missing_ok=True)
             errors.append((name, e))
+        finally:
+            record.bytes_transferred += partial.transferred
 
-    raise Exception(errors)
+    raise DownloadError(errors)
+
+
+def gtfsclean_arguments(source: Source) -> list[str]:
+    """
+    Options passed to gtfsclean for source, besides the input and output file.
+    """
+    arguments = ["--fix-zip",
+                 "--check-null-coords",
+                 "--empty-agency-url-repl", "https://transitous.org"]
+    if source.fix:
+        arguments.append("--fix")
+    if source.drop_too_fast_trips:
+        arguments.append("--drop-too-fast-trips")
+    if source.drop_shapes:
+        arguments.append("--drop-shapes")
+    if source.drop_agency_names:
+        for agency in source.drop_agency_names:
+            arguments.append("--drop-agency-names")
+            arguments.append(agency)
+    if source.keep_agency_names:
+        for agency in source.keep_agency_names:
+            arguments.append("--keep-agency-names")
+            arguments.append(agency)
+    if source.display_name_options:
+        if source.display_name_options.copy_trip_names_matching:
+            arguments.append("--copy-trip-names-matching")
+            arguments.append(source.display_name_options.copy_trip_names_matching)
+        if source.display_name_options.keep_route_names_matching:
+            arguments.append("--keep-route-names-matching")
+            arguments.append(source.display_name_options.keep_route_names_matching)
+        if source.display_name_options.move_headsigns_matching:
+            arguments.append("--move-headsigns-matching")
+            arguments.append(source.display_name_options.move_headsigns_matching)
+    if source.keep_additional_fields:
+        arguments.append("--keep-additional-fields")
+
+    return arguments
+
+
+def run_tool(command: list[str]):
+    """
+    Runs a postprocessing tool. Its output is printed afterwards instead of
+    going to the terminal directly, so it ends up in the log of the job.
+    """
+    result = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True,
+                            errors="replace")
+    if result.stdout:
+        print(result.stdout, end="")
+    result.check_returncode()
+
+
+def input_digest(path: Path) -> str:
+    """
+    SHA-256 of a downloaded file. Taken from the download state if it
+    describes the file, otherwise the file is hashed.
+    """
+    state = DownloadState.for_download(path)
+    if state.sha256 and state.content_length == path.stat().st_size:
+        return state.sha256
+
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
 
 
 class Fetcher:
-    transitland_atlas: transitland.Atlas
     licensing: Licensing
 
     def __init__(self):
-        self.transitland_atlas = transitland.Atlas.load(
-            Path("transitland-atlas/"))
-        self.mobility_database = None
+        # The atlas and the database are only loaded once a source needs them
+        self.database_lock = threading.Lock()
         self.licensing = get_spdx_licensing()
+        self.postprocess_cache = postprocesscache.PostprocessCache()
+        self.metadata_cache = MetadataCache()
 
     def resolve_database_sources(self, source: Source) -> Source:
         match source:
             case TransitlandSource():
-                http_source = self.transitland_atlas.sources_by_id(source)
+                with self.database_lock:
+                    atlas = self.metadata_cache.atlas()
+                http_source = atlas.sources_by_id(source)
                 if not http_source:
                     eprint("Error: Could not resolve", source.transitland_atlas_id)
                     sys.exit(1)
 
                 return http_source[0]  # multi-source feeds only occur for GTFS-RT, which we don't handle here
             case MobilityDatabaseSource():
-                if not self.mobility_database:
-                    self.mobility_database = mobilitydatabase.Database.load()
-                http_source = self.mobility_database.source_by_id(source)
+                with self.database_lock:
+                    database = self.metadata_cache.mobility_database()
+                http_source = database.source_by_id(source)
                 if not http_source:
                     eprint("Error: Could not resolve", source.mdb_id)
                     sys.exit(1)
@@ -318,76 +554,121 @@ class Fetcher:
                 return source
 
 
-    # Returns whether something was downloaded
-    def fetch_source(self, dest_path: Path, source: Source) -> bool:
-        if source.spec != "gtfs" and source.spec != "gbfs" and source.spec != "netex":
-            return False
+    # Moves a finished download to dest_path, returns whether it changed
+    def store_download(self, dest_path: Path, source: HttpSource,
+                       download: Download, state: DownloadState) -> bool:
+        last_modified_server = None
 
-        match source:
-            case HttpSource():
-                response = download_http_source(dest_path, source)
+        # Update our last_modified_server information from the response
+        # of the actual download.
+        server_headers = download.headers
+        if "last-modified" in server_headers:
+            last_modified_server = email.utils.parsedate_to_datetime(
+                server_headers["last-modified"])
 
-                # No request was made
-                if not response:
-                    return False
-
-                last_modified_server = None
+        if "#" in source.url and source.url.partition("#")[2]:
+            # if URL contains #, treat the path after # as an embedded ZIP file
+            sub_path = source.url.partition("#")[2]
+            sub_download_path = temp_path_for(download.path)
+            try:
+                with ZipFile(download.path) as zipfile, \
+                        zipfile.open(sub_path) as member, \
+                        open(sub_download_path, "wb") as dest:
+                    digest = copy_hashing(read_chunks(member), dest)
+                os.replace(sub_download_path, download.path)
+            finally:
+                sub_download_path.unlink(missing_ok=True)
+
+            download.sha256 = digest
+
+        state.etag = server_headers.get("etag")
+        state.last_modified = server_headers.get("last-modified")
+
+        # Only write file if the new version changed. Helps to at least
+        # skip postprocessing with servers that don't send a
+        # last-modified header.
+        if dest_path.exists() and not last_modified_server:
+            old_digest = state.sha256
+            if not old_digest:
+                with open(dest_path, "rb") as tfp:
+                    old_digest = hashlib.file_digest(tfp, "sha256") \
+                        .hexdigest()
+
+            if download.sha256 == old_digest:
+                state.sha256 = old_digest
+                state.record("unchanged")
+                return False
 
-                # Update our last_modified_server information from the response
-                # of the actual download.
-                server_headers = response.headers
-                if "last-modified" in server_headers:
-                    last_modified_server = email.utils.parsedate_to_datetime(
-                        server_headers["last-modified"])
+        os.replace(download.path, dest_path)
 
-                content: bytes
-                if "#" in source.url and source.url.partition("#")[2]:
-                    # if URL contains #, treat the path after # as an embedded ZIP file
-                    sub_path = source.url.partition("#")[2]
-                    zipfile = ZipFile(io.BytesIO(response.content))
+        state.content_length = dest_path.stat().st_size
+        state.sha256 = download.sha256
+        state.record("updated")
 
-                    content = zipfile.read(sub_path)
-                else:
-                    content = response.content
+        # Set server mtime on local file
+        if last_modified_server:
+            atime_mtime = (last_modified_server.timestamp(),
+                           last_modified_server.timestamp())
+            os.utime(dest_path, atime_mtime)
 
-                # Only write file if the new version changed. Helps to at least
-                # skip postprocessing with servers that don't send a
-                # last-modified header.
-                if dest_path.exists() and not last_modified_server:
-                    h = hashlib.new("sha256")
-                    h.update(content)
-                    digest = h.hexdigest()
+        return True
 
-                    with open(dest_path, "rb") as tfp:
-                        new_digest = hashlib.file_digest(tfp, "sha256") \
-                            .hexdigest()
+    # Returns whether something was downloaded
+    def fetch_source(self, dest_path: Path, source: Source,
+                     record: Optional[FetchRecord] = None) -> bool:
+        if source.spec != "gtfs" and source.spec != "gbfs" and source.spec != "netex":
+            return False
 
-                    if digest == new_digest:
+        record = record or FetchRecord()
+        match source:
+            case HttpSource():
+                state = DownloadState.for_download(dest_path)
+                try:
+                    if probe_unchanged(dest_path, source, state,
+                                       record=record):
                         return False
 
-                with open(dest_path, "wb") as dest:
-                    dest.write(content)
+                    download = download_http_source(dest_path, source,
+                                                    state=state, record=record)
 
-                # Set server mtime on local file
-                if last_modified_server:
-                    atime_mtime = (last_modified_server.timestamp(),
-                                   last_modified_server.timestamp())
-                    os.utime(dest_path, atime_mtime)
+                    # No request was made
+                    if not download:
+                        return False
 
-                return True
+                    try:
+                        return self.store_download(dest_path, source,
+                                                   download, state)
+                    finally:
+                        download.discard()
+                except Exception:
+                    state.record("failed")
+                    raise
+                finally:
+                    state.save()
+                    record.outcome = state.outcome
             case FtpSource():
                 url = urllib.parse.urlsplit(source.url)
-                ftp = ftplib.FTP(url.hostname)
-                ftp.login()
+                record.outcome = "failed"
+                with record.phase("head"):
+                    ftp = ftplib.FTP(url.hostname)
+                    ftp.login()
 
-                # check if file modification time has changed
-                ftptime = ftp.voidcmd(f"MDTM {url.path}")[4:]
+                    # check if file modification time has changed
+                    ftptime = ftp.voidcmd(f"MDTM {url.path}")[4:]
                 mtime = time.mktime(time.strptime(ftptime, "%Y%m%d%H%M%S"))
                 if dest_path.exists() and dest_path.stat().st_mtime == mtime:
+                    record.outcome = "not-modified"
                     return False
 
-                ftp.retrbinary(f"RETR {url.path}", open(dest_path, 'wb').write)
+                # The old file may be hardlinked to the output, so replace it
+                # instead of overwriting it
+                temp_path = temp_path_for(dest_path)
+                with record.phase("get"), open(temp_path, 'wb') as f:
+                    ftp.retrbinary(f"RETR {url.path}", f.write)
+                os.replace(temp_path, dest_path)
                 os.utime(dest_path, (mtime, mtime))
+                record.bytes_transferred += dest_path.stat().st_size
+                record.outcome = "updated"
                 return True
 
             case UrlSource():
@@ -396,153 +677,409 @@ class Fetcher:
         eprint("Unknown data source", source, file=sys.stderr)
         assert False
 
+    def postprocess_key(self, source: Source, input_path: Path) -> str:
+        options = {
+            "spec": source.spec,
+            "fix-csv-quotes": source.fix_csv_quotes and source.spec == "gtfs",
+            "gtfsclean": gtfsclean_arguments(source)
+            if source.use_gtfsclean and source.spec == "gtfs" else None
+        }
+        return postprocesscache.postprocess_key(input_digest(input_path),
+                                                options)
+
     def postprocess(self, source: Source,
-                    input_path: Path, output_path: Path):
+                    input_path: Path, output_path: Path,
+                    record: Optional[FetchRecord] = None):
+        record = record or FetchRecord()
         temp_file = output_path.parent / f".tmp-{output_path.name}"
-        shutil.copyfile(input_path, temp_file)
-
-        if source.fix_csv_quotes and source.spec == "gtfs":
-            subprocess.check_call(["./src/fix-csv-quotes.py", temp_file])
-
-        if source.use_gtfsclean and source.spec == "gtfs":
-            command = ["gtfsclean", str(temp_file),
-                    "--fix-zip",
-                    "--check-null-coords",
-                    "--empty-agency-url-repl", "https://transitous.org",
-                    "--output", str(temp_file)]
-            if source.fix:
-                command.append("--fix")
-            if source.drop_too_fast_trips:
-                command.append("--drop-too-fast-trips")
-            if source.drop_shapes:
-                command.append("--drop-shapes")
-            if source.drop_agency_names:
-                for agency in source.drop_agency_names:
-                    command.append("--drop-agency-names")
-                    command.append(agency)
-            if source.keep_agency_names:
-                for agency in source.keep_agency_names:
-                    command.append("--keep-agency-names")
-                    command.append(agency)
-            if source.display_name_options:
-                if source.display_name_options.copy_trip_names_matching:
-                    command.append("--copy-trip-names-matching")
-                    command.append(source.display_name_options.copy_trip_names_matching)
-                if source.display_name_options.keep_route_names_matching:
-                    command.append("--keep-route-names-matching")
-                    command.append(source.display_name_options.keep_route_names_matching)
-                if source.display_name_options.move_headsigns_matching:
-                    command.append("--move-headsigns-matching")
-                    command.append(source.display_name_options.move_headsigns_matching)
-            if source.keep_additional_fields:
-                command.append("--keep-additional-fields")
-
-            subprocess.check_call(command)
+        key = self.postprocess_key(source, input_path)
+        cached = self.postprocess_cache.lookup(key, source.spec)
+        record.cache_hit = cached is not None
+
+        if cached:
+            eprint("Info: Input and options unchanged, using cached result")
+            staging.stage_file(cached, temp_file)
+        else:
+            staging.stage_file(input_path, temp_file)
 
+            if source.fix_csv_quotes and source.spec == "gtfs":
+                with record.phase("fix-csv-quotes"):
+                    run_tool(["./src/fix-csv-quotes.py", str(temp_file)])
+
+            if source.use_gtfsclean and source.spec == "gtfs":
+                with record.phase("gtfsclean"):
+                    run_tool(["gtfsclean", str(temp_file),
+                              "--output", str(temp_file),
+                              *gtfsclean_arguments(source)])
+
+        summary = None
         if source.spec == "gtfs":
-            with ZipFile(file=open(temp_file, "rb")) as z:
-                validity = check_feed_timeframe_valid(z)
-                if validity == FeedValidity.IN_FUTURE and output_path.exists():
-                    eprint("Info: Feed not yet valid, using old version")
-                    os.remove(temp_file)
-                    os.remove(input_path)  # to force checking again
-                    return
-
-                if validity == FeedValidity.EXPIRED:
-                    if source.extend_calendar:
-                        eprint("Warning: Feed is expired, the calendar will be extended beyond the specified end date")
-                    else:
-                        eprint("Error: Feed is expired, please consider " +
-                        "removing or updating its source")
-                        raise Exception("Feed is expired")
+            with record.phase("validity"):
+                summary = feedsummary.summarize_feed(temp_file)
+                validity = feedsummary.validity(summary)
+            if validity == FeedValidity.IN_FUTURE and output_path.exists():
+                eprint("Info: Feed not yet valid, using old version")
+                os.remove(temp_file)
+                os.remove(input_path)  # to force checking again
+                return
+
+            if validity == FeedValidity.EXPIRED:
+                if source.extend_calendar:
+                    eprint("Warning: Feed is expired, the calendar will be extended beyond the specified end date")
+                else:
+                    eprint("Error: Feed is expired, please consider " +
+                    "removing or updating its source")
+                    raise Exception("Feed is expired")
 
         os.rename(temp_file, output_path)
+        record.output_size = output_path.stat().st_size
 
         ts = input_path.stat().st_mtime
         os.utime(output_path, (ts, ts))
 
-    def fetch(self, metadata: Path) -> int:
-        region = Region(json.load(open(metadata, "r")))
-        metadata_filename = metadata.name
-        region_name = metadata_filename[:metadata_filename.rfind('.')]
+        if summary:
+            feedsummary.write_summary(output_path, summary)
 
-        errors = 0
+        if not cached:
+            self.postprocess_cache.store(key, source.spec, output_path)
+        self.postprocess_cache.remember(key, source.spec, output_path)
 
-        outdir = Path("out/")
-        if not outdir.exists():
-            os.mkdir(outdir)
+    def region_jobs(self, metadata: Path,
+                    compiled: CompiledRegion) -> list["FetchJob"]:
+        # Decrypt all secrets of the region at once
+        prefetch_secrets(compiled.secrets)
+
+        return [FetchJob(metadata, compiled.name, source,
+                         compiled.resolved_sources(i))
+                for i, source in enumerate(compiled.region.sources)]
 
-        for source in region.sources:
-            if source.function:
+    # Resolves the source of a job, returns whether there is anything to fetch
+    def prepare_job(self, job: "FetchJob") -> bool:
+        source = job.source
+        if source.function:
+            with job.record.phase("resolve"):
                 source = getattr(region_helpers, source.function)(source)
 
-            if source.skip:
-                if source.skip_reason != "":
-                    print("Skipping " + region_name + "-" + source.name + ": " + source.skip_reason)
-                else:
-                    print("Skipping " + region_name + "-" + source.name)
-                continue
+        if source.skip:
+            if source.skip_reason != "":
+                print("Skipping " + job.id + ": " + source.skip_reason)
+            else:
+                print("Skipping " + job.id)
+            job.record.outcome = "skipped"
+            return False
 
+        if source.license.spdx_identifier:
+            validate_spdx_identifier(self.licensing, source.license.spdx_identifier)
 
-            if source.license.spdx_identifier:
-                validate_spdx_identifier(self.licensing, source.license.spdx_identifier)
+        validate_source_name(source.name)
+        download_name = f"{job.region_name}_{source.name}.{source.spec}.zip"
 
-            validate_source_name(source.name)
-            download_name = f"{region_name}_{source.name}.{source.spec}.zip"
+        print(f"Fetching {job.id}…")
+        sys.stdout.flush()
 
+        # Helper functions can return any kind of source, so only use the
+        # precompiled resolution if the source didn't go through one
+        if job.resolved and not job.source.function:
+            source = job.resolved[0]
+        else:
+            with job.record.phase("resolve"):
+                source = self.resolve_database_sources(source)
+        job.source = source
 
-            print(f"Fetching {region_name}-{source.name}…")
-            sys.stdout.flush()
+        # Nothing to download for realtime feeds
+        if source.spec != "gtfs" and source.spec != "netex":
+            return False
 
-            source = self.resolve_database_sources(source)
+        download_dir = Path("downloads/")
+        download_dir.mkdir(exist_ok=True)
+        outdir = Path("out/")
+        outdir.mkdir(exist_ok=True)
 
-            # Nothing to download for realtime feeds
-            if source.spec != "gtfs" and source.spec != "netex":
-                continue
+        job.download_path = download_dir.absolute() / download_name
+        job.output_path = outdir.absolute() / download_name
 
-            download_dir = Path("downloads/")
-            if not download_dir.exists():
-                os.mkdir(download_dir)
+        return True
 
-            download_path = download_dir.absolute() / download_name
-            output_path = outdir.absolute() / download_name
+    def renew_credentials(self, job: "FetchJob", error: Exception) -> bool:
+        """
+        If the server rejected the credentials that a helper function added
+        to the source, for example because a shared token expired while the
+        job was waiting, requests new ones and prepares the job again.
+        Returns whether the download should be retried.
+        """
+        if not job.definition.function or not credentials_rejected(error):
+            return False
 
-            try:
-                new_data = self.fetch_source(download_path, source)
-            except Exception as e:
-                eprint(f"Error: Could not fetch {region_name}-{source.name}: {e}")
-                errors += 1
-                continue
+        eprint(f"Info: Credentials for {job.id} were rejected, requesting new ones")
+        if isinstance(job.source, HttpSource):
+            region_helpers.token_cache.invalidate(
+                map(decrypt_if_necessary, job.source.options.headers.values()))
+        job.source = job.definition
+        return self.prepare_job(job)
+
+    def needs_postprocess(self, job: "FetchJob") -> bool:
+        assert job.download_path and job.output_path
+
+        if not job.output_path.exists():
+            return True
+
+        # The output belongs to the same input and options. This also catches
+        # downloads that changed their mtime, but not their content.
+        key = self.postprocess_key(job.source, job.download_path)
+        return not self.postprocess_cache.is_current(
+            key, job.source.spec, job.output_path)
+
+    # Returns whether the job needs to be postprocessed
+    def fetch_job(self, job: "FetchJob") -> bool:
+        with joblog.capture(job.log):
+            if not self.prepare_job(job):
+                return False
+
+            assert job.download_path
+            for attempt in itertools.count():
+                try:
+                    self.fetch_source(job.download_path, job.source,
+                                      job.record)
+                    break
+                except Exception as e:
+                    if attempt == 0 and self.renew_credentials(job, e):
+                        continue
+                    raise JobError(f"Could not fetch {job.id}: {e}") from e
+
+            return self.needs_postprocess(job)
 
-            # Nothing new was downloaded, and data is already processed
-            if not new_data and output_path.exists() \
-                    and download_path.stat().st_mtime <= output_path.stat().st_mtime:
-                continue
+    def postprocess_job(self, job: "FetchJob"):
+        assert job.download_path and job.output_path
 
-            # Something new was downloaded or the data was previously not processed
-            print(f"Postprocessing {region_name}-{source.name} with gtfsclean…")
+        with joblog.capture(job.log):
+            print(f"Postprocessing {job.id} with gtfsclean…")
             sys.stdout.flush()
 
             try:
-                self.postprocess(source, download_path, output_path)
+                self.postprocess(job.source, job.download_path,
+                                 job.output_path, job.record)
             except Exception as e:
-                eprint(f"Error: Could not postprocess {region_name}-{source.name}: {e}")
-                errors += 1
+                raise JobError(f"Could not postprocess {job.id}: {e}") from e
 
-            print()
-            sys.stdout.flush()
 
-        return errors
+class JobError(Exception):
+    pass
+
+
+def record_history(started_at: str, jobs: list["FetchJob"]):
+    """
+    Adds the records of the jobs that had something to fetch to the history.
+    """
+    records = []
+    for job in jobs:
+        if not job.download_path and not job.record.outcome:
+            continue
+
+        # Also record the size of feeds that were not postprocessed again
+        if job.record.output_size is None and job.output_path \
+                and job.output_path.exists():
+            job.record.output_size = job.output_path.stat().st_size
+        records.append(job.record)
+
+    try:
+        fetchhistory.save_run(started_at, " ".join(sys.argv), records)
+    except (OSError, sqlite3.Error) as e:
+        eprint(f"Warning: Could not write the fetch history: {e}")
+
+
+class FetchJob:
+    metadata: Path
+    region_name: str
+    # The source as written in the region file
+    definition: Source
+    source: Source
+    # Sources the source resolves to, from the metadata cache
+    resolved: Optional[list[Source]] = None
+    download_path: Optional[Path] = None
+    output_path: Optional[Path] = None
+    # Everything printed while the job ran
+    log: list[str]
+
+    def __init__(self, metadata: Path, region_name: str, source: Source,
+                 resolved: Optional[list[Source]] = None):
+        self.metadata = metadata
+        self.region_name = region_name
+        self.definition = source
+        self.source = source
+        self.resolved = resolved
+        # Keep the name of the unresolved source, in case a helper function
+        # or the database lookup fails
+        self.id = f"{region_name}-{source.name}"
+        self.record = FetchRecord(self.id, region_name)
+        self.log = []
+
+
+class FetchScheduler:
+    """
+    Fetches the sources of many regions in one process.
+
+    All sources are put into one queue, interleaved by region so that
+    neighbouring jobs rarely hit the same server. Downloads and
+    postprocessing run in separate bounded pools, so a large region
+    does not hold up the others, and shared state like the Transitland atlas
+    is only loaded once.
+
+    postprocess_memory is the memory in bytes that concurrent postprocessing
+    jobs may use together, by default most of the available memory.
+    """
+    fetcher: Fetcher
+    network_workers: int
+    postprocess_workers: int
+    postprocess_memory: Optional[int]
+    # Jobs of the last run
+    jobs: list[FetchJob]
+
+    def __init__(self, fetcher: Fetcher, network_workers: int = 16,
+                 postprocess_workers: int = os.cpu_count() or 1,
+                 postprocess_memory: Optional[int] = None):
+        self.fetcher = fetcher
+        self.network_workers = network_workers
+        self.postprocess_workers = postprocess_workers
+        self.postprocess_memory = postprocess_memory
+        self.jobs = []
+
+    def run(self, metadata_files: Iterable[Path]) -> dict[Path, list[str]]:
+        """
+        Runs all jobs and returns the error messages of each region that
+        had errors.
+        """
+        self.errors: dict[Path, list[str]] = {}
+        started_at = datetime.now(tz=timezone.utc).isoformat()
+        joblog.install()
+
+        metadata_files = list(metadata_files)
+        # Load all regions at once, so the metadata cache is only written once
+        load_errors: dict[Path, Exception] = {}
+        compiled_regions = self.fetcher.metadata_cache.regions(
+            metadata_files, load_errors)
+        loaded = [metadata for metadata in metadata_files
+                  if metadata not in load_errors]
+
+        region_jobs = []
+        for metadata, compiled in zip(loaded, compiled_regions):
+            try:
+                region_jobs.append(self.fetcher.region_jobs(metadata, compiled))
+            except Exception as e:
+                self.report(metadata, f"Could not load {metadata}: {e}")
+        for metadata, e in load_errors.items():
+            self.report(metadata, f"Could not load {metadata}: {e}")
+
+        jobs = [job for jobs in itertools.zip_longest(*region_jobs)
+                for job in jobs if job]
+        self.jobs = jobs
+
+        with PostprocessPool(max_workers=self.postprocess_workers,
+                             memory=self.postprocess_memory) as postprocess_pool:
+            postprocesses = self.fetch_all(jobs, postprocess_pool)
+
+            for future in concurrent.futures.as_completed(postprocesses):
+                job = postprocesses[future]
+                try:
+                    future.result()
+                except JobError as e:
+                    self.report_job(job, str(e))
+
+            postprocess_pool.print_report()
+
+        self.record_changes(jobs, metadata_files)
+        record_history(started_at, jobs)
+
+        return self.errors
+
+    def record_changes(self, jobs: list[FetchJob], metadata_files: list[Path]):
+        """
+        Writes the manifest of datasets that changed in this run.
+        """
+        produced = {f"{job.region_name}-{job.source.name}":
+                    (job.output_path, job.metadata)
+                    for job in jobs if job.output_path}
+
+        manifest = ChangeManifest()
+        manifest.update(produced, set(metadata_files), set(self.errors))
+        try:
+            manifest.save()
+        except OSError as e:
+            eprint(f"Warning: Could not write the dataset change manifest: {e}")
+        manifest.print_summary()
+
+    def fetch_all(self, jobs: list[FetchJob],
+                  postprocess_pool: PostprocessPool) \
+            -> dict[concurrent.futures.Future, FetchJob]:
+        """
+        Fetches all jobs, and submits them to the postprocess pool as soon
+        as their download finished.
+        """
+        postprocesses: dict[concurrent.futures.Future, FetchJob] = {}
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.network_workers) as network_pool:
+            fetches = {network_pool.submit(self.fetcher.fetch_job, job): job
+                       for job in jobs}
+
+            for future in concurrent.futures.as_completed(fetches):
+                self.fetched(fetches[future], future, postprocess_pool,
+                             postprocesses)
+
+        return postprocesses
+
+    def fetched(self, job: FetchJob, future: concurrent.futures.Future,
+                postprocess_pool: PostprocessPool,
+                postprocesses: dict[concurrent.futures.Future, FetchJob]):
+        try:
+            if future.result():
+                postprocesses[postprocess_pool.submit(
+                    job, self.fetcher.postprocess_job)] = job
+        except JobError as e:
+            self.report_job(job, str(e))
+        except (Exception, SystemExit) as e:
+            # Helper functions and validation may fail or exit
+            self.report_job(job, f"Could not fetch {job.id}: {e!r}")
+
+    def log(self, metadata: Path) -> str:
+        """
+        The output of the jobs of a region in the last run.
+        """
+        return "".join(text for job in self.jobs if job.metadata == metadata
+                       for text in job.log)
+
+    def report(self, job_metadata: Path, message: str):
+        eprint(f"Error: {message}")
+        self.errors.setdefault(job_metadata, []).append(message)
+
+    def report_job(self, job: FetchJob, message: str):
+        job.record.error = message
+        job.record.outcome = job.record.outcome or "failed"
+        self.report(job.metadata, message)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Transitous GTFS feed fetcher and post-processor.')
-    parser.add_argument('metadata_file', metavar='metadata-file', type=str, help='Region metadata file to fetch feeds from')
+    parser.add_argument('metadata_files', metavar='metadata-file', type=str, nargs="+", help='Region metadata file(s) to fetch feeds from')
+    parser.add_argument('--jobs', type=int, default=16, help='Number of parallel downloads when fetching multiple regions')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Use the asyncio download engine when fetching multiple regions')
+    parser.add_argument('--postprocess-jobs', type=int, default=os.cpu_count() or 1, help='Maximum number of feeds postprocessed at the same time')
+    parser.add_argument('--postprocess-memory', type=int, help='Memory in MiB that parallel postprocessing may use, by default 75%% of the available memory')
     arguments = parser.parse_args()
 
     fetcher = Fetcher()
 
-    errors = fetcher.fetch(Path(arguments.metadata_file))
+    postprocess_options = {
+        "postprocess_workers": arguments.postprocess_jobs,
+        "postprocess_memory": arguments.postprocess_memory * MiB
+        if arguments.postprocess_memory else None
+    }
+    if arguments.use_async:
+        from asyncfetch import AsyncFetchScheduler
+        scheduler = AsyncFetchScheduler(fetcher, **postprocess_options)
+    else:
+        scheduler = FetchScheduler(fetcher, network_workers=arguments.jobs,
+                                   **postprocess_options)
+    errors = sum(map(len, scheduler.run(map(Path, arguments.metadata_files)).values()))
     if errors > 0:
         eprint(f"Error: {errors} errors occurred during fetching.")
         sys.exit(1)
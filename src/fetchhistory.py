@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# History of fetch runs in a local SQLite database, with one row per source
+# and run. Each row contains how long the phases of the fetch took, how many
+# bytes were transferred and whether the content changed, so that slow, big
+# or frequently changing feeds can be found from data.
+# src/fetch-history.py reports from it.
+#
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import sqlite3
+import time
+
+DEFAULT_HISTORY_PATH = Path("cache/fetch-history.sqlite")
+
+PHASES = ["resolve", "probe", "head", "get", "fix-csv-quotes", "gtfsclean",
+          "validity"]
+
+
+def phase_column(phase: str) -> str:
+    return phase.replace("-", "_") + "_seconds"
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        started_at TEXT,
+        finished_at TEXT,
+        reason TEXT
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS fetches (
+        run_id INTEGER REFERENCES runs (id),
+        job_id TEXT,
+        region TEXT,
+        started_at TEXT,
+        outcome TEXT,
+        http_status INTEGER,
+        bytes_transferred INTEGER,
+        output_size INTEGER,
+        cache_hit INTEGER,
+        error TEXT,
+        {", ".join(f"{phase_column(phase)} REAL" for phase in PHASES)}
+    )""",
+    "CREATE INDEX IF NOT EXISTS fetches_job_id ON fetches (job_id)",
+]
+
+
+class FetchRecord:
+    """
+    What happened to one source during a fetch run.
+    """
+    job_id: str
+    region: str
+    started_at: str
+    # Time spent in each phase, in seconds
+    durations: dict[str, float]
+    # Download outcome, one of the DownloadState outcomes, or skipped/failed
+    outcome: Optional[str] = None
+    http_status: Optional[int] = None
+    bytes_transferred: int = 0
+    output_size: Optional[int] = None
+    # Whether the postprocessed feed came from the postprocess cache,
+    # None if it wasn't postprocessed
+    cache_hit: Optional[bool] = None
+    error: Optional[str] = None
+
+    def __init__(self, job_id: str = "", region: str = ""):
+        self.job_id = job_id
+        self.region = region
+        self.started_at = datetime.now(tz=timezone.utc).isoformat()
+        self.durations = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) \
+                + time.monotonic() - start
+
+
+class FetchHistory:
+    connection: sqlite3.Connection
+
+    def __init__(self, path: Path = DEFAULT_HISTORY_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, started_at: str, reason: str,
+                records: Iterable[FetchRecord]):
+        with self.connection:
+            run_id = self.connection.execute(
+                "INSERT INTO runs (started_at, finished_at, reason) VALUES (?, ?, ?)",
+                (started_at, datetime.now(tz=timezone.utc).isoformat(), reason)
+            ).lastrowid
+
+            columns = ["run_id", "job_id", "region", "started_at", "outcome",
+                       "http_status", "bytes_transferred", "output_size",
+                       "cache_hit", "error"] + list(map(phase_column, PHASES))
+            self.connection.executemany(
+                f"INSERT INTO fetches ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                ([run_id, record.job_id, record.region, record.started_at,
+                  record.outcome, record.http_status,
+                  record.bytes_transferred, record.output_size,
+                  record.cache_hit, record.error]
+                 + [record.durations.get(phase) for phase in PHASES]
+                 for record in records))
+
+    def query(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        return self.connection.execute(sql, parameters).fetchall()
+
+
+def save_run(started_at: str, reason: str, records: Iterable[FetchRecord],
+             path: Path = DEFAULT_HISTORY_PATH):
+    history = FetchHistory(path)
+    try:
+        history.add_run(started_at, reason, records)
+    finally:
+        history.close()
@@ -4,12 +4,17 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import zipfile
-import sys
+import argparse
 import os
-from functools import reduce
+import re
+import shutil
+import struct
+import sys
 import csv
 import io
 
+from typing import IO, Iterable, Iterator
+
 
 def strip_quotes(field: str):
     if field.startswith('"') and field.endswith('"'):
@@ -18,70 +23,175 @@ def strip_quotes(field: str):
         return field
 
 
-def parse_fuzzy_csv(csv: str) -> list[list[str]]:
-    rows = []
-
-    # skip BOM
-    if csv.startswith("\ufeff"):
-        csv = csv[len("\ufeff"):]
-
-    # Split lines and fields
-    for line in csv.splitlines():
-        start = 0
-        current_field_start = 0
-        fields = []
-
-        while True:
-            fieldsep = line.find(",", start)
-            if fieldsep == -1:
-                field = line[current_field_start:]
-                fields.append(strip_quotes(field.strip()))
-                rows.append(fields)
-                break
-
-            field = line[current_field_start:fieldsep]
-            numquotes = reduce(
-                lambda acc, c: acc + 1 if c == '"' else acc, field, 0)
-            if numquotes % 2 == 0:
-                fields.append(strip_quotes(field.strip()))
-                current_field_start = fieldsep + 1
-                start = fieldsep + 1
-            else:
-                start = fieldsep + 1
+def parse_fuzzy_line(line: str) -> list[str]:
+    """
+    Splits a line at the commas that are not inside quotes. Quotes that are
+    not properly escaped are kept as part of the field.
+    """
+    fields = []
+    start = 0
+    current_field_start = 0
+    # Number of quotes in the current field up to start
+    numquotes = 0
+
+    while True:
+        fieldsep = line.find(",", start)
+        if fieldsep == -1:
+            field = line[current_field_start:]
+            fields.append(strip_quotes(field.strip()))
+            break
+
+        numquotes += line.count('"', start, fieldsep)
+        if numquotes % 2 == 0:
+            fields.append(strip_quotes(line[current_field_start:fieldsep].strip()))
+            current_field_start = fieldsep + 1
+            numquotes = 0
+
+        start = fieldsep + 1
 
     # Unescape
-    for i, row in enumerate(rows):
-        for j, field in enumerate(row):
-            rows[i][j] = field.replace('""', '"')
-
-    return rows
-
-
-def edit_zip(source: str, destination: str):
+    return [field.replace('""', '"') for field in fields]
+
+
+def parse_fuzzy_csv(lines: Iterable[str]) -> Iterator[list[str]]:
+    first = True
+    for physical_line in lines:
+        # skip BOM
+        if first:
+            physical_line = physical_line.removeprefix("\ufeff")
+            first = False
+
+        # Besides newlines, splitlines also splits at other line boundaries
+        # such as form feeds.
+        for line in physical_line.splitlines():
+            yield parse_fuzzy_line(line)
+
+
+def fix_csv(infile: IO[bytes], outfile: IO[bytes]):
+    with io.TextIOWrapper(infile, encoding="utf-8") as intext, \
+            io.TextIOWrapper(outfile, encoding="utf-8", newline="") as outtext:
+        writer = csv.writer(outtext)
+        writer.writerows(parse_fuzzy_csv(intext))
+
+
+# Lines that the fuzzy parser might read differently from a normal CSV reader
+SUSPICIOUS_LINE = re.compile(r'"|\s,|,\s|^\s|\s$')
+
+
+def needs_fixing(infile: IO[bytes]) -> bool:
+    """
+    Checks whether fixing the file would change its content as read by a CSV
+    reader. Only lines with quotes or with whitespace around fields need to
+    be parsed for that.
+    """
+    with io.TextIOWrapper(infile, encoding="utf-8") as intext:
+        for physical_line in intext:
+            lines = physical_line.splitlines()
+            if len(lines) > 1:
+                return True
+
+            for line in lines:
+                if SUSPICIOUS_LINE.search(line) and \
+                        parse_fuzzy_line(line) != next(csv.reader([line])):
+                    return True
+
+    return False
+
+
+# copy_raw uses internals of zipfile, so only use it with the versions it was
+# tested with, and otherwise fall back to decompressing and compressing again
+RAW_COPY_SUPPORTED = (3, 11) <= sys.version_info[:2] <= (3, 13) \
+    and all(hasattr(zipfile, name) for name in [
+        "structFileHeader", "sizeFileHeader", "_FH_FILENAME_LENGTH",
+        "_FH_EXTRA_FIELD_LENGTH", "_MASK_USE_DATA_DESCRIPTOR"]) \
+    and hasattr(zipfile.ZipFile, "_writecheck")
+
+
+def copy_raw(inzip: zipfile.ZipFile, outzip: zipfile.ZipFile,
+             inzipinfo: zipfile.ZipInfo):
+    """
+    Copies a member with its compressed bytes, without decompressing and
+    compressing it again.
+    """
+    # Skip the local file header of the input member
+    inzip.fp.seek(inzipinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           inzip.fp.read(zipfile.sizeFileHeader))
+    inzip.fp.seek(header[zipfile._FH_FILENAME_LENGTH]
+                  + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    zinfo = zipfile.ZipInfo(inzipinfo.filename, inzipinfo.date_time)
+    zinfo.compress_type = inzipinfo.compress_type
+    zinfo.create_system = inzipinfo.create_system
+    zinfo.external_attr = inzipinfo.external_attr
+    zinfo.CRC = inzipinfo.CRC
+    zinfo.compress_size = inzipinfo.compress_size
+    zinfo.file_size = inzipinfo.file_size
+    # Sizes and CRC are known, so the new header contains them and
+    # no data descriptor follows the data
+    zinfo.flag_bits = inzipinfo.flag_bits & ~zipfile._MASK_USE_DATA_DESCRIPTOR
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT \
+        or zinfo.compress_size > zipfile.ZIP64_LIMIT
+
+    # Same steps as ZipFile.mkdir, but followed by the member data
+    with outzip._lock:
+        outzip.fp.seek(outzip.start_dir)
+        zinfo.header_offset = outzip.fp.tell()
+        outzip._writecheck(zinfo)
+        outzip._didModify = True
+
+        outzip.filelist.append(zinfo)
+        outzip.NameToInfo[zinfo.filename] = zinfo
+        outzip.fp.write(zinfo.FileHeader(zip64))
+
+        remaining = inzipinfo.compress_size
+        while remaining:
+            chunk = inzip.fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated member {inzipinfo.filename}")
+            outzip.fp.write(chunk)
+            remaining -= len(chunk)
+
+        outzip.start_dir = outzip.fp.tell()
+
+
+def edit_zip(source: str, destination: str, rewrite_all: bool = False):
     with zipfile.ZipFile(source) as inzip, \
             zipfile.ZipFile(destination, "w", compression=zipfile.ZIP_DEFLATED) as outzip:
         # Iterate the input files
         for inzipinfo in inzip.infolist():
-            with inzip.open(inzipinfo) as infile:
-                if inzipinfo.filename.endswith(".txt"):
+            fix = inzipinfo.filename.endswith(".txt")
+            # Encrypted members (flag bit 0) can't be copied raw
+            if not rewrite_all and not inzipinfo.flag_bits & 0x1:
+                if fix:
+                    with inzip.open(inzipinfo) as infile:
+                        fix = needs_fixing(infile)
+
+                if not fix and RAW_COPY_SUPPORTED:
+                    copy_raw(inzip, outzip, inzipinfo)
+                    continue
+
+            # Fixing quotes can make a file slightly larger
+            force_zip64 = inzipinfo.file_size > zipfile.ZIP64_LIMIT // 2
+            with inzip.open(inzipinfo) as infile, \
+                    outzip.open(inzipinfo.filename, "w", force_zip64=force_zip64) as outfile:
+                if fix:
                     print("Rewriting", inzipinfo.filename)
-                    content = infile.read()
-                    rows = parse_fuzzy_csv(content.decode())
-
-                    with io.StringIO() as outcsv:
-                        writer = csv.writer(outcsv)
-                        for row in rows:
-                            writer.writerow(row)
-
-                        outzip.writestr(inzipinfo.filename, outcsv.getvalue())
+                    fix_csv(infile, outfile)
                 else:
-                    outzip.writestr(inzipinfo.filename, infile.read())
+                    shutil.copyfileobj(infile, outfile)
 
 
 if __name__ == "__main__":
-    source = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Fix improperly quoted fields in a GTFS feed.")
+    parser.add_argument("source", help="GTFS zip file, modified in place")
+    parser.add_argument("--rewrite-all", action="store_true",
+                        help="Rewrite and recompress all files, even if they are already fine")
+    arguments = parser.parse_args()
+
+    source = arguments.source
     destination = source + ".tmp"
 
-    edit_zip(source, destination)
+    edit_zip(source, destination, arguments.rewrite_all)
 
     os.rename(destination, source)
@@ -9,6 +9,9 @@ import time
 import os
 
 from metadata import Region
+from downloadstate import state_path_for
+from feedsummary import summary_path_for
+from postprocesscache import PostprocessCache
 from pathlib import Path
 
 
@@ -49,6 +52,12 @@ if __name__ == "__main__":
         time.sleep(5)
 
     for f in to_delete_filenames:
-        for p in [out_dir / f, downloads_dir / f]:
+        for p in [out_dir / f, downloads_dir / f,
+                  state_path_for(downloads_dir / f),
+                  summary_path_for(out_dir / f)]:
             if p.exists():
                 delete_file(p)
+
+    # Cache entries of deleted or updated feeds
+    for entry in PostprocessCache().prune():
+        print(f"Deleted unused postprocess cache entry {entry.name}")
@@ -3,17 +3,18 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import argparse
+import concurrent.futures
 import json
-import csv
-import io
-import transitland
-import mobilitydatabase
+import os
+import feedsummary
 import pycountry
 
 from pathlib import Path
-from metadata import TransitlandSource, MobilityDatabaseSource, Region, UrlSource, HttpSource, FtpSource
-from zipfile import ZipFile
-from typing import Optional, Any
+from metadata import UrlSource, HttpSource, FtpSource
+from metadatacache import MetadataCache
+from utils import eprint
+from typing import Optional, Any, Iterable
 from datetime import datetime, timezone
 
 
@@ -25,6 +26,10 @@ COUNTRIES = {
 }
 SUBDIVISIONS: dict[str, str] = {}
 
+# Summaries of feeds whose summary in out/ is outdated. They are kept here,
+# as generating the attribution should not modify the published files.
+SUMMARY_CACHE_DIR = Path("cache/feed-summaries/")
+
 
 def filter_duplicates(elems):
     prev = None
@@ -38,7 +43,44 @@ def filter_duplicates(elems):
     return out
 
 
-def http_source_attribution(source: HttpSource | FtpSource, source_id: str, region_data: dict) -> Optional[dict]:
+def cached_summary_path(feed_path: Path) -> Path:
+    return SUMMARY_CACHE_DIR / feedsummary.summary_path_for(feed_path).name
+
+
+def load_summaries(feed_paths: Iterable[Path], jobs: int) -> dict[Path, dict]:
+    """
+    Loads the summaries of the GTFS feeds at feed_paths. Feeds that changed
+    since their summary was written are summarized again in a process pool.
+    Feeds that can't be summarized are left out.
+    """
+    summaries = {}
+    outdated = []
+    for feed_path in feed_paths:
+        summary = feedsummary.load_summary(feed_path) \
+            or feedsummary.load_summary(feed_path, cached_summary_path(feed_path))
+        if summary is None:
+            outdated.append(feed_path)
+        else:
+            summaries[feed_path] = summary
+
+    if outdated:
+        print(f"Summarizing {len(outdated)} changed feeds…")
+        SUMMARY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(feedsummary.load_or_create_summary,
+                                   feed_path, cached_summary_path(feed_path)):
+                       feed_path for feed_path in outdated}
+            for future in concurrent.futures.as_completed(futures):
+                feed_path = futures[future]
+                try:
+                    summaries[feed_path] = future.result()
+                except Exception as e:
+                    eprint(f"Warning: Could not read {feed_path}, skipping it: {e}")
+
+    return summaries
+
+
+def http_source_attribution(source: HttpSource | FtpSource, source_id: str, region_data: dict, summary: Optional[dict] = None) -> Optional[dict]:
     attribution = region_data
 
     if source.license.spdx_identifier:
@@ -74,63 +116,51 @@ def http_source_attribution(source: HttpSource | FtpSource, source_id: str, regi
         if source.spec == "gtfs":
             contacts: list[dict] = []
 
-            with ZipFile(feed_path) as z:
-                if "feed_info.txt" in z.namelist():
-                    with z.open("feed_info.txt", "r") as i:
-                        with io.TextIOWrapper(i) as it:
-                            inforeader = csv.DictReader(it, delimiter=",", quotechar='"')
-
-                            publisher = next(inforeader)
-                            if "feed_publisher_name" in publisher and "feed_publisher_url" in publisher:
-                                attribution["publisher"] = {}
-                                attribution["publisher"]["name"] = publisher["feed_publisher_name"]
-                                attribution["publisher"]["url"] = publisher["feed_publisher_url"]
-
-                                contact = {
-                                        "type": "publisher",
-                                        "name": publisher["feed_publisher_name"],
-                                        "email": publisher.get("feed_contact_email"),
-                                        "url": publisher.get("feed_contact_url")
-                                }
-
-                                contacts.append(contact)
-
-                with z.open("agency.txt", "r") as a:
-                    with io.TextIOWrapper(a) as at:
-                        agencyreader = list(csv.DictReader(at, delimiter=",", quotechar='"'))
-
-                        attribution["operators"] = \
-                            filter_duplicates(map(lambda agency: agency["agency_name"],
-                                                agencyreader))
-
-                        contacts += map(lambda agency: {
-                                "type": "agency",
-                                "agency_id": agency.get("agency_id"),
-                                "name": agency["agency_name"],
-                                "email": agency.get("agency_email")
-                            }, agencyreader)
-
-                if "attributions.txt" in z.namelist():
-                    with z.open("attributions.txt", "r") as a:
-                        with io.TextIOWrapper(a) as at:
-                            attributionstxt = csv.DictReader(at, delimiter=",", quotechar='"')
-                            attribution["attributions"] = filter_duplicates(
-                                map(
-                                    lambda contrib: {
-                                        "name": contrib["organization_name"],
-                                        "url": contrib.get("attribution_url")
-                                    },
-                                    attributionstxt,
-                                )
-                            )
-
-                            attribution_contacts = map(lambda operator: {
-                                    "type": "attribution",
-                                    "name": operator["organization_name"],
-                                    "email": operator.get("attribution_email")
-                                }, attributionstxt)
-
-                            contacts += attribution_contacts
+            if summary is None:
+                summary = feedsummary.summarize_feed(feed_path)
+
+            publisher = summary["publisher"]
+            if publisher:
+                attribution["publisher"] = {}
+                attribution["publisher"]["name"] = publisher["name"]
+                attribution["publisher"]["url"] = publisher["url"]
+
+                contact = {
+                        "type": "publisher",
+                        "name": publisher["name"],
+                        "email": publisher["email"],
+                        "url": publisher["contact_url"]
+                }
+
+                contacts.append(contact)
+
+            agencies = summary["agencies"]
+            attribution["operators"] = \
+                filter_duplicates(map(lambda agency: agency["name"], agencies))
+
+            contacts += map(lambda agency: {
+                    "type": "agency",
+                    "agency_id": agency["agency_id"],
+                    "name": agency["name"],
+                    "email": agency["email"]
+                }, agencies)
+
+            if summary["attributions"] is not None:
+                attribution["attributions"] = filter_duplicates(
+                    map(
+                        lambda contrib: {
+                            "name": contrib["name"],
+                            "url": contrib["url"]
+                        },
+                        summary["attributions"],
+                    )
+                )
+
+                contacts += map(lambda operator: {
+                        "type": "attribution",
+                        "name": operator["name"],
+                        "email": operator["email"]
+                    }, summary["attributions"])
 
             attribution["contacts"] = \
                 list(filter(lambda c: c.get("email") or c.get("url"),
@@ -234,42 +264,45 @@ def attribute_sort_key(attr):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the attribution list out/license.json.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of feeds summarized in parallel")
+    arguments = parser.parse_args()
+
     feed_dir = Path("feeds/")
 
-    transitland_atlas = transitland.Atlas.load(Path("transitland-atlas/"))
-    mobilitydb = mobilitydatabase.Database.load()
+    metadata_cache = MetadataCache()
+    regions = metadata_cache.regions(sorted(feed_dir.glob("*.json")))
 
-    attributions: dict[str, dict] = {}
+    # Read the contents of all changed feeds up front, in parallel
+    feed_paths = []
+    for compiled in regions:
+        for i, source in enumerate(compiled.region.sources):
+            if source.skip:
+                continue
+            feed_path = Path(f"out/{compiled.name}_{source.name}.gtfs.zip")
+            for resolved in compiled.resolved_sources(i) or []:
+                if isinstance(resolved, (HttpSource, FtpSource)) \
+                        and resolved.spec == "gtfs" and feed_path.exists():
+                    feed_paths.append(feed_path)
 
-    for feed in sorted(feed_dir.glob("*.json")):
-        parsed = {}
-        with open(feed, "r") as f:
-            parsed = json.load(f)
+    summaries = load_summaries(dict.fromkeys(feed_paths), arguments.jobs)
 
-        metadata_filename = feed.name
-        region_code_lower = metadata_filename[: metadata_filename.rfind(".")]
+    attributions: dict[str, dict] = {}
+
+    for compiled in regions:
+        region_code_lower = compiled.name
         region_data = get_region_data(region_code_lower)
 
-        region = Region(parsed)
-        for source in region.sources:
+        for i, source in enumerate(compiled.region.sources):
             source_id = f"{region_code_lower}_{source.name}"
 
             if source.skip:
                 continue
 
-            resolved_sources = []
-            match source:
-                case TransitlandSource():
-                    resolved_sources = transitland_atlas.sources_by_id(source)
-                    if not resolved_sources:
-                        continue
-                case MobilityDatabaseSource():
-                    resolved_source = mobilitydb.source_by_id(source)
-                    if not resolved_source:
-                        continue
-                    resolved_sources = [resolved_source]
-                case _:
-                    resolved_sources = [source]
+            resolved_sources = compiled.resolved_sources(i)
+            if not resolved_sources:
+                continue
 
             for source in resolved_sources:
                 match source:
@@ -287,7 +320,15 @@ if __name__ == "__main__":
                             if source_id not in attributions:
                                 attributions[source_id] = gbfs_attribution
                     case HttpSource() | FtpSource():
-                        http_attribution = http_source_attribution(source, source_id, region_data.copy())
+                        feed_path = Path(f"out/{source_id}.{source.spec}.zip")
+                        if source.spec == "gtfs" and feed_path.exists() \
+                                and feed_path not in summaries:
+                            # Could not be summarized
+                            continue
+
+                        http_attribution = http_source_attribution(
+                            source, source_id, region_data.copy(),
+                            summaries.get(feed_path))
                         if not http_attribution:
                             continue
 
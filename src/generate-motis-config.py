@@ -4,19 +4,21 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import argparse
+import filecmp
+import io
 import json
+import pickle
 import toml
 import metadata
 import os
 import shutil
 import sys
-import transitland
-import mobilitydatabase
 
-from ruamel.yaml import YAML
-from typing import Any
+from ruamel.yaml import YAML, YAMLError
+from typing import Any, Optional
 from pathlib import Path
-from utils import eprint, decrypt_if_necessary
+from utils import eprint, decrypt_if_necessary, prefetch_secrets
+from metadatacache import MetadataCache, CompiledRegion
 from urllib.parse import quote
 
 FEED_PROXY="https://rt.triptix.tech"
@@ -37,19 +39,268 @@ def to_motis_rt_spec(spec: str) -> str:
         case 'siri-json': return 'siri_json'
     return spec
 
+FRAGMENT_CACHE_PATH = Path("cache/motis-config-fragments.pickle")
+# Increase when the generated fragments change
+FRAGMENT_CACHE_VERSION = 1
+
+
+def region_output_state(compiled: CompiledRegion, script_dir: Path) -> tuple:
+    """
+    Existence of the files in out/ and scripts/ that the datasets of a region
+    refer to.
+    """
+    state = []
+    for i, source in enumerate(compiled.region.sources):
+        if source.skip:
+            continue
+
+        for source in compiled.resolved_sources(i) or []:
+            if source.spec in ["gtfs", "netex"]:
+                schedule_file = f"{compiled.name}_{source.name}.{source.spec}.zip"
+                state.append((schedule_file, check_file_exist_in_out_folder(schedule_file)))
+            if source.script is not None:
+                state.append((source.script, os.path.exists(script_dir / source.script)))
+
+    return tuple(state)
+
+
+def region_fragment(compiled: CompiledRegion, feed_proxy: bool,
+                    skip_missing_files: bool, script_dir: Path) -> dict:
+    """
+    Datasets and GBFS feeds of one region. Encrypted values are left as they
+    are, so that the fragment can be cached.
+    """
+    region_name = compiled.name
+    datasets: dict[str, Any] = {}
+    gbfs: dict[str, Any] = {}
+    ignored: list[tuple[str, str]] = []
+
+    for i, source in enumerate(compiled.region.sources):
+        if source.skip:
+            continue
+
+        resolved_sources = compiled.resolved_sources(i)
+        if not resolved_sources:
+            match source:
+                case metadata.TransitlandSource():
+                    eprint("Error: Could not resolve", source.transitland_atlas_id)
+                case metadata.MobilityDatabaseSource():
+                    eprint("Error: Could not resolve", source.mdb_id)
+            sys.exit(1)
+
+        for source in resolved_sources:
+            use_original_url = isinstance(source, metadata.UrlSource) and not source.use_feed_proxy
+            if feed_proxy and use_original_url and source.spec != "gbfs":
+                continue
+            if feed_proxy:
+                use_original_url = True
+            match source.spec:
+                case source.spec if source.spec in ["gtfs", "netex"]:
+                    schedule_file = \
+                        f"{region_name}_{source.name}.{source.spec}.zip"
+                    name = f"{region_name}-{source.name}"
+                    if (not skip_missing_files) or check_file_exist_in_out_folder(schedule_file):
+                        datasets[name] = \
+                            {
+                                "path": schedule_file,
+                                "extend_calendar": source.extend_calendar
+                            }
+
+                        if source.default_timezone is not None:
+                            datasets[name]["default_timezone"] = source.default_timezone
+
+                        if source.enable_crowd_sourced_realtime:
+                            if "rt" not in datasets[name]:
+                                datasets[name]["rt"] = []
+
+                            datasets[name]["rt"].append({"url": f"http://crowdsourcing.transitous.org/gtfsrt/{name}/trip-updates.pb" })
+
+                        if source.script is not None:
+                            if not os.path.exists(os.path.join(script_dir, source.script)):
+                                eprint(f"Error: Import script {source.script} for {name} could not be found.")
+                                sys.exit(1)
+                            datasets[name]["script"] = f"scripts/{source.script}"
+                    else:
+                        ignored.append((name, schedule_file))
+
+                case source.spec if isinstance(source, metadata.UrlSource) and source.spec in ["gtfs-rt", "siri", "siri-json"]:
+                    name = f"{region_name}-{source.name}"
+                    if name not in datasets:
+                        if skip_missing_files:  # Probably the static feed was not downloaded
+                            continue
+                        eprint(
+                            "Error: The name of a realtime (gtfs-rt) "
+                            + "feed needs to match the name of its "
+                            + "static base feed defined before the "
+                            + "realtime feed. Found nothing "
+                            + "belonging to",
+                            source.name,
+                        )
+                        sys.exit(1)
+
+                    if "rt" not in datasets[name]:
+                        datasets[name]["rt"] = []
+
+                    rt_feed: dict[str, Any] = {
+                        "url": source.url if use_original_url else FEED_PROXY + '/feed/' + quote(name) + "-" + str(len(datasets[name]["rt"])),
+                        "protocol": to_motis_rt_spec(source.spec)
+                    }
+
+                    if source.headers and use_original_url:
+                        rt_feed["headers"] = dict(source.headers)
+
+                    datasets[name]["rt"].append(rt_feed)
+
+                    if source.derive_trip_updates:
+                        datasets[name]["rt"].append({
+                            "url": f"https://crowdsourcing.transitous.org/gtfsrt/{name}/trip-updates.pb",
+                            "protocol": "gtfsrt"
+                        })
+
+                case "gbfs" if isinstance(source, metadata.UrlSource):
+                    name = f"{region_name}-{source.name}"
+                    gbfs[name] = {"url": source.url if use_original_url else FEED_PROXY + '/feed/' + quote(name)}
+                    if source.headers and use_original_url:
+                        gbfs[name]["headers"] = dict(source.headers)
+
+    return {
+        "datasets": datasets,
+        "gbfs": gbfs,
+        "ignored": ignored
+    }
+
+
+def decrypt_feed(feed: dict) -> dict:
+    """
+    Copy of a realtime or GBFS feed entry with its secrets decrypted.
+    """
+    result = dict(feed)
+    if "url" in feed:
+        result["url"] = decrypt_if_necessary(feed["url"])
+    if "headers" in feed:
+        result["headers"] = {key: decrypt_if_necessary(value)
+                             for key, value in feed["headers"].items()}
+    return result
+
+
+class FragmentCache:
+    """
+    Region fragments of previous runs, keyed by the region name and the
+    options they were generated with.
+    """
+    path: Path
+    entries: dict[tuple, tuple[tuple, dict]]
+
+    def __init__(self, path: Path = FRAGMENT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+
+        try:
+            with open(path, "rb") as f:
+                cache = pickle.load(f)
+            if cache.get("version") == FRAGMENT_CACHE_VERSION:
+                self.entries = cache["entries"]
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+    def lookup(self, name: tuple, key: tuple) -> Optional[dict]:
+        entry = self.entries.get(name)
+        if entry and entry[0] == key:
+            return entry[1]
+        return None
+
+    def store(self, name: tuple, key: tuple, fragment: dict):
+        self.entries[name] = (key, fragment)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = self.path.parent / f".tmp-{os.getpid()}-{self.path.name}"
+        with open(tmppath, "wb") as f:
+            pickle.dump({
+                "version": FRAGMENT_CACHE_VERSION,
+                "entries": self.entries
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, self.path)
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Writes content to path, unless the file already contains exactly that.
+    Returns whether the file was written.
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+
+def sync_scripts(source: Path, dest: Path) -> bool:
+    """
+    Makes dest a copy of source, only touching the files that differ.
+    Returns whether anything changed.
+    """
+    changed = False
+    expected = set()
+    for path in source.rglob("*"):
+        if not path.is_file():
+            continue
+        relative = path.relative_to(source)
+        expected.add(relative)
+        target = dest / relative
+        if target.is_file() and filecmp.cmp(path, target, shallow=False):
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(path, target)
+        changed = True
+
+    for path in dest.rglob("*"):
+        if path.is_file() and path.relative_to(dest) not in expected:
+            path.unlink()
+            changed = True
+
+    return changed
+
+
+def changed_datasets(previous_path: str, datasets: dict) -> Optional[list[str]]:
+    """
+    Names of the datasets that were added, removed or modified compared to
+    the config at previous_path, or None if there is no previous config.
+    """
+    try:
+        with open(previous_path) as f:
+            previous = YAML(typ="safe").load(f)["timetable"]["datasets"] or {}
+    except (OSError, YAMLError, KeyError, TypeError):
+        return None
+
+    return sorted(name for name in previous.keys() | datasets.keys()
+                  if previous.get(name) != datasets.get(name))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Transitous MOTIS configuration generator.')
     parser.add_argument('--import-only', action='store_true', help='Generate configuration for importing only.')
     parser.add_argument('--skip-missing-files', action='store_true', help='Do not generate entry for missing GTFS files')
     parser.add_argument('--feed-proxy', action='store_true', help='Generate configuration for the feed proxy.')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the configuration of unchanged regions from the last run.')
+    parser.add_argument('--report', type=str, help='Write a JSON summary of what changed in the MOTIS configuration to this file.')
     parser.add_argument('regions', type=str, help='Only generate configuration for the given region(s) (leave empty for all regions, globs are supported)', nargs="*")
     arguments = parser.parse_args()
 
     feed_dir = Path("feeds/")
     script_dir = Path("scripts/")
 
-    atlas = transitland.Atlas.load(Path("transitland-atlas/"))
-    mdb = mobilitydatabase.Database.load()
+    metadata_cache = MetadataCache()
 
     # TODO backward compatibility, remove this in a few months
     while "full" in arguments.regions:
@@ -57,19 +308,44 @@ if __name__ == "__main__":
         arguments.regions.remove("full")
 
     feeds = []
-    regions: list[tuple[str, metadata.Region]] = []
     if len(arguments.regions) == 0:
         feeds = list(feed_dir.glob("*.json"))
     else:
         for region in arguments.regions:
             feeds += list(feed_dir.glob(f"{region}.json"))
 
-    for feed in sorted(feeds):
-        region_name = feed.name[:feed.name.rfind(".")]
-        regions.append((region_name, metadata.Region(json.load(open(feed, "r")))))
+    regions = metadata_cache.regions(sorted(feeds))
+
+    # Decrypt all secrets at once, instead of one by one while generating
+    prefetch_secrets([region.secrets for region in regions])
 
     ignored_feeds = set() # for feeds ignored due to missing file
 
+    fragment_cache = FragmentCache() if arguments.incremental else None
+    fragments = []
+    for compiled in regions:
+        fragment_name = (compiled.name, arguments.feed_proxy, arguments.skip_missing_files)
+        key = (metadata_cache.fingerprint(compiled),
+               region_output_state(compiled, script_dir))
+
+        fragment = fragment_cache.lookup(fragment_name, key) if fragment_cache else None
+        if fragment is None:
+            fragment = region_fragment(compiled, arguments.feed_proxy,
+                                       arguments.skip_missing_files, script_dir)
+            if fragment_cache:
+                fragment_cache.store(fragment_name, key, fragment)
+
+        fragments.append(fragment)
+
+    if fragment_cache:
+        try:
+            fragment_cache.save()
+        except OSError as e:
+            eprint(f"Warning: Could not write MOTIS config fragment cache: {e}")
+
+    config_changed = True
+    datasets_changed = None
+
     with open("configs/motis/config.yml") as f:
         yaml = YAML(typ="rt")
 
@@ -97,116 +373,19 @@ if __name__ == "__main__":
         config["gbfs"]["feeds"] = {}
         config["gbfs"]["proxy"] = FEED_PROXY
 
-        for feed in sorted(feeds):
-            with open(feed, "r") as f:
-                parsed = json.load(f)
-                region = metadata.Region(parsed)
+        for fragment in fragments:
+            for name, dataset in fragment["datasets"].items():
+                if "rt" in dataset:
+                    dataset = dict(dataset)
+                    dataset["rt"] = [decrypt_feed(rt_feed) for rt_feed in dataset["rt"]]
+                config["timetable"]["datasets"][name] = dataset
 
-                metadata_filename = feed.name
-                region_name = metadata_filename[: metadata_filename.rfind(".")]
+            for name, feed in fragment["gbfs"].items():
+                config["gbfs"]["feeds"][name] = decrypt_feed(feed)
 
-                for source in region.sources:
-                    schedule_name = f"{region_name}-{source.name}"
-
-                    if source.skip:
-                        continue
-
-                    resolved_sources = []
-                    match source:
-                        case metadata.TransitlandSource():
-                            resolved_sources = atlas.sources_by_id(source)
-                            if not resolved_sources:
-                                eprint("Error: Could not resolve", source.transitland_atlas_id)
-                                sys.exit(1)
-                        case metadata.MobilityDatabaseSource():
-                            resolved_source = mdb.source_by_id(source)
-                            if not resolved_source:
-                                eprint("Error: Could not resolve", source.mdb_id)
-                                sys.exit(1)
-                            resolved_sources = [resolved_source]
-                        case _:
-                            resolved_sources = [source]
-
-                    for source in resolved_sources:
-                        use_original_url = isinstance(source, metadata.UrlSource) and not source.use_feed_proxy
-                        if arguments.feed_proxy and use_original_url and source.spec != "gbfs":
-                            continue
-                        if arguments.feed_proxy:
-                            use_original_url = True
-                        match source.spec:
-                            case source.spec if source.spec in ["gtfs", "netex"]:
-                                schedule_file = \
-                                    f"{region_name}_{source.name}.{source.spec}.zip"
-                                name = f"{region_name}-{source.name}"
-                                if (not arguments.skip_missing_files) or check_file_exist_in_out_folder(schedule_file):
-                                    config["timetable"]["datasets"][name] = \
-                                        {
-                                            "path": schedule_file,
-                                            "extend_calendar": source.extend_calendar
-                                        }
-
-                                    if source.default_timezone is not None:
-                                        config["timetable"]["datasets"][name]["default_timezone"] = source.default_timezone
-
-                                    if source.enable_crowd_sourced_realtime:
-                                        if "rt" not in config["timetable"]["datasets"][name]:
-                                            config["timetable"]["datasets"][name]["rt"] = []
-
-                                        config["timetable"]["datasets"][name]["rt"].append({"url": f"http://crowdsourcing.transitous.org/gtfsrt/{name}/trip-updates.pb" })
-
-                                    if source.script is not None:
-                                        if not os.path.exists(os.path.join(script_dir, source.script)):
-                                            eprint(f"Error: Import script {source.script} for {name} could not be found.")
-                                            sys.exit(1)
-                                        config["timetable"]["datasets"][name]["script"] = f"scripts/{source.script}"
-                                else:
-                                    print("Warning: Skipping " + name + " as " + schedule_file + " is missing.")
-                                    ignored_feeds.add(name)
-
-                            case source.spec if isinstance(source, metadata.UrlSource) and source.spec in ["gtfs-rt", "siri", "siri-json"]:
-                                name = f"{region_name}-{source.name}"
-                                if name not in config["timetable"]["datasets"]:
-                                    if arguments.skip_missing_files:  # Probably the static feed was not downloaded
-                                        continue
-                                    eprint(
-                                        "Error: The name of a realtime (gtfs-rt) "
-                                        + "feed needs to match the name of its "
-                                        + "static base feed defined before the "
-                                        + "realtime feed. Found nothing "
-                                        + "belonging to",
-                                        source.name,
-                                    )
-                                    sys.exit(1)
-
-                                if "rt" not in config["timetable"]["datasets"][name]:
-                                    config["timetable"]["datasets"][name]["rt"] = []
-
-                                rt_feed: dict[str, Any] = {
-                                    "url": decrypt_if_necessary(source.url) if use_original_url else FEED_PROXY + '/feed/' + quote(name) + "-" + str(len(config["timetable"]["datasets"][name]["rt"])),
-                                    "protocol": to_motis_rt_spec(source.spec)
-                                }
-
-                                if source.headers and use_original_url:
-                                    rt_feed["headers"] = {}
-                                    for key, value in source.headers.items():
-                                        rt_feed["headers"][key] = decrypt_if_necessary(value)
-
-                                config["timetable"]["datasets"][name]["rt"] \
-                                        .append(rt_feed)
-
-                                if source.derive_trip_updates:
-                                    config["timetable"]["datasets"][name]["rt"].append({
-                                        "url": f"https://crowdsourcing.transitous.org/gtfsrt/{name}/trip-updates.pb",
-                                        "protocol": "gtfsrt"
-                                    })
-
-                            case "gbfs" if isinstance(source, metadata.UrlSource):
-                                name = f"{region_name}-{source.name}"
-                                config["gbfs"]["feeds"][name] = {"url": decrypt_if_necessary(source.url) if use_original_url else FEED_PROXY + '/feed/' + quote(name)}
-                                if source.headers and use_original_url:
-                                    config["gbfs"]["feeds"][name]["headers"] = {}
-                                    for key, value in source.headers.items():
-                                        config["gbfs"]["feeds"][name]["headers"][key] = decrypt_if_necessary(value)
+            for name, schedule_file in fragment["ignored"]:
+                print("Warning: Skipping " + name + " as " + schedule_file + " is missing.")
+                ignored_feeds.add(name)
 
         if arguments.feed_proxy:
             with open("/tmp/feed-proxy-vars.yml", "w") as fo:
@@ -221,34 +400,53 @@ if __name__ == "__main__":
                     feed_vars[key]['gbfs'] = True
                 yaml.dump(feed_vars, fo)    
         else:
-            with open("out/config.yml", "w") as fo:
-                yaml.dump(config, fo)
+            datasets_changed = changed_datasets("out/config.yml", config["timetable"]["datasets"])
+            buffer = io.StringIO()
+            yaml.dump(config, buffer)
+            config_changed = write_if_changed("out/config.yml", buffer.getvalue())
 
     # copy scripts
-    shutil.rmtree("out/scripts", ignore_errors=True)
-    shutil.copytree(script_dir, "out/scripts")
+    scripts_changed = sync_scripts(script_dir, Path("out/scripts"))
+
+    if not arguments.feed_proxy:
+        if config_changed or scripts_changed:
+            print("MOTIS configuration changed", end="")
+            if datasets_changed is not None:
+                print(f", {len(datasets_changed)} datasets differ", end="")
+            print(".")
+        else:
+            print("MOTIS configuration unchanged.")
+
+        if arguments.report:
+            with open(arguments.report, "w") as fo:
+                json.dump({
+                    "config-changed": config_changed,
+                    "scripts-changed": scripts_changed,
+                    "changed-datasets": datasets_changed
+                }, fo, indent=4)
 
     with open("configs/gps-collector/config.toml", "r") as f:
         config = toml.load(f)
         config["feeds"] = {}
 
-        for (region_name, region) in regions:
-            for source in region.sources:
+        for compiled in regions:
+            region_name = compiled.name
+            for source in compiled.region.sources:
                 if source.enable_crowd_sourced_realtime:
                     config["feeds"][f"{region_name}-{source.name}"] = {}
 
         if not os.path.exists("out/gps-collector/"):
             os.makedirs("out/gps-collector/")
 
-        with open("out/gps-collector/config.toml", "w") as fo:
-            toml.dump(config, fo)
+        write_if_changed("out/gps-collector/config.toml", toml.dumps(config))
 
     with open("configs/delay-tracker/config.toml", "r") as f:
         config = toml.load(f)
         config["feeds"] = {}
 
-        for (region_name, region) in regions:
-            for source in region.sources:
+        for compiled in regions:
+            region_name = compiled.name
+            for source in compiled.region.sources:
                 if source.enable_crowd_sourced_realtime:
                     config["feeds"][f"{region_name}-{source.name}"] = {
                         "gtfs_url": f"../{region_name}_{source.name}.gtfs.zip",
@@ -266,5 +464,4 @@ if __name__ == "__main__":
         if not os.path.exists("out/delay-tracker/"):
             os.makedirs("out/delay-tracker/")
 
-        with open("out/delay-tracker/config.toml", "w") as fo:
-            toml.dump(config, fo)
+        write_if_changed("out/delay-tracker/config.toml", toml.dumps(config))
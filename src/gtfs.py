@@ -0,0 +1,227 @@
+# SPDX-FileCopyrightText: 2023 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Helpers for reading the contents of GTFS feeds
+#
+
+from datetime import datetime
+from zipfile import ZipFile
+from typing import Optional, IO
+from zoneinfo import ZoneInfo
+from enum import Enum
+
+import csv
+import io
+
+
+def parse_gtfs_csv(f: IO) -> csv.DictReader:
+    header = list(map(lambda h: h.strip(), next(csv.reader(f))))
+    return csv.DictReader(f, delimiter=",",
+                          quotechar='"', fieldnames=header)
+
+
+def get_feed_timezone(zip_file: ZipFile) -> Optional[str]:
+    if "agency.txt" not in zip_file.namelist():
+        return None
+
+    with zip_file.open("agency.txt", "r") as a:
+        with io.TextIOWrapper(a) as at:
+            feedinforeader = parse_gtfs_csv(at)
+            for row in feedinforeader:
+                if "agency_timezone" in row \
+                        and row["agency_timezone"]:
+                    return row["agency_timezone"].strip()
+
+    return None
+
+
+class FeedValidity(Enum):
+    EXPIRED = 1
+    IN_FUTURE = 2
+    CURRENTLY_VALID = 3
+
+
+class DateRange:
+    """
+    Smallest and largest value of a date column, as YYYYMMDD strings.
+    GTFS dates compare correctly as strings, so no datetimes are needed.
+    """
+    min: Optional[str] = None
+    max: Optional[str] = None
+    # Rows that have no value in the column
+    missing: int = 0
+    rows: int = 0
+
+    @staticmethod
+    def from_json(parsed: dict) -> "DateRange":
+        result = DateRange()
+        result.min = parsed.get("min")
+        result.max = parsed.get("max")
+        result.missing = parsed.get("missing", 0)
+        result.rows = parsed.get("rows", 0)
+        return result
+
+    def to_json(self) -> dict:
+        return {
+            "min": self.min,
+            "max": self.max,
+            "missing": self.missing,
+            "rows": self.rows
+        }
+
+    def merge(self, other: "DateRange") -> "DateRange":
+        result = DateRange()
+        values = [v for v in (self.min, self.max, other.min, other.max) if v]
+        if values:
+            result.min = min(values)
+            result.max = max(values)
+        result.missing = self.missing + other.missing
+        result.rows = self.rows + other.rows
+        return result
+
+
+def scan_date_columns(zip_file: ZipFile, name: str,
+                      columns: list[str]) -> Optional[list[DateRange]]:
+    """
+    Reads the given date columns of a GTFS file in one pass.
+    Returns None if the file does not exist.
+    """
+    if name not in zip_file.namelist():
+        return None
+
+    ranges = [DateRange() for _ in columns]
+    with zip_file.open(name, "r") as f:
+        with io.TextIOWrapper(f, encoding="utf-8-sig") as text:
+            reader = csv.reader(text)
+            header = [h.strip() for h in next(reader, [])]
+            indices = [(header.index(column) if column in header else None, r)
+                       for column, r in zip(columns, ranges)]
+
+            for row in reader:
+                # DictReader skips empty lines as well
+                if not row:
+                    continue
+
+                for index, r in indices:
+                    r.rows += 1
+                    value = row[index].strip() \
+                        if index is not None and index < len(row) else ""
+                    if not value:
+                        r.missing += 1
+                        continue
+
+                    if len(value) != 8 or not value.isdigit():
+                        raise ValueError(f"Invalid date {value!r} in {name}")
+
+                    if r.max is None:
+                        r.min = r.max = value
+                    elif value > r.max:
+                        r.max = value
+                    elif value < r.min:  # type: ignore
+                        r.min = value
+
+    return ranges
+
+
+class FeedTimeframe:
+    """
+    The dates relevant for checking whether a feed is currently valid.
+    """
+    # feed_start_date / feed_end_date from feed_info.txt, None if the file
+    # does not exist
+    feed_start: Optional[DateRange] = None
+    feed_end: Optional[DateRange] = None
+    # Range of dates in calendar.txt and calendar_dates.txt
+    service: DateRange
+
+    def __init__(self):
+        self.service = DateRange()
+
+    @staticmethod
+    def from_json(parsed: dict) -> "FeedTimeframe":
+        timeframe = FeedTimeframe()
+        if parsed.get("feed_start"):
+            timeframe.feed_start = DateRange.from_json(parsed["feed_start"])
+        if parsed.get("feed_end"):
+            timeframe.feed_end = DateRange.from_json(parsed["feed_end"])
+        timeframe.service = DateRange.from_json(parsed["service"])
+        return timeframe
+
+    def to_json(self) -> dict:
+        return {
+            "feed_start": self.feed_start.to_json() if self.feed_start else None,
+            "feed_end": self.feed_end.to_json() if self.feed_end else None,
+            "service": self.service.to_json()
+        }
+
+    @property
+    def service_start(self) -> Optional[str]:
+        return self.service.min
+
+    @property
+    def service_end(self) -> Optional[str]:
+        return self.service.max
+
+    def already_valid(self, today: str) -> bool:
+        if not self.feed_start or not self.feed_start.rows:
+            return True
+
+        # Valid if any feed_info row has no start date or started already
+        return self.feed_start.missing > 0 \
+            or (self.feed_start.min is not None and self.feed_start.min <= today)
+
+    def not_expired(self, today: str) -> bool:
+        # The last day of a feed counts as expired once it started,
+        # as the end date is compared as midnight in the feed's time zone.
+        if self.feed_end and self.feed_end.max:
+            return self.feed_end.max > today
+
+        return self.service.max is not None and self.service.max > today
+
+    def validity(self, today: str) -> "FeedValidity":
+        if not self.already_valid(today):
+            return FeedValidity.IN_FUTURE
+
+        if not self.not_expired(today):
+            return FeedValidity.EXPIRED
+
+        return FeedValidity.CURRENTLY_VALID
+
+
+def scan_feed_timeframe(zip_file: ZipFile) -> FeedTimeframe:
+    timeframe = FeedTimeframe()
+
+    feed_info = scan_date_columns(zip_file, "feed_info.txt",
+                                  ["feed_start_date", "feed_end_date"])
+    if feed_info:
+        timeframe.feed_start, timeframe.feed_end = feed_info
+
+    calendar = scan_date_columns(zip_file, "calendar.txt",
+                                 ["start_date", "end_date"])
+    if calendar:
+        timeframe.service = timeframe.service.merge(calendar[0]) \
+            .merge(calendar[1])
+
+    calendar_dates = scan_date_columns(zip_file, "calendar_dates.txt",
+                                       ["date"])
+    if calendar_dates:
+        timeframe.service = timeframe.service.merge(calendar_dates[0])
+
+    return timeframe
+
+
+def today_in(tz: Optional[str]) -> str:
+    """
+    Today's date in the time zone of a feed, as YYYYMMDD
+    """
+    if not tz:
+        raise Exception("Could not check validity, because the time zone could not be detected")
+
+    return datetime.now(tz=ZoneInfo(tz)).strftime("%Y%m%d")
+
+
+def check_feed_timeframe_valid(zip_file: ZipFile) -> FeedValidity:
+    today = today_in(get_feed_timezone(zip_file))
+    return scan_feed_timeframe(zip_file).validity(today)
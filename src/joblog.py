@@ -0,0 +1,61 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Collects everything a fetch job prints, so that the log of a failed region
+# can be attached to its error report, like when every region was fetched in
+# its own process. The output still goes to the terminal as well. The log of
+# the running job is kept in a context variable, so this works for the
+# threads of the fetch scheduler as well as for the asyncio tasks.
+#
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional, TextIO
+
+import sys
+
+current_log: ContextVar[Optional[list[str]]] = \
+    ContextVar("current_log", default=None)
+
+
+class CapturingStream:
+    """
+    Passes writes on to stream, and adds them to the log of the current job.
+    """
+    stream: TextIO
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        log = current_log.get()
+        if log is not None:
+            log.append(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+
+def install():
+    """
+    Captures sys.stdout and sys.stderr from now on.
+    """
+    if not isinstance(sys.stdout, CapturingStream):
+        sys.stdout = CapturingStream(sys.stdout)
+    if not isinstance(sys.stderr, CapturingStream):
+        sys.stderr = CapturingStream(sys.stderr)
+
+
+@contextmanager
+def capture(log: list[str]) -> Iterator[None]:
+    """
+    Adds the output of the current thread or task to log.
+    """
+    token = current_log.set(log)
+    try:
+        yield
+    finally:
+        current_log.reset(token)
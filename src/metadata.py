@@ -1,13 +1,14 @@
 # SPDX-FileCopyrightText: 2023 Jonah Brüchert <jbb@kaidan.im>
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
-from typing import List, Optional
+from typing import List, Optional, Union
 from utils import eprint
 
 import sys
 
 
 class Maintainer:
+    __slots__ = ("name", "github")
     name: str
     github: str
 
@@ -17,19 +18,42 @@ class Maintainer:
 
 
 class License:
-    spdx_identifier: Optional[str] = None
-    url: Optional[str] = None
-    attribution_text: Optional[str] = None
-    publisher: Optional[str] = None
-    publisher_url: Optional[str] = None
+    __slots__ = ("spdx_identifier", "url", "attribution_text", "publisher",
+                 "publisher_url")
+    spdx_identifier: Optional[str]
+    url: Optional[str]
+    attribution_text: Optional[str]
+    publisher: Optional[str]
+    publisher_url: Optional[str]
+
+    def __init__(self):
+        self.spdx_identifier = None
+        self.url = None
+        self.attribution_text = None
+        self.publisher = None
+        self.publisher_url = None
+
+    def copy(self) -> "License":
+        result = License()
+        result.spdx_identifier = self.spdx_identifier
+        result.url = self.url
+        result.attribution_text = self.attribution_text
+        result.publisher = self.publisher
+        result.publisher_url = self.publisher_url
+        return result
 
 
 class DisplayNameOptions:
-    copy_trip_names_matching: Optional[str] = None
-    keep_route_names_matching: Optional[str] = None
-    move_headsigns_matching: Optional[str] = None
+    __slots__ = ("copy_trip_names_matching", "keep_route_names_matching",
+                 "move_headsigns_matching")
+    copy_trip_names_matching: Optional[str]
+    keep_route_names_matching: Optional[str]
+    move_headsigns_matching: Optional[str]
 
     def __init__(self, parsed: Optional[dict] = None):
+        self.copy_trip_names_matching = None
+        self.keep_route_names_matching = None
+        self.move_headsigns_matching = None
         if parsed:
             if "copy-trip-names-matching" in parsed:
                 self.copy_trip_names_matching = \
@@ -43,29 +67,55 @@ class DisplayNameOptions:
 
 
 class Source:
+    __slots__ = ("name", "fix", "use_gtfsclean", "license", "spec",
+                 "fix_csv_quotes", "skip", "skip_reason", "function",
+                 "drop_too_fast_trips", "drop_shapes", "drop_agency_names",
+                 "keep_agency_names", "display_name_options", "extend_calendar",
+                 "default_timezone", "keep_additional_fields", "script",
+                 "use_feed_proxy", "enable_crowd_sourced_realtime")
     name: str
-    fix: bool = False
-    use_gtfsclean: bool = True
+    fix: bool
+    use_gtfsclean: bool
     license: License
-    spec: str = "gtfs"
-    fix_csv_quotes: bool = False
-    skip: bool = False
-    skip_reason: str = ""
-    function: Optional[str] = None
-    drop_too_fast_trips: bool = True
-    drop_shapes: bool = False
-    drop_agency_names: List[str] = []
-    keep_agency_names: List[str] = []
-    display_name_options: Optional[DisplayNameOptions] = None
-    extend_calendar = False
-    default_timezone: Optional[str] = None
-    keep_additional_fields = True
-    script: Optional[str] = None
-    use_feed_proxy: bool = False
-    enable_crowd_sourced_realtime = False
+    spec: str
+    fix_csv_quotes: bool
+    skip: bool
+    skip_reason: str
+    function: Optional[str]
+    drop_too_fast_trips: bool
+    drop_shapes: bool
+    drop_agency_names: List[str]
+    keep_agency_names: List[str]
+    display_name_options: Optional[DisplayNameOptions]
+    extend_calendar: bool
+    default_timezone: Optional[str]
+    keep_additional_fields: bool
+    script: Optional[str]
+    use_feed_proxy: bool
+    enable_crowd_sourced_realtime: bool
 
     def __init__(self, parsed: Optional[dict] = None):
+        self.name = ""
+        self.fix = False
+        self.use_gtfsclean = True
         self.license = License()
+        self.spec = "gtfs"
+        self.fix_csv_quotes = False
+        self.skip = False
+        self.skip_reason = ""
+        self.function = None
+        self.drop_too_fast_trips = True
+        self.drop_shapes = False
+        self.drop_agency_names = []
+        self.keep_agency_names = []
+        self.display_name_options = None
+        self.extend_calendar = False
+        self.default_timezone = None
+        self.keep_additional_fields = True
+        self.script = None
+        self.use_feed_proxy = False
+        self.enable_crowd_sourced_realtime = False
+
         if parsed:
             if "license" in parsed:
                 if "spdx-identifier" in parsed["license"]:
@@ -121,18 +171,37 @@ class Source:
 
 
 class HttpOptions:
-    fetch_interval_days: Optional[int] = None
+    __slots__ = ("fetch_interval_days", "headers", "ignore_tls_errors",
+                 "method", "request_body", "timeout", "retries",
+                 "retry_backoff")
+    fetch_interval_days: Optional[int]
     headers: dict[str, str]
-    ignore_tls_errors: bool = False
-    method: Optional[str] = None
-    request_body: Optional[str] = None
+    ignore_tls_errors: bool
+    method: Optional[str]
+    request_body: Optional[str]
+    timeout: float
+    retries: int
+    retry_backoff: float
 
     def __init__(self, parsed: Optional[dict] = None):
+        self.fetch_interval_days = None
         self.headers = {}
+        self.ignore_tls_errors = False
+        self.method = None
+        self.request_body = None
+        self.timeout = 30
+        self.retries = 3
+        self.retry_backoff = 2.0
         if parsed:
             if "fetch-interval-days" in parsed:
                 self.fetch_interval_days = \
                     int(parsed["fetch-interval-days"])
+            if "timeout" in parsed:
+                self.timeout = float(parsed["timeout"])
+            if "retries" in parsed:
+                self.retries = int(parsed["retries"])
+            if "retry-backoff" in parsed:
+                self.retry_backoff = float(parsed["retry-backoff"])
             if "ignore-tls-errors" in parsed:
                 self.ignore_tls_errors = \
                     bool(parsed["ignore-tls-errors"])
@@ -142,11 +211,19 @@ class HttpOptions:
             self.method = parsed.get("method")
             self.request_body = parsed.get("request-body")
 
+    def copy(self) -> "HttpOptions":
+        result = HttpOptions()
+        for field in HttpOptions.__slots__:
+            setattr(result, field, getattr(self, field))
+        result.headers = dict(self.headers)
+        return result
+
 
 class TransitlandSource(Source):
-    transitland_atlas_id: str = ""
-    url_override: Optional[str] = None
-    api_key: Optional[str] = None
+    __slots__ = ("transitland_atlas_id", "url_override", "api_key", "options")
+    transitland_atlas_id: str
+    url_override: Optional[str]
+    api_key: Optional[str]
     options: HttpOptions
 
     def __init__(self, parsed: dict):
@@ -162,8 +239,9 @@ class TransitlandSource(Source):
 
 
 class MobilityDatabaseSource(Source):
-    mdb_id: str = ""
-    url_override: Optional[str] = None
+    __slots__ = ("mdb_id", "url_override", "options")
+    mdb_id: str
+    url_override: Optional[str]
     options: HttpOptions
 
     def __init__(self, parsed: dict):
@@ -178,26 +256,31 @@ class MobilityDatabaseSource(Source):
 
 
 class HttpSource(Source):
-    url: str = ""
+    __slots__ = ("url", "options", "url_override", "cache_url")
+    url: str
     options: HttpOptions
-    url_override: Optional[str] = None
-    cache_url: Optional[str] = None
+    url_override: Optional[str]
+    cache_url: Optional[str]
 
     def __init__(self, parsed: Optional[dict] = None):
+        super().__init__(parsed)
+        self.url = ""
+        self.url_override = None
+        self.cache_url = None
 
         if parsed:
-            super().__init__(parsed)
             self.url = parsed["url"]
             self.url_override = parsed.get("url-override", None)
 
-            if "http-options" in parsed:
-                self.options = HttpOptions(parsed["http-options"])
-            else:
-                self.options = HttpOptions()
+        if parsed and "http-options" in parsed:
+            self.options = HttpOptions(parsed["http-options"])
+        else:
+            self.options = HttpOptions()
 
 
 class FtpSource(Source):
-    url: str = ""
+    __slots__ = ("url",)
+    url: str
 
     def __init__(self, parsed: dict):
         super().__init__(parsed)
@@ -205,15 +288,18 @@ class FtpSource(Source):
 
 
 class UrlSource(Source):
-    url: str = ""
+    __slots__ = ("url", "headers", "derive_trip_updates")
+    url: str
     headers: dict[str, str]
-    derive_trip_updates: bool = False
+    derive_trip_updates: bool
 
     def __init__(self, parsed: Optional[dict] = None):
+        super().__init__(parsed)
+        self.url = ""
         self.headers = {}
+        self.derive_trip_updates = False
 
         if parsed:
-            super().__init__(parsed)
             self.url = parsed["url"]
             if "headers" in parsed:
                 self.headers = parsed["headers"]
@@ -240,18 +326,27 @@ def sourceFromJson(parsed: dict) -> Source:
     sys.exit(1)
 
 
-def inherit_options_from_db_source(source: Source) -> HttpSource:
-    from copy import deepcopy
-    from typing import cast
-
-    result = cast(HttpSource, deepcopy(source))
-    result.__class__ = HttpSource
+def inherit_options_from_db_source(source: Union[TransitlandSource, MobilityDatabaseSource]) -> HttpSource:
+    """
+    Creates an HttpSource with the options of a database source. Only the
+    parts that are changed in place later on are copied.
+    """
+    result = HttpSource()
+    for field in Source.__slots__:
+        setattr(result, field, getattr(source, field))
+
+    result.license = source.license.copy()
+    result.drop_agency_names = list(source.drop_agency_names)
+    result.keep_agency_names = list(source.keep_agency_names)
+    result.url_override = source.url_override
+    result.options = source.options.copy()
     return result
 
 
 class Region:
-    maintainers: List[Maintainer] = []
-    sources: List[Source] = []
+    __slots__ = ("maintainers", "sources")
+    maintainers: List[Maintainer]
+    sources: List[Source]
 
     def __init__(self, parsed: dict):
         self.maintainers = list(map(Maintainer, parsed["maintainers"]))
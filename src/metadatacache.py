@@ -0,0 +1,231 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Compiled region metadata. The parsed regions, together with the sources the
+# Transitland atlas and the Mobility Database resolve their sources to, are
+# kept in one pickle in cache/. A region is only parsed and resolved again
+# if its file changed, or if the atlas or the database export changed and the
+# region has sources of that kind. Regions with Mobility Database sources are
+# also resolved again once the export is due for a refresh.
+#
+
+from pathlib import Path
+from typing import Optional, Iterable
+from metadata import Region, Source, TransitlandSource, MobilityDatabaseSource
+from utils import eprint, collect_secrets
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+import transitland
+import mobilitydatabase
+
+DEFAULT_CACHE_PATH = Path("cache/regions.pickle")
+# Increase when the metadata classes change
+CACHE_VERSION = 3
+
+
+class CompiledRegion:
+    name: str
+    region: Region
+    # Encrypted values in the region file
+    secrets: list[str]
+    # Resolved sources of the database sources that are not skipped, by
+    # their index in region.sources. None if the source could not be resolved.
+    resolved: dict[int, Optional[list[Source]]]
+
+    def __init__(self, name: str, region: Region, secrets: list[str]):
+        self.name = name
+        self.region = region
+        self.secrets = secrets
+        self.resolved = {}
+
+    def resolved_sources(self, index: int) -> Optional[list[Source]]:
+        """
+        The sources that region.sources[index] stands for,
+        or None if it could not be resolved or is skipped.
+        """
+        source = self.region.sources[index]
+        if isinstance(source, (TransitlandSource, MobilityDatabaseSource)):
+            return self.resolved.get(index)
+
+        return [source]
+
+    def databases(self) -> set[str]:
+        """
+        The databases the sources of the region are resolved with.
+        """
+        databases = set()
+        for i in self.resolved:
+            match self.region.sources[i]:
+                case TransitlandSource():
+                    databases.add("transitland")
+                case MobilityDatabaseSource():
+                    databases.add("mobilitydatabase")
+        return databases
+
+
+class CacheEntry:
+    sha256: str
+    resolution_key: tuple
+    compiled: CompiledRegion
+
+    def __init__(self, sha256: str, resolution_key: tuple,
+                 compiled: CompiledRegion):
+        self.sha256 = sha256
+        self.resolution_key = resolution_key
+        self.compiled = compiled
+
+
+class MetadataCache:
+    path: Path
+    atlas_path: Path
+    entries: dict[str, CacheEntry]
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH,
+                 atlas_path: Path = Path("transitland-atlas/")):
+        self.path = path
+        self.atlas_path = atlas_path
+        self.entries = {}
+        self._atlas: Optional[transitland.Atlas] = None
+        self._mobility_database: Optional[mobilitydatabase.Database] = None
+        self._fingerprints: dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, "rb") as f:
+                cache = pickle.load(f)
+            if cache.get("version") == CACHE_VERSION:
+                self.entries = cache["entries"]
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+    def database_fingerprint(self, database: str) -> Optional[str]:
+        if database not in self._fingerprints:
+            match database:
+                case "transitland":
+                    fingerprint = transitland.atlas_fingerprint(
+                        self.atlas_path / "feeds")
+                case "mobilitydatabase":
+                    csv_path = mobilitydatabase.DEFAULT_CSV_PATH
+                    if csv_path.exists() and time.time() \
+                            - csv_path.stat().st_mtime <= mobilitydatabase.MAX_AGE:
+                        fingerprint = mobilitydatabase.export_fingerprint(csv_path)
+                    else:
+                        # Never matches, so the regions that use the export
+                        # are resolved again, which refreshes it first
+                        fingerprint = f"stale:{time.time()}"
+            self._fingerprints[database] = fingerprint
+
+        return self._fingerprints[database]
+
+    def resolution_key(self, compiled: CompiledRegion) -> tuple:
+        """
+        Identifies the versions of the atlas and the database export that
+        the sources of the region are resolved with. Only covers the
+        databases the region uses.
+        """
+        return tuple((database, self.database_fingerprint(database))
+                     for database in sorted(compiled.databases()))
+
+    def atlas(self) -> transitland.Atlas:
+        if not self._atlas:
+            self._atlas = transitland.Atlas.load(self.atlas_path)
+        return self._atlas
+
+    def mobility_database(self) -> mobilitydatabase.Database:
+        if not self._mobility_database:
+            self._mobility_database = mobilitydatabase.Database.load()
+            # Loading may have refreshed the export
+            self._fingerprints.pop("mobilitydatabase", None)
+        return self._mobility_database
+
+    def compile(self, path: Path, content: bytes) -> CompiledRegion:
+        parsed = json.loads(content)
+        compiled = CompiledRegion(path.name[:path.name.rfind(".")],
+                                  Region(parsed),
+                                  list(collect_secrets(parsed)))
+
+        for i, source in enumerate(compiled.region.sources):
+            if source.skip:
+                continue
+
+            match source:
+                case TransitlandSource():
+                    compiled.resolved[i] = self.atlas().sources_by_id(source)
+                case MobilityDatabaseSource():
+                    resolved = self.mobility_database().source_by_id(source)
+                    compiled.resolved[i] = [resolved] if resolved else None
+
+        return compiled
+
+    def regions(self, paths: Iterable[Path],
+                errors: Optional[dict[Path, Exception]] = None) \
+            -> list[CompiledRegion]:
+        """
+        Returns the compiled regions of the region files at paths.
+
+        If errors is given, regions that can't be loaded are left out of the
+        result, and the error is stored in errors instead of raised.
+        """
+        with self._lock:
+            changed = False
+            result = []
+            for path in paths:
+                try:
+                    with open(path, "rb") as f:
+                        content = f.read()
+                    sha256 = hashlib.sha256(content).hexdigest()
+
+                    entry = self.entries.get(path.name)
+                    if not entry or entry.sha256 != sha256 \
+                            or entry.resolution_key \
+                            != self.resolution_key(entry.compiled):
+                        compiled = self.compile(path, content)
+                        entry = CacheEntry(sha256,
+                                           self.resolution_key(compiled),
+                                           compiled)
+                        self.entries[path.name] = entry
+                        changed = True
+                except Exception as e:
+                    if errors is None:
+                        raise
+                    errors[path] = e
+                    continue
+
+                result.append(entry.compiled)
+
+            if changed:
+                try:
+                    self.save()
+                except OSError as e:
+                    eprint(f"Warning: Could not write region metadata cache: {e}")
+
+            return result
+
+    def region(self, path: Path) -> CompiledRegion:
+        return self.regions([path])[0]
+
+    def fingerprint(self, compiled: CompiledRegion) -> tuple:
+        """
+        Changes whenever the region file or the sources it was resolved
+        with change.
+        """
+        entry = self.entries[f"{compiled.name}.json"]
+        return (entry.sha256, entry.resolution_key)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = self.path.parent / f".tmp-{os.getpid()}-{self.path.name}"
+        with open(tmppath, "wb") as f:
+            pickle.dump({
+                "version": CACHE_VERSION,
+                "entries": self.entries
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, self.path)
@@ -2,47 +2,166 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+#
+# The Mobility Database export is cached in mobilitydatabase.csv and
+# refreshed once it is older than MAX_AGE. For lookups, the columns we need
+# are copied into an indexed SQLite database, which is rebuilt whenever the
+# export changes, so scripts don't need to parse the whole export.
+#
+
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Optional
+from urllib.parse import urlparse
 from metadata import UrlSource, HttpSource, Source, MobilityDatabaseSource, License, inherit_options_from_db_source
 from utils import eprint
 import requests
 import csv
 import os
+import sqlite3
+import threading
+import time
 
+EXPORT_URL = "https://files.mobilitydatabase.org/feeds_v2.csv"
+DEFAULT_CSV_PATH = Path("mobilitydatabase.csv")
+DEFAULT_INDEX_PATH = Path("mobilitydatabase.sqlite")
+# Age in seconds after which the export is downloaded again
+MAX_AGE = 24 * 60 * 60
+# Increase when the layout of the index changes
+INDEX_VERSION = 2
 
-class Database:
-    by_id: Dict[str, dict]
+# Columns of the export that are kept in the index
+COLUMNS = ["id", "data_type", "location.country_code", "urls.direct_download",
+           "urls.latest", "status", "redirect.id", "name", "provider",
+           "static_reference", "urls.license"]
+SELECT_COLUMNS = ", ".join(f'"{column}"' for column in COLUMNS)
 
-    def __init__(self):
-        self.by_id = {}
 
-    @staticmethod
-    def load() -> "Database":
-        db = Database()
+def canonicalize_url(url: str) -> str:
+    parsed = urlparse(url)
+    return parsed._replace(scheme="https", netloc=parsed.netloc.strip("www.")).geturl()
+
+
+def download_export(path: Path):
+    eprint(f"Caching Mobility Database export at `{path}`…")
+    resp = requests.get(EXPORT_URL)
+
+    if resp.status_code != 200:
+        raise Exception("Failed to download Mobility Database export")
+
+    tmppath = path.parent / (".tmp-" + str(os.getpid()) + "-" + path.name)
+
+    with open(tmppath, "w") as f:
+        f.write(resp.text)
+    os.rename(tmppath, path)
+
 
-        path = Path("mobilitydatabase.csv")
-        if not path.exists():
-            eprint("Caching Mobility Database export at `mobilitydatabase.csv`…")
-            resp = requests.get("https://files.mobilitydatabase.org/feeds_v2.csv")
+def export_fingerprint(csv_path: Path) -> str:
+    stat = csv_path.stat()
+    return f"{INDEX_VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
 
-            if resp.status_code != 200:
-                raise Exception("Failed to download Mobility Database export")
 
-            tmppath = ".tmp-" + str(os.getpid()) + "-" + str(path)
+def build_index(csv_path: Path, index_path: Path):
+    tmppath = index_path.parent / (".tmp-" + str(os.getpid()) + "-" + index_path.name)
+    tmppath.unlink(missing_ok=True)
 
-            with open(tmppath, "w") as f:
-                f.write(resp.text)
-                os.rename(tmppath, path)
+    connection = sqlite3.connect(tmppath)
+    try:
+        column_definitions = ", ".join(f'"{column}" TEXT' for column in COLUMNS)
+        connection.execute(f"CREATE TABLE feeds ({column_definitions}, canonical_url TEXT)")
+        connection.execute("CREATE TABLE meta (fingerprint TEXT)")
+        connection.execute('CREATE UNIQUE INDEX feeds_id ON feeds ("id")')
 
-        with open(path) as f:
-            for row in csv.DictReader(f, delimiter=",", quotechar="\""):
-                db.by_id[row["id"]] = row
+        with open(csv_path) as f:
+            # If an id occurs more than once, the last row wins
+            connection.executemany(
+                f"INSERT OR REPLACE INTO feeds VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+                ([row.get(column) or "" for column in COLUMNS]
+                 + [canonicalize_url(row.get("urls.direct_download") or "")]
+                 for row in csv.DictReader(f, delimiter=",", quotechar="\"")))
 
-        return db
+        connection.execute('CREATE INDEX feeds_country ON feeds ("location.country_code")')
+        connection.execute("CREATE INDEX feeds_canonical_url ON feeds (canonical_url)")
+        connection.execute("INSERT INTO meta VALUES (?)",
+                           (export_fingerprint(csv_path),))
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmppath, index_path)
+
+
+def index_is_current(csv_path: Path, index_path: Path) -> bool:
+    if not index_path.exists():
+        return False
+
+    try:
+        connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT fingerprint FROM meta").fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+
+    return row is not None and row[0] == export_fingerprint(csv_path)
+
+
+class Database:
+    connection: sqlite3.Connection
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(csv_path: Path = DEFAULT_CSV_PATH,
+             index_path: Path = DEFAULT_INDEX_PATH,
+             max_age: float = MAX_AGE) -> "Database":
+        if not csv_path.exists() \
+                or time.time() - csv_path.stat().st_mtime > max_age:
+            try:
+                download_export(csv_path)
+            except Exception as e:
+                if not csv_path.exists():
+                    raise
+                eprint(f"Warning: Could not refresh Mobility Database export, using the cached one: {e}")
+
+        if not index_is_current(csv_path, index_path):
+            build_index(csv_path, index_path)
+
+        return Database(sqlite3.connect(f"file:{index_path}?mode=ro",
+                                        uri=True, check_same_thread=False))
+
+    def _query(self, condition: str, parameters: tuple) -> list[dict]:
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {SELECT_COLUMNS} FROM feeds {condition}",
+                parameters).fetchall()
+
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def feed_by_id(self, mdb_id: str) -> Optional[dict]:
+        rows = self._query('WHERE "id" = ?', (mdb_id,))
+        return rows[0] if rows else None
+
+    def feed_by_url(self, url: str) -> Optional[dict]:
+        """
+        Finds the feed with the same direct download url, ignoring the
+        scheme and the www. prefix. The last one wins if there are several.
+        """
+        rows = self._query("WHERE canonical_url = ? ORDER BY rowid DESC LIMIT 1",
+                           (canonicalize_url(url),))
+        return rows[0] if rows else None
+
+    def feeds_by_country(self, country_code: str) -> list[dict]:
+        return self._query('WHERE "location.country_code" = ? ORDER BY rowid',
+                           (country_code,))
+
+    def feeds(self) -> list[dict]:
+        return self._query("ORDER BY rowid", ())
 
     def redirect_by_id(self, mdb_id: str) -> Optional[str]:
-        row = self.by_id.get(mdb_id)
+        row = self.feed_by_id(mdb_id)
         if not row:
             return None
 
@@ -50,11 +169,11 @@ class Database:
 
     def source_by_id(self, source: MobilityDatabaseSource) -> Optional[Source]:
         result: Optional[Source] = None
-        feed = self.by_id.get(source.mdb_id)
+        feed = self.feed_by_id(source.mdb_id)
 
         if not feed:
             eprint(f"Warning: Did not find requested id {source.mdb_id} in Mobility Database.")
-            eprint("         Try deleting the cache at `mobilitydatabase.csv` if the feed was added recently.")
+            eprint("         The cache at `mobilitydatabase.csv` is refreshed daily, delete it if the feed was added recently.")
             return None
 
         match feed["data_type"]:
@@ -81,8 +200,8 @@ class Database:
 
         result.license = License()
 
-        if "license" in feed:
-            result.license.url = feed["license"]
+        if feed["urls.license"]:
+            result.license.url = feed["urls.license"]
 
         # Allow to override these as mobility database does not have spdx-identifiers (yet)
         if source.license.spdx_identifier:
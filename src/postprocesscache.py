@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Content addressed cache of postprocessed feeds. Entries are named after the
+# hash of the input file and of every option that changes the result of the
+# postprocessing, so identical inputs are only cleaned once. Entries are
+# hardlinks to the file in out/ they were created from, so they don't need
+# additional space as long as that feed is current. Other outputs that use an
+# entry get their own copy, so no two files in out/ share an inode.
+#
+# For every output, the key it was created with is recorded next to the
+# entries, so an unchanged output isn't restored from the cache again.
+#
+
+from pathlib import Path
+from typing import Optional
+from utils import eprint
+
+import hashlib
+import json
+import os
+
+# Increase when the postprocessing changes in a way not covered by the options
+CACHE_VERSION = 1
+
+
+def postprocess_key(input_sha256: str, options: dict) -> str:
+    canonical = json.dumps({
+        "version": CACHE_VERSION,
+        "input": input_sha256,
+        "options": options
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class PostprocessCache:
+    path: Path
+
+    def __init__(self, path: Path = Path("postprocess-cache/")):
+        self.path = path
+
+    def entry_path(self, key: str, spec: str) -> Path:
+        return self.path / f"{key}.{spec}.zip"
+
+    def lookup(self, key: str, spec: str) -> Optional[Path]:
+        entry = self.entry_path(key, spec)
+        return entry if entry.exists() else None
+
+    def record_path(self, output_path: Path) -> Path:
+        return self.path / "outputs" / f"{output_path.name}.json"
+
+    def is_current(self, key: str, spec: str, output_path: Path) -> bool:
+        """
+        Whether output_path is the result of postprocessing with this key.
+        """
+        try:
+            with open(self.record_path(output_path), "r") as f:
+                record = json.load(f)
+            stat = output_path.stat()
+        except (OSError, ValueError):
+            return False
+
+        return record.get("key") == f"{key}.{spec}" \
+            and record.get("size") == stat.st_size \
+            and record.get("mtime-ns") == stat.st_mtime_ns
+
+    def remember(self, key: str, spec: str, output_path: Path):
+        """
+        Records that output_path is the result of postprocessing with this
+        key. Must be called after the output got its final mtime.
+        """
+        record_path = self.record_path(output_path)
+        tmppath = record_path.parent / f".tmp-{record_path.name}"
+        try:
+            record_path.parent.mkdir(parents=True, exist_ok=True)
+            stat = output_path.stat()
+            with open(tmppath, "w") as f:
+                json.dump({
+                    "key": f"{key}.{spec}",
+                    "output": str(output_path),
+                    "size": stat.st_size,
+                    "mtime-ns": stat.st_mtime_ns
+                }, f)
+            os.replace(tmppath, record_path)
+        except OSError as e:
+            eprint(f"Warning: Could not record the postprocess key of {output_path.name}: {e}")
+
+    def store(self, key: str, spec: str, output_path: Path):
+        """
+        Adds output_path to the cache. The output must not be modified in
+        place afterwards, including its mtime, only replaced.
+        """
+        self.path.mkdir(exist_ok=True)
+        entry = self.entry_path(key, spec)
+        tmppath = entry.parent / f".tmp-{entry.name}"
+        try:
+            tmppath.unlink(missing_ok=True)
+            os.link(output_path, tmppath)
+            os.replace(tmppath, entry)
+        except OSError as e:
+            # A copy would double the space needed, rather don't cache
+            eprint(f"Warning: Could not add {output_path.name} to the postprocess cache: {e}")
+
+    def prune(self) -> list[Path]:
+        """
+        Deletes the entries that are no longer used by any file in out/, and
+        the records of outputs that no longer exist.
+        """
+        for record_path in self.path.glob("outputs/*.json"):
+            try:
+                with open(record_path, "r") as f:
+                    output = json.load(f)["output"]
+            except (OSError, ValueError, KeyError):
+                output = None
+            if not output or not Path(output).exists():
+                record_path.unlink()
+
+        pruned = []
+        for entry in self.path.glob("*.zip"):
+            if entry.stat().st_nlink == 1:
+                entry.unlink()
+                pruned.append(entry)
+
+        return pruned
@@ -0,0 +1,175 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Runs postprocessing jobs in parallel, but only as many at the same time as
+# fit into the available memory. gtfsclean keeps the whole feed in memory, so
+# the memory a job needs is estimated from the uncompressed size of its input.
+# Jobs are admitted in the order they were submitted, so a large feed can't
+# be starved by a stream of small ones.
+#
+
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, TYPE_CHECKING
+from zipfile import ZipFile, BadZipFile
+
+import concurrent.futures
+import itertools
+import os
+import sys
+import threading
+import time
+
+if TYPE_CHECKING:
+    from fetch import FetchJob
+
+MiB = 1024 * 1024
+
+# Memory used by gtfsclean per byte of uncompressed GTFS, and per process
+GTFSCLEAN_MEMORY_FACTOR = 3
+BASE_MEMORY = 64 * MiB
+
+
+def available_memory() -> int:
+    """
+    Memory that can be used without swapping, in bytes.
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def estimate_memory(job: "FetchJob") -> int:
+    """
+    Estimates the peak memory usage of postprocessing job, in bytes.
+    """
+    source = job.source
+    if not job.download_path or not source.use_gtfsclean \
+            or source.spec != "gtfs":
+        return BASE_MEMORY
+
+    try:
+        with ZipFile(job.download_path) as z:
+            uncompressed = sum(info.file_size for info in z.infolist())
+    except (OSError, BadZipFile):
+        # Typical compression ratio of GTFS feeds
+        uncompressed = 10 * job.download_path.stat().st_size \
+            if job.download_path.exists() else 0
+
+    return BASE_MEMORY + GTFSCLEAN_MEMORY_FACTOR * uncompressed
+
+
+class MemoryBudget:
+    """
+    Hands out reservations from a fixed amount of memory in submission order.
+    A reservation larger than the whole budget is granted once nothing else
+    is running.
+    """
+    total: int
+    in_use: int = 0
+
+    def __init__(self, total: int):
+        self.total = total
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._next_ticket = 0
+
+    @contextmanager
+    def reserve(self, amount: int) -> Iterator[None]:
+        with self._condition:
+            ticket = next(self._tickets)
+            self._condition.wait_for(
+                lambda: self._next_ticket == ticket and
+                (self.in_use == 0 or self.in_use + amount <= self.total))
+            self._next_ticket += 1
+            self.in_use += amount
+            # The next job may fit as well
+            self._condition.notify_all()
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= amount
+                self._condition.notify_all()
+
+
+class JobTimes:
+    job_id: str
+    estimated_memory: int
+    queued: float = 0.0
+    running: float = 0.0
+
+    def __init__(self, job_id: str, estimated_memory: int):
+        self.job_id = job_id
+        self.estimated_memory = estimated_memory
+
+
+class PostprocessPool:
+    """
+    Thread pool for postprocessing jobs. The threads mostly wait for the
+    gtfsclean processes they started, the memory budget decides how many of
+    those run at the same time.
+    """
+    max_workers: int
+    budget: MemoryBudget
+    times: list[JobTimes]
+
+    def __init__(self, max_workers: int = os.cpu_count() or 1,
+                 memory: Optional[int] = None):
+        self.max_workers = max_workers
+        self.budget = MemoryBudget(memory or int(available_memory() * 0.75))
+        self.times = []
+        self._times_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+    def __enter__(self) -> "PostprocessPool":
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown()
+
+    def submit(self, job: "FetchJob", function: Callable[["FetchJob"], None]) \
+            -> concurrent.futures.Future:
+        times = JobTimes(job.id, estimate_memory(job))
+        submitted = time.monotonic()
+
+        def run():
+            with self.budget.reserve(times.estimated_memory):
+                started = time.monotonic()
+                times.queued = started - submitted
+                try:
+                    function(job)
+                finally:
+                    times.running = time.monotonic() - started
+                    with self._times_lock:
+                        self.times.append(times)
+                    print(f"Postprocessed {job.id} in {times.running:.1f}s, "
+                          f"queued for {times.queued:.1f}s "
+                          f"(estimated {times.estimated_memory // MiB} MiB)")
+                    sys.stdout.flush()
+
+        return self._executor.submit(run)
+
+    def print_report(self):
+        if not self.times:
+            return
+
+        running = sum(t.running for t in self.times)
+        queued = sum(t.queued for t in self.times)
+        print(f"Postprocessed {len(self.times)} feeds with up to "
+              f"{self.max_workers} jobs and {self.budget.total // MiB} MiB: "
+              f"{running:.1f}s running, {queued:.1f}s queued in total")
+        print("Longest running:")
+        for t in sorted(self.times, key=lambda t: t.running, reverse=True)[:5]:
+            print(f"    {t.job_id}: {t.running:.1f}s, queued for {t.queued:.1f}s, "
+                  f"estimated {t.estimated_memory // MiB} MiB")
+        sys.stdout.flush()
@@ -9,38 +9,190 @@
 
 from metadata import HttpSource
 from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+from utils import eprint
 
+import json
+import os
 import requests
+import threading
+import time
+
+
+class TokenCache:
+    """
+    Credentials shared by the sources of a run. A token is requested once
+    and reused until shortly before it expires. Concurrent requests for the
+    same token wait for the first one instead of requesting their own.
+    """
+    # Don't hand out tokens that are about to expire, at most half of the
+    # lifetime of a token is cut off. Tokens that expire while a job waits
+    # for its download are renewed when the server rejects them.
+    EXPIRY_MARGIN = 60
+
+    def __init__(self):
+        self._tokens: dict[str, tuple[str, float]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, request: Callable[[], tuple[str, float]]) -> str:
+        """
+        Returns the cached token for key, or requests a new one.
+        request returns the token and its lifetime in seconds.
+        """
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            cached = self._tokens.get(key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
+            token, expires_in = request()
+            margin = min(self.EXPIRY_MARGIN, expires_in / 2)
+            self._tokens[key] = \
+                (token, time.monotonic() + expires_in - margin)
+            return token
+
+    def invalidate(self, rejected: Iterable[str]):
+        """
+        Forgets the tokens that are part of the rejected values, for example
+        the headers of a request that a server refused. Tokens that were
+        already renewed since are kept.
+        """
+        rejected = list(rejected)
+        with self._lock:
+            for key, (token, _) in list(self._tokens.items()):
+                if token and any(token in value for value in rejected):
+                    del self._tokens[key]
+
+
+token_cache = TokenCache()
 
 
 def mvo_keycloak_token(source: HttpSource) -> HttpSource:
-    token = requests.post(
-        "https://user.mobilitaetsverbuende.at/auth/realms/dbp-public/protocol/openid-connect/token",
-        data={
-            "client_id": "dbp-public-ui",
-            "username": "5f7xgv6ilp@ro5wy.anonbox.net",
-            "password": ")#E8qE'~CqND5b#",
-            "grant_type": "password",
-            "scope": "openid",
-        },
-    ).json()["access_token"]
+    def request_token() -> tuple[str, float]:
+        response = requests.post(
+            "https://user.mobilitaetsverbuende.at/auth/realms/dbp-public/protocol/openid-connect/token",
+            data={
+                "client_id": "dbp-public-ui",
+                "username": "5f7xgv6ilp@ro5wy.anonbox.net",
+                "password": ")#E8qE'~CqND5b#",
+                "grant_type": "password",
+                "scope": "openid",
+            },
+        ).json()
+        # Without a lifetime, only share the token within a short window
+        return response["access_token"], response.get("expires_in", 120)
+
+    token = token_cache.get("mvo-keycloak", request_token)
 
     source.options.headers["Authorization"] = f"Bearer {token}"
 
     return source
 
 
-def data_public_lu_latest_resource(source: HttpSource) -> HttpSource:
-    api = requests.get(source.url).json()
-    res = sorted(
-        api["resources"],
-        key=lambda res: datetime.fromisoformat(res["last_modified"]),
-        reverse=True,
-    )
-    source.url = res[0]["latest"]
+class ResolverCache:
+    """
+    Remembers which download URL a landing page resolved to, together with
+    the ETag and Last-Modified of the page. Within the TTL, the page is not
+    requested at all. After that, a conditional request is made, and the
+    page is only parsed again if it changed.
+    """
+    path: Path
+    ttl: float
+
+    def __init__(self, path: Path = Path("cache/resolved-urls.json"),
+                 ttl: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self._entries: Optional[dict[str, dict]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+        return self._entries
+
+    def lookup(self, url: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._load().get(url)
+            return dict(entry) if entry else None
+
+    def store(self, url: str, entry: dict):
+        with self._lock:
+            self._load()[url] = entry
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmppath = self.path.parent / f".tmp-{os.getpid()}-{self.path.name}"
+                with open(tmppath, "w") as f:
+                    json.dump(self._entries, f, indent=4)
+                os.replace(tmppath, self.path)
+            except OSError as e:
+                eprint(f"Warning: Could not write resolver cache: {e}")
+
+
+resolver_cache = ResolverCache()
+
+
+def resolve_landing_page(source: HttpSource,
+                         resolve: Callable[[requests.Response], str],
+                         headers: Optional[dict[str, str]] = None,
+                         timeout: int = 30) -> HttpSource:
+    """
+    Sets source.url to the download URL that resolve finds in the response
+    for the landing page at source.url, going through the resolver cache.
+    """
+    url = source.url
+    entry = resolver_cache.lookup(url)
+    now = time.time()
+
+    if entry and now - entry["checked-at"] < resolver_cache.ttl:
+        source.url = entry["resolved-url"]
+        return source
+
+    request_headers = dict(headers or {})
+    if entry and entry.get("etag"):
+        request_headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last-modified"):
+        request_headers["If-Modified-Since"] = entry["last-modified"]
+
+    response = requests.get(url, headers=request_headers, timeout=timeout)
+    if entry and response.status_code == 304:
+        entry["checked-at"] = now
+    else:
+        response.raise_for_status()
+        entry = {
+            "resolved-url": resolve(response),
+            "etag": response.headers.get("ETag"),
+            "last-modified": response.headers.get("Last-Modified"),
+            "checked-at": now
+        }
+
+    resolver_cache.store(url, entry)
+    source.url = entry["resolved-url"]
     return source
 
 
+def data_public_lu_latest_resource(source: HttpSource) -> HttpSource:
+    def latest(response: requests.Response) -> str:
+        api = response.json()
+        res = sorted(
+            api["resources"],
+            key=lambda res: datetime.fromisoformat(res["last_modified"]),
+            reverse=True,
+        )
+        return res[0]["latest"]
+
+    return resolve_landing_page(source, latest)
+
+
 def delhi_gov_in_csrf(source: HttpSource) -> HttpSource:
     from bs4 import BeautifulSoup
 
@@ -59,15 +211,14 @@ def data_slupsk_latest_resource(source: HttpSource) -> HttpSource:
         "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
     }  # user-agent is necessary to avoid 403 Forbidden
 
-    html = requests.get(source.url, headers=headers).text
+    def latest(response: requests.Response) -> str:
+        soup = BeautifulSoup(response.text, "lxml")
+        gtfs_link = soup.find("a", href=lambda x: x and x.endswith(".zip"))["href"]
 
-    soup = BeautifulSoup(html, "lxml")
-    gtfs_link = soup.find("a", href=lambda x: x and x.endswith(".zip"))["href"]
+        base_url = source.url.rsplit("/", 1)[0]
+        return f"{base_url}/{gtfs_link}"
 
-    base_url = source.url.rsplit("/", 1)[0]
-    source.url = f"{base_url}/{gtfs_link}"
-
-    return source
+    return resolve_landing_page(source, latest, headers=headers)
 
 
 def data_kaposvar_latest_resource(source: HttpSource) -> HttpSource:
@@ -77,40 +228,41 @@ def data_kaposvar_latest_resource(source: HttpSource) -> HttpSource:
 
     split_source_url = urlsplit(source.url)
 
-    page_html = requests.get(source.url).text
-    page_html_parsed = BeautifulSoup(page_html, "lxml")
+    def latest(response: requests.Response) -> str:
+        page_html_parsed = BeautifulSoup(response.text, "lxml")
 
-    contains_word_gtfs = re.compile(r".*GTFS.*", re.IGNORECASE)
-    url_path_tag = page_html_parsed.find("a", string=contains_word_gtfs)
-    assert url_path_tag
+        contains_word_gtfs = re.compile(r".*GTFS.*", re.IGNORECASE)
+        url_path_tag = page_html_parsed.find("a", string=contains_word_gtfs)
+        assert url_path_tag
 
-    url_path = url_path_tag["href"]
-    url_path_safe = quote(url_path)
+        url_path = url_path_tag["href"]
+        url_path_safe = quote(url_path)
 
-    source.url = f"{split_source_url.scheme}://{split_source_url.netloc}{url_path_safe}"
-    return source
+        return f"{split_source_url.scheme}://{split_source_url.netloc}{url_path_safe}"
+
+    return resolve_landing_page(source, latest)
 
 
 def data_hodmezovasarhely_latest_resource(source: HttpSource) -> HttpSource:
     import re
     from bs4 import BeautifulSoup
 
-    page_html = requests.get(source.url).text
-    page_html_parsed = BeautifulSoup(page_html, "lxml")
+    def latest(response: requests.Response) -> str:
+        page_html_parsed = BeautifulSoup(response.text, "lxml")
 
-    contains_word_gtfs = re.compile(r".*GTFS.*", re.IGNORECASE)
-    url_paragraph_label = page_html_parsed.find("span", string=contains_word_gtfs)
-    assert url_paragraph_label
+        contains_word_gtfs = re.compile(r".*GTFS.*", re.IGNORECASE)
+        url_paragraph_label = page_html_parsed.find("span", string=contains_word_gtfs)
+        assert url_paragraph_label
 
-    url_paragraph = url_paragraph_label.parent.parent
-    source.url = url_paragraph["href"]
-    return source
+        url_paragraph = url_paragraph_label.parent.parent
+        return url_paragraph["href"]
+
+    return resolve_landing_page(source, latest)
 
 
 def data_metroporto_latest_resource(source: HttpSource) -> HttpSource:
     from bs4 import BeautifulSoup
     from urllib.parse import urljoin
-    import requests
 
     headers = {
         "user-agent": (
@@ -120,26 +272,25 @@ def data_metroporto_latest_resource(source: HttpSource) -> HttpSource:
         )
     }
 
-    html = requests.get(source.url, headers=headers, timeout=30).text
-    soup = BeautifulSoup(html, "html.parser")
+    def latest(response: requests.Response) -> str:
+        soup = BeautifulSoup(response.text, "html.parser")
 
-    li = soup.select_one("li.last.zip")
-    if li is None:
-        raise ValueError("Could not find the latest GTFS link on Metro do Porto page")
+        li = soup.select_one("li.last.zip")
+        if li is None:
+            raise ValueError("Could not find the latest GTFS link on Metro do Porto page")
 
-    a_tag = li.find("a", href=True)
-    if a_tag is None:
-        raise ValueError("No <a> tag with href found")
+        a_tag = li.find("a", href=True)
+        if a_tag is None:
+            raise ValueError("No <a> tag with href found")
 
-    gtfs_url = urljoin(source.url, a_tag["href"])
-    source.url = gtfs_url
-    return source
+        return urljoin(source.url, a_tag["href"])
+
+    return resolve_landing_page(source, latest, headers=headers)
 
 
 def data_stcp_latest_resource(source: HttpSource) -> HttpSource:
     from bs4 import BeautifulSoup
     from urllib.parse import urljoin
-    import requests
     import re
     from datetime import datetime
 
@@ -151,65 +302,64 @@ def data_stcp_latest_resource(source: HttpSource) -> HttpSource:
         )
     }
 
-    html = requests.get(source.url, headers=headers, timeout=30).text
-    soup = BeautifulSoup(html, "html.parser")
-
-    resources = soup.select("li.resource-item")
-    if not resources:
-        raise ValueError("No resources found on STCP page")
-
-    def _extract_download(li, base_url, source):
-        from urllib.parse import urljoin
-
+    def _extract_download(li, base_url):
         for a in li.select("a[href]"):
             href = a.get("href", "")
             label = a.get_text(" ", strip=True).lower()
 
             if "/download/" in href or "transferir" in label:
-                source.url = urljoin(base_url, href)
-                return source
+                return urljoin(base_url, href)
 
         raise ValueError("Download link not found in selected resource")
 
-    # look for Mas Recente
-    for li in resources:
-        heading = li.select_one("a.heading")
-        if not heading:
-            continue
+    def latest(response: requests.Response) -> str:
+        soup = BeautifulSoup(response.text, "html.parser")
 
-        title = heading.get("title", "")
-        text = heading.get_text(" ", strip=True)
+        resources = soup.select("li.resource-item")
+        if not resources:
+            raise ValueError("No resources found on STCP page")
 
-        if "Mais Recente" in title or "Mais Recente" in text:
-            return _extract_download(li, source.url, source)
+        # look for Mas Recente
+        for li in resources:
+            heading = li.select_one("a.heading")
+            if not heading:
+                continue
 
-    # fallback: parse dates and pick latest
-    dated_resources = []
+            title = heading.get("title", "")
+            text = heading.get_text(" ", strip=True)
 
-    date_pattern = re.compile(r"(\d{2}-\d{2}-\d{4})")
+            if "Mais Recente" in title or "Mais Recente" in text:
+                return _extract_download(li, source.url)
 
-    for li in resources:
-        heading = li.select_one("a.heading")
-        if not heading:
-            continue
+        # fallback: parse dates and pick latest
+        dated_resources = []
 
-        text = heading.get_text(" ", strip=True)
+        date_pattern = re.compile(r"(\d{2}-\d{2}-\d{4})")
 
-        match = date_pattern.search(text)
-        if not match:
-            continue
+        for li in resources:
+            heading = li.select_one("a.heading")
+            if not heading:
+                continue
 
-        try:
-            dt = datetime.strptime(match.group(1), "%d-%m-%Y")
-            dated_resources.append((dt, li))
-        except ValueError:
-            continue
+            text = heading.get_text(" ", strip=True)
 
-    if not dated_resources:
-        raise ValueError("No dated GTFS resources found")
+            match = date_pattern.search(text)
+            if not match:
+                continue
 
-    latest_li = max(dated_resources, key=lambda x: x[0])[1]
-    return _extract_download(latest_li, source.url, source)
+            try:
+                dt = datetime.strptime(match.group(1), "%d-%m-%Y")
+                dated_resources.append((dt, li))
+            except ValueError:
+                continue
+
+        if not dated_resources:
+            raise ValueError("No dated GTFS resources found")
+
+        latest_li = max(dated_resources, key=lambda x: x[0])[1]
+        return _extract_download(latest_li, source.url)
+
+    return resolve_landing_page(source, latest, headers=headers)
 
 
 def chile_dtp_downloader(source: HttpSource) -> HttpSource:
@@ -228,54 +378,53 @@ def chile_dtp_downloader(source: HttpSource) -> HttpSource:
        GTFS .zip links and returns the lexicographically largest one.
     4. Returns None if no GTFS links are found at all.
     """
-    response = requests.get(source.url)
-    response.raise_for_status()
+    def latest(response: requests.Response) -> str:
+        soup = BeautifulSoup(response.text, "html.parser")
 
-    soup = BeautifulSoup(response.text, "html.parser")
+        pattern = re.compile(r"GTFS_(\d{8})[^/]*\.zip")
 
-    pattern = re.compile(r"GTFS_(\d{8})[^/]*\.zip")
+        dated_feeds = []
+        all_gtfs_feeds = []
 
-    dated_feeds = []
-    all_gtfs_feeds = []
+        for a in soup.find_all("a", href=True):
+            href = a["href"]
+            if "gtfs" in href.lower() and href.lower().endswith(".zip"):
+                full_url = urljoin(source.url, href)
+                all_gtfs_feeds.append(full_url)
 
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
-        if "gtfs" in href.lower() and href.lower().endswith(".zip"):
-            full_url = urljoin(source.url, href)
-            all_gtfs_feeds.append(full_url)
+                match = pattern.search(href)
+                if match:
+                    date_str = match.group(1)
+                    dated_feeds.append((int(date_str), full_url))
 
-            match = pattern.search(href)
-            if match:
-                date_str = match.group(1)
-                dated_feeds.append((int(date_str), full_url))
+        # Case 1: Found valid date-based feeds → choose latest
+        if dated_feeds:
+            dated_feeds.sort(key=lambda x: x[0], reverse=True)
+            return dated_feeds[0][1]
 
-    # Case 1: Found valid date-based feeds → choose latest
-    if dated_feeds:
-        dated_feeds.sort(key=lambda x: x[0], reverse=True)
-        source.url = dated_feeds[0][1]
-        return source
+        # Case 2: Fallback → lexicographically largest GTFS link
+        if not all_gtfs_feeds:
+            raise ValueError("No GTFS files found!")
 
-    # Case 2: Fallback → lexicographically largest GTFS link
-    if not all_gtfs_feeds:
-        raise ValueError("No GTFS files found!")
+        return max(all_gtfs_feeds)
 
-    source.url = max(all_gtfs_feeds)
-    return source
+    return resolve_landing_page(source, latest)
 
 
 def data_gov_gr_latest_resource(source: HttpSource) -> HttpSource:
-    resources = requests.get(source.url).json()["result"]["resources"]
-
-    gtfs_resources = [
-        r for r in resources
-        if r.get("last_modified")
-        and r.get("format") == "ZIP"
-        and not r.get("downloadall_datapackage_hash")
-    ]
-
-    source.url = max(
-        gtfs_resources,
-        key=lambda r: datetime.fromisoformat(r["last_modified"])
-    )["url"]
-
-    return source
+    def latest(response: requests.Response) -> str:
+        resources = response.json()["result"]["resources"]
+
+        gtfs_resources = [
+            r for r in resources
+            if r.get("last_modified")
+            and r.get("format") == "ZIP"
+            and not r.get("downloadall_datapackage_hash")
+        ]
+
+        return max(
+            gtfs_resources,
+            key=lambda r: datetime.fromisoformat(r["last_modified"])
+        )["url"]
+
+    return resolve_landing_page(source, latest)
@@ -0,0 +1,107 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Shared HTTP sessions, so that feeds hosted on the same server reuse
+# keep-alive connections and TLS sessions, and so that we never open more
+# than a few parallel connections to a single server.
+#
+
+from contextlib import contextmanager
+from typing import Iterator
+from urllib.parse import urlsplit
+from urllib3.util import create_urllib3_context
+from requests.adapters import HTTPAdapter
+from requests import Session
+
+import ssl
+import threading
+import time
+
+
+class LenientCipherAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        context = create_urllib3_context(ciphers="ALL:@SECLEVEL=1", cert_reqs=ssl.CERT_NONE)
+        kwargs['ssl_context'] = context
+        return super(LenientCipherAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class HostLimit:
+    semaphore: threading.Semaphore
+    lock: threading.Lock
+    last_request: float = 0.0
+
+    def __init__(self, max_connections: int):
+        self.semaphore = threading.Semaphore(max_connections)
+        self.lock = threading.Lock()
+
+
+class SessionRegistry:
+    """
+    Hands out one requests session per host and TLS mode.
+
+    max_connections_per_host bounds both the connection pool of each session
+    and the number of requests that may run against a host at the same time.
+    min_request_interval is the minimum time in seconds between the start of
+    two requests to the same host.
+    """
+    max_connections_per_host: int
+    min_request_interval: float
+
+    def __init__(self, max_connections_per_host: int = 4,
+                 min_request_interval: float = 0.2):
+        self.max_connections_per_host = max_connections_per_host
+        self.min_request_interval = min_request_interval
+        self._sessions: dict[tuple[str, bool], Session] = {}
+        self._limits: dict[str, HostLimit] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str, ignore_tls_errors: bool = False) -> Session:
+        key = (host_of(url), ignore_tls_errors)
+        with self._lock:
+            if key not in self._sessions:
+                session = Session()
+                adapter_class = LenientCipherAdapter if ignore_tls_errors \
+                    else HTTPAdapter
+                adapter = adapter_class(
+                    pool_connections=1,
+                    pool_maxsize=self.max_connections_per_host,
+                    pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[key] = session
+
+            return self._sessions[key]
+
+    @contextmanager
+    def host_slot(self, url: str) -> Iterator[None]:
+        """
+        Waits until a request to the host of url may be started,
+        and holds a connection slot for that host until the block is left.
+        """
+        host = host_of(url)
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = HostLimit(self.max_connections_per_host)
+            limit = self._limits[host]
+
+        with limit.semaphore:
+            with limit.lock:
+                wait = limit.last_request + self.min_request_interval \
+                    - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                limit.last_request = time.monotonic()
+
+            yield
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def host_of(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Places a copy of a download next to its output, without copying the bytes
+# where the filesystem allows it. The copy is a copy-on-write reflink, and
+# only if that is not supported, the data is actually copied. Hardlinks are
+# not used, as the mtime of downloads is the state for conditional requests
+# and must not change with the mtime of the output.
+#
+
+from pathlib import Path
+
+import fcntl
+import shutil
+
+# ioctl from linux/fs.h, shares the extents of one file with another
+FICLONE = 0x40049409
+
+
+def reflink(source: Path, dest: Path) -> bool:
+    """
+    Creates dest as a copy-on-write clone of source.
+    Returns False if the filesystem does not support it.
+    """
+    try:
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        dest.unlink(missing_ok=True)
+        return False
+
+
+def stage_file(source: Path, dest: Path):
+    """
+    Makes the content of source available at dest, as a separate file.
+    """
+    dest.unlink(missing_ok=True)
+
+    if not reflink(source, dest):
+        shutil.copyfile(source, dest)
@@ -7,8 +7,31 @@ from typing import Dict, Optional, Union
 import json
 from metadata import UrlSource, HttpSource, Source, TransitlandSource, License, inherit_options_from_db_source
 import sys
+import os
+import hashlib
+import pickle
 from utils import eprint
 
+# Parsing all files of the atlas takes seconds, so the fields needed
+# by sources_by_id are kept in a pickled index, which is rebuilt
+# whenever a file of the atlas changes.
+DEFAULT_INDEX_PATH = Path("cache/transitland-atlas.pickle")
+INDEXED_FIELDS = ["urls", "authorization", "license"]
+# Increase when the format of the index changes
+INDEX_VERSION = 1
+
+
+def atlas_fingerprint(feeds_dir: Path) -> str:
+    """
+    Hash of the names, sizes and mtimes of the atlas files.
+    """
+    fingerprint = hashlib.sha256()
+    for entry in sorted(os.scandir(feeds_dir), key=lambda e: e.name):
+        stat = entry.stat()
+        fingerprint.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+
+    return fingerprint.hexdigest()
+
 
 class Atlas:
     by_id: Dict[str, dict]
@@ -17,14 +40,60 @@ class Atlas:
         self.by_id = {}
 
     @staticmethod
-    def load(path: Path):
+    def load(path: Path, index_path: Optional[Path] = DEFAULT_INDEX_PATH):
+        fingerprint = atlas_fingerprint(path / "feeds")
+        if index_path:
+            atlas = Atlas.load_index(index_path, fingerprint)
+            if atlas:
+                return atlas
+
+        atlas = Atlas.parse(path)
+
+        if index_path:
+            try:
+                atlas.save_index(index_path, fingerprint)
+            except OSError as e:
+                eprint(f"Warning: Could not write Transitland atlas index: {e}")
+
+        return atlas
+
+    @staticmethod
+    def parse(path: Path):
         atlas = Atlas()
         for f in Path(path / "feeds").iterdir():
             for feed in json.load(open(f, "r", encoding="utf-8"))["feeds"]:
-                atlas.by_id[feed["id"]] = feed
+                atlas.by_id[feed["id"]] = \
+                    {key: feed[key] for key in INDEXED_FIELDS if key in feed}
 
         return atlas
 
+    @staticmethod
+    def load_index(index_path: Path, fingerprint: str) -> Optional["Atlas"]:
+        try:
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        if index.get("version") != INDEX_VERSION \
+                or index.get("fingerprint") != fingerprint:
+            return None
+
+        atlas = Atlas()
+        atlas.by_id = index["by_id"]
+        return atlas
+
+    def save_index(self, index_path: Path, fingerprint: str):
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = index_path.parent / f".tmp-{index_path.name}"
+        with open(tmppath, "wb") as f:
+            pickle.dump({
+                "version": INDEX_VERSION,
+                "fingerprint": fingerprint,
+                "by_id": self.by_id
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, index_path)
+
     def sources_by_id(self, source: TransitlandSource) -> Optional[list[Union[UrlSource, HttpSource]]]:
         results: list[Union[UrlSource, HttpSource]] = []
         if not source.transitland_atlas_id in self.by_id:
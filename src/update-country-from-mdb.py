@@ -13,7 +13,7 @@ region_file = sys.argv[1]
 country_code = sys.argv[2]
 
 mdb = Database.load()
-relevant_entries = filter(lambda entry: entry["location.country_code"] == country_code, mdb.by_id.values())
+relevant_entries = mdb.feeds_by_country(country_code)
 
 with open(region_file, "r") as f:
     region = json.load(f)
@@ -37,7 +37,9 @@ with open(region_file, "r") as f:
             if id_map.get(feed["static_reference"]):
                 name = id_map[feed["static_reference"]]["name"]
             else:
-                res = mdb.by_id[feed["static_reference"]]
+                res = mdb.feed_by_id(feed["static_reference"])
+                if not res:
+                    raise KeyError(feed["static_reference"])
                 name = make_name(res["name"], res["provider"], res["id"])
         else:
             name = make_name(feed["name"], feed["provider"], feed["id"])
@@ -5,21 +5,50 @@
 import sys
 import os
 import base64
+import concurrent.futures
 import subprocess
+import threading
+
+from typing import Any, Iterable, Iterator, Optional
+
+import pyrage
 
 AGE_SENTINEL = "AGE-ENCRYPTED:"
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-def decrypt_if_necessary(val):
-    if not val.startswith(AGE_SENTINEL):
-        return val
+# Decrypted secrets of this process, by their encrypted value
+_decrypted: dict[str, str] = {}
+_decryption_lock = threading.Lock()
+
+
+def decryption_failed(error: str):
+    print(f"Feed API key decryption failed. This is expected for static feeds on PRs from forks. If this occurs for RT feeds, you have forgotten to set 'use-feed-proxy'. Original error: {error}")
+
 
-    encrypted_bytes = base64.b64decode(val.replace(AGE_SENTINEL, ""))
+def load_identities(key_file: str) -> Optional[list]:
+    """
+    Loads the age identities from key_file, or returns None if the file
+    contains something only the age command can handle.
+    """
+    with open(key_file, "rb") as f:
+        content = f.read()
 
+    if b"PRIVATE KEY-----" in content:
+        return [pyrage.ssh.Identity.from_buffer(content)]
+
+    lines = [line.strip() for line in content.decode().splitlines()]
+    keys = [line for line in lines if line and not line.startswith("#")]
+    if not keys or not all(key.startswith("AGE-SECRET-KEY-") for key in keys):
+        return None
+
+    return [pyrage.x25519.Identity.from_str(key) for key in keys]
+
+
+def decrypt_with_command(encrypted_bytes: bytes, key_file: str) -> str:
     process = subprocess.Popen(
-        ['age', '--decrypt', '-i', os.environ['TRANSITOUS_FEED_PROXY_KEY_FILE']],
+        ['age', '--decrypt', '-i', key_file],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE
@@ -28,7 +57,81 @@ def decrypt_if_necessary(val):
     stdout, stderr = process.communicate(input=encrypted_bytes)
 
     if process.returncode != 0:
-        print(f"Feed API key decryption failed. This is expected for static feeds on PRs from forks. If this occurs for RT feeds, you have forgotten to set 'use-feed-proxy'. Original error: {stderr.decode()}")
+        decryption_failed(stderr.decode())
         return ""
 
     return stdout.decode('utf-8')
+
+
+def decrypt_batch(values: list[str], key_file: str) -> dict[str, str]:
+    encrypted = {val: base64.b64decode(val.replace(AGE_SENTINEL, ""))
+                 for val in values}
+
+    try:
+        identities = load_identities(key_file)
+    except (OSError, ValueError, pyrage.IdentityError) as e:
+        decryption_failed(str(e))
+        return {val: "" for val in values}
+
+    if identities is None:
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            return dict(zip(values, pool.map(
+                lambda val: decrypt_with_command(encrypted[val], key_file),
+                values)))
+
+    decrypted = {}
+    for val in values:
+        try:
+            decrypted[val] = pyrage.decrypt(encrypted[val], identities) \
+                .decode('utf-8')
+        except pyrage.DecryptError as e:
+            decryption_failed(str(e))
+            decrypted[val] = ""
+
+    return decrypted
+
+
+def decrypt_all(values: Iterable[str]) -> dict[str, str]:
+    """
+    Decrypts all encrypted values at once with a single key load. Results
+    are remembered for the rest of the process.
+    """
+    values = list(values)
+    with _decryption_lock:
+        pending = list({val for val in values
+                        if val.startswith(AGE_SENTINEL) and val not in _decrypted})
+        if pending:
+            _decrypted.update(decrypt_batch(
+                pending, os.environ['TRANSITOUS_FEED_PROXY_KEY_FILE']))
+
+        return {val: _decrypted.get(val, val) for val in values}
+
+
+def collect_secrets(parsed: Any) -> Iterator[str]:
+    """
+    Finds all encrypted strings in parsed JSON.
+    """
+    match parsed:
+        case str() if parsed.startswith(AGE_SENTINEL):
+            yield parsed
+        case dict():
+            for value in parsed.values():
+                yield from collect_secrets(value)
+        case list():
+            for value in parsed:
+                yield from collect_secrets(value)
+
+
+def prefetch_secrets(parsed: Any):
+    """
+    Decrypts all secrets of a region in one go, if a key is available.
+    """
+    if "TRANSITOUS_FEED_PROXY_KEY_FILE" in os.environ:
+        decrypt_all(collect_secrets(parsed))
+
+
+def decrypt_if_necessary(val):
+    if not val.startswith(AGE_SENTINEL):
+        return val
+
+    return decrypt_all([val])[val]
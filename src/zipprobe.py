@@ -0,0 +1,153 @@
+# SPDX-FileCopyrightText: 2025 Jonah Brüchert <jbb@kaidan.im>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+#
+# Compares a remote ZIP file with a local copy without downloading it. Using
+# range requests, only the end of central directory record and the central
+# directory are fetched, which contain the names, sizes and CRC32 values of
+# all members. For servers that send neither Last-Modified nor ETag, this
+# avoids downloading unchanged feeds just to compare their hashes.
+#
+
+from pathlib import Path
+from typing import Any, Optional
+from zipfile import ZipFile, BadZipFile
+from requests import Session
+
+import os
+import re
+
+# Large enough for the end of central directory record of most files, and
+# often for the whole central directory
+TAIL_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class ProbeError(Exception):
+    pass
+
+
+class RangesNotSupported(ProbeError):
+    pass
+
+
+class RemoteFile:
+    """
+    Read-only file object for a file on an HTTP server that fetches the
+    ranges that are read. The end of the file is fetched up front.
+    """
+    size: int
+    transferred: int = 0
+
+    def __init__(self, session: Session, url: str, headers: dict[str, str],
+                 request_options: dict[str, Any]):
+        self.session = session
+        self.url = url
+        self.headers = headers
+        self.request_options = request_options
+        self._segments: list[tuple[int, bytes]] = []
+        self._position = 0
+
+        start, data, size = self._fetch(f"bytes=-{TAIL_SIZE}")
+        self.size = size
+        self._segments.append((start, data))
+
+    def _fetch(self, byte_range: str) -> tuple[int, bytes, int]:
+        with self.session.get(self.url,
+                              headers=self.headers | {"range": byte_range},
+                              stream=True, **self.request_options) as response:
+            # Errors may be temporary, and say nothing about range support
+            response.raise_for_status()
+
+            if response.status_code == 200:
+                # Servers may send small files whole, even if they support
+                # ranges. Only a full response that is larger than the range
+                # shows that ranges are not supported.
+                length = response.headers.get("content-length", "")
+                if not length.isdigit():
+                    raise ProbeError("Server answered range request with 200 of unknown length")
+                if int(length) > TAIL_SIZE:
+                    # Close the connection instead of reading a full response
+                    raise RangesNotSupported(
+                        f"Server answered range request with {response.status_code}")
+
+                data = response.content
+                self.transferred += len(data)
+                return 0, data, len(data)
+
+            content_range = CONTENT_RANGE.fullmatch(
+                response.headers.get("content-range", ""))
+            if response.status_code == 206 and not content_range:
+                raise RangesNotSupported("Server answered range request without a valid Content-Range")
+            if response.status_code != 206:
+                raise ProbeError(
+                    f"Unexpected answer to range request: {response.status_code}")
+
+            data = response.content
+            self.transferred += len(data)
+            return int(content_range[1]), data, int(content_range[3])
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        match whence:
+            case os.SEEK_SET:
+                self._position = offset
+            case os.SEEK_CUR:
+                self._position += offset
+            case os.SEEK_END:
+                self._position = self.size + offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, n: int = -1) -> bytes:
+        start = self._position
+        end = self.size if n < 0 else min(start + n, self.size)
+        if start >= end:
+            return b""
+
+        for segment_start, data in self._segments:
+            if segment_start <= start and end <= segment_start + len(data):
+                self._position = end
+                return data[start - segment_start:end - segment_start]
+
+        segment_start, data, _ = self._fetch(f"bytes={start}-{end - 1}")
+        self._segments.append((segment_start, data))
+        self._position = end
+        return data[start - segment_start:end - segment_start]
+
+
+def members(zip_file: ZipFile) -> list[tuple[str, int, int]]:
+    return sorted((info.filename, info.file_size, info.CRC)
+                  for info in zip_file.infolist())
+
+
+def local_members(path: Path) -> Optional[list[tuple[str, int, int]]]:
+    try:
+        with ZipFile(path) as z:
+            return members(z)
+    except (OSError, BadZipFile):
+        return None
+
+
+def remote_matches(session: Session, url: str, headers: dict[str, str],
+                   request_options: dict[str, Any],
+                   local: list[tuple[str, int, int]]) -> tuple[bool, int]:
+    """
+    Whether the ZIP file at url has the same members as local, and the
+    number of bytes that were transferred to find out.
+
+    Raises RangesNotSupported if the server ignores range requests, and
+    ProbeError or a requests exception if the probe failed otherwise.
+    """
+    remote = RemoteFile(session, url, headers, request_options)
+    try:
+        with ZipFile(remote) as z:
+            return members(z) == local, remote.transferred
+    except BadZipFile:
+        return False, remote.transferred